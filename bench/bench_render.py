@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmark the JSON serialisation of typical dispatch bodies, e.g.:
+
+      python bench/bench_render.py
+"""
+
+import decimal
+import json
+import timeit
+
+from mock import Mock
+
+from pyramid import interfaces as pi
+from pyramid import registry
+from pyramid import renderers
+
+from pyramid_torque_engine import render
+
+PAYLOADS = {
+    'engine': {
+        'action': u'action:START',
+        'state': u'state:STARTED',
+        'event_id': 1234,
+        'state_event_id': 1235,
+    },
+    'hook': {
+        'event': {
+            'id': 1234,
+            'type': u'job:started',
+            'data': {
+                'snapshot': {
+                    'parent': {'id': 12, 'type': u'jobs'},
+                    'user': {'id': 3, 'type': u'auth_users'},
+                },
+                'amount': decimal.Decimal('12.50'),
+                'items': [{'id': i, 'qty': decimal.Decimal(i)} for i in range(20)],
+            },
+        },
+        'context': {'id': 12, 'state': u'state:STARTED'},
+    },
+}
+
+def main(number=20000):
+    request = Mock()
+    request.environ = {}
+    request.registry = registry.Registry()
+    renderer = renderers.JSON()
+    renderer.add_adapter(decimal.Decimal, lambda obj, request: float(obj))
+    request.registry.registerUtility(renderer, pi.IRendererFactory, name='json')
+    serializers = [
+        ('json_dumps', lambda value: render.json_dumps(request, value)),
+        ('_json_dumps', lambda value: render._json_dumps(value)),
+    ]
+    backends = [('json', json), ('simplejson', render.simplejson)]
+    for label, backend in backends:
+        if backend is not None:
+            dumps = render.CompactJSONSerializer(backend=backend)
+            label = 'compact ({0})'.format(label)
+            call = lambda value, dumps=dumps: dumps(request, value)
+            serializers.append((label, call))
+    for name, value in sorted(PAYLOADS.items()):
+        print '{0} payload:'.format(name)
+        for label, dumps in serializers:
+            seconds = timeit.timeit(lambda: dumps(value), number=number)
+            usecs = seconds * 1e6 / number
+            print '  {0:<22} {1:8.2f} us/call'.format(label, usecs)
+
+
+if __name__ == '__main__':
+    main()
@@ -41,7 +41,11 @@ setup(
     ],
     entry_points = {
         'console_scripts': [
-            'engine_notification = pyramid_torque_engine.notification_table_executer:run'
+            'engine_backfill_work_status = pyramid_torque_engine.backfill:run',
+            'engine_create_indexes = pyramid_torque_engine.migrate:run',
+            'engine_notification = pyramid_torque_engine.notification_table_executer:run',
+            'engine_prune_ledger = pyramid_torque_engine.ledger:run',
+            'engine_outbox_relay = pyramid_torque_engine.relay:run',
         ]
     }
 )
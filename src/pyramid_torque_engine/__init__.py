@@ -80,6 +80,10 @@ class IncludeMe(object):
         # Provide the `request.torque` client API.
         config.include('pyramid_torque_engine.client')
 
+        # Defer flushing state changes until commit, iff the
+        # `engine.deferred_flush` setting is enabled.
+        config.include('pyramid_torque_engine.deferred')
+
         # Expose the `/` index view.
         config.add_route('index', '/')
         config.scan('pyramid_torque_engine.view')
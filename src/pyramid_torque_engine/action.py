@@ -21,6 +21,10 @@
 
       machine.can('a.DECLINE') # True or False
 
+  Note that the machine is a lightweight, per call view onto a transition table
+  that's compiled from the registered rules when the configuration is committed.
+  The table is never mutated after that, so it's safe to share between threads.
+
   You can register a valid action for any state using the `*` character and
   register an action that doesn't actually set the state using ``Ellipsis``:
 
@@ -38,19 +42,129 @@
 __all__ = [
     'AddEngineAction',
     'StateChanger',
+    'StateMachine',
+    'TransitionTable',
     'get_state_machine',
+    'resolve_interface',
 ]
 
 import logging
 logger = logging.getLogger(__name__)
 
 import fysom
+import zope.interface as zi
 
 from collections import defaultdict
 
+from . import constants
+from . import deferred
+from . import orm
 from . import util
 from . import repo
 
+class StateMachine(object):
+    """Stateless, per call view onto the transition rules compiled for a single
+      ``context`` that provides the ``can()`` / ``trigger()`` api, e.g.:
+
+          machine = StateMachine(table, IFoo, u'state:CREATED')
+          machine.can(u'action:START') # True or False
+          machine.trigger(u'action:START') # u'state:STARTED'
+
+      Instances are cheap to create and are never shared, so triggering an
+      action only ever changes the ``current`` value of this instance.
+    """
+
+    def __init__(self, table, context, current):
+        self.table = table
+        self.context = context
+        self.current = current
+
+    def can(self, action):
+        """Is ``action`` valid in the current state?"""
+
+        return self.table.lookup(self.context, self.current, action) is not None
+
+    def cannot(self, action):
+        return not self.can(action)
+
+    def trigger(self, action):
+        """Set and return the next state, raising a ``fysom.FysomError`` if
+          ``action`` isn't valid in the current state.
+        """
+
+        next_state = self.table.lookup(self.context, self.current, action)
+        if next_state is None:
+            msg = 'event {0} inappropriate in current state {1}'
+            raise fysom.FysomError(msg.format(action, self.current))
+        self.current = next_state
+        return next_state
+
+class TransitionTable(object):
+    """Immutable ``(context, from_state, action) -> to_state`` lookup table,
+      compiled from the ``registry.state_action_rules``.
+
+      Rules registered for any state using ``*`` are expanded to every state
+      that the context's rules mention and rules with a to state of
+      ``Ellipsis`` are resolved to their from state. The ``*`` rule itself is
+      kept so that it matches states that aren't mentioned in the rules.
+    """
+
+    def __init__(self, rules):
+        self._transitions = transitions = {}
+        self._actions = actions = {}
+        for context, action_rules in rules.items():
+            # Gather all the states that the rules for this context mention.
+            states = set()
+            for allowed in action_rules.values():
+                for from_states, to_state in allowed:
+                    states.update(from_states)
+                    states.add(to_state)
+            states.discard(constants.ASTERIX)
+            states.discard(Ellipsis)
+            # Map the wildcard rules first, so that explicit rules win.
+            explicit = []
+            for action, allowed in action_rules.items():
+                for from_states, to_state in allowed:
+                    for state in from_states:
+                        if state != constants.ASTERIX:
+                            explicit.append((action, state, to_state))
+                            continue
+                        key = (context, constants.ASTERIX, action)
+                        transitions[key] = to_state
+                        for item in states:
+                            value = item if to_state is Ellipsis else to_state
+                            transitions[(context, item, action)] = value
+            for action, state, to_state in explicit:
+                value = state if to_state is Ellipsis else to_state
+                transitions[(context, state, action)] = value
+            actions[context] = frozenset(action_rules.keys())
+
+    def __contains__(self, context):
+        return context in self._actions
+
+    def has_action(self, context, action):
+        """Is ``action`` registered for ``context`` in any state?"""
+
+        return action in self._actions.get(context, ())
+
+    def lookup(self, context, from_state, action):
+        """Return the state to transition to or ``None`` if ``action`` isn't
+          valid for ``context`` in ``from_state``.
+        """
+
+        to_state = self._transitions.get((context, from_state, action))
+        if to_state is None:
+            key = (context, constants.ASTERIX, action)
+            to_state = self._transitions.get(key)
+        if to_state is Ellipsis:
+            to_state = from_state
+        return to_state
+
+    def machine(self, context, current):
+        """Return a new ``StateMachine`` for ``context`` in ``current`` state."""
+
+        return StateMachine(self, context, current)
+
 class StateChanger(object):
     """High level api to validate and perform state changes that uses the
       engine configuration and client to make decisions and notify.
@@ -68,61 +182,204 @@ class StateChanger(object):
             machine = self.get_machine(context, action=action)
         return bool(machine and machine.can(action))
 
-    def perform(self, context, action, event):
+    def perform(self, context, action, event, machine=None):
         """Return the next state that ``self.context`` should transition to iff
           it's different from the current state.
         """
 
         # Unpack.
         engine = self.engine
-        machine = self.get_machine(context, action=action)
+        if machine is None:
+            machine = self.get_machine(context, action=action)
         current_state = machine.current
         request = self.request
 
         # Prepare return value.
         next_state, has_changed, dispatched = None, False, []
 
-        # Use the state machine to give us the next state.
-        try:
-            machine.trigger(action)
-        except TypeError:
-            # If the to_state is `Ellipsis` that means noop. Now, the current
-            # fysom machinery raises a TypeError when the value is Ellipsis,
-            # so we catch that error in, and only in, that case.
-            if machine.current is not Ellipsis:
-                raise
-        # And here (regardless of whether a TypeError was raised) we revert to
-        # the previous state if the new value is `Ellipsis`.
-        if machine.current == Ellipsis:
-            machine.current = current_state
-        next_state = machine.current
+        # Use the state machine to give us the next state. Note that this
+        # raises a `FysomError` if the action isn't valid in the current state
+        # and resolves a to state of `Ellipsis` to the current state.
+        next_state = machine.trigger(action)
 
         # If the state has changed create a new work status entry (with the
-        # activity event hung off it) and notify.
+        # activity event hung off it) and notify about the new state and the
+        # action in a single dispatch.
         if next_state != current_state:
             has_changed = True
-            # Create a new activity event for the new state.
-            event_factory = repo.ActivityEventFactory(request)
-            event_type = event_factory.type_from_context_action(event.parent, next_state)
-            state_event = event_factory(event.parent, event.user, type_=event_type)
-            context.set_work_status(next_state, state_event)
-            # Broadcast the new event.
-            dispatched.append(engine.changed(context, state_event))
+            state_event = self.change_state(context, next_state, event)
+            dispatched.append(engine.changed_and_happened(context, action,
+                    state_event, event=event, state=next_state))
 
-        # Either way, notify that the action has been performed.
-        dispatched.append(engine.happened(context, action, event=event))
+        # Otherwise just notify that the action has been performed.
+        else:
+            dispatched.append(engine.happened(context, action, event=event))
 
         # Return all the available information.
         return next_state, has_changed, dispatched
 
+    def try_perform(self, context, action, event=None, get_event=None):
+        """Validate and perform ``action`` in one pass, resolving the machine
+          and reading the current state once. Returns ``None`` if ``context``
+          can't perform the action, otherwise the same ``(next_state,
+          has_changed, dispatched)`` as ``perform``.
+
+          If provided, ``get_event`` is called to create the event only once
+          the action has been validated.
+        """
+
+        machine = self.get_machine(context, action=action)
+        if not (machine and machine.can(action)):
+            return None
+        if get_event is not None:
+            event = get_event()
+        return self.perform(context, action, event, machine=machine)
+
+    def perform_many(self, contexts, action, user, **kwargs):
+        """Perform ``action`` on each of the ``contexts`` that can perform it,
+          as ``user``. Returns a list of ``(context, next_state, has_changed,
+          dispatched)`` tuples for the contexts that performed the action.
+
+          The current states and the status and event associations are loaded
+          up front, the activity events and work statuses are written in one
+          batched flush and, once they've been written, the notifications are
+          dispatched in a single batch.
+        """
+
+        # Compose.
+        get_statuses = kwargs.get('get_statuses', orm.get_current_work_statuses)
+        load_associations = kwargs.get('load_associations',
+                orm.load_associations)
+        unit_cls = kwargs.get('unit_cls', deferred.DeferredFlush)
+
+        # Unpack.
+        engine = self.engine
+        event_factory = repo.ActivityEventFactory(self.request)
+
+        # Bulk load the current states and associations.
+        contexts = list(contexts)
+        load_associations(contexts)
+        statuses = get_statuses(contexts)
+
+        # Validate and perform the action, deferring the writes.
+        performed = []
+        with unit_cls():
+            for context in contexts:
+                status = statuses.get(context, None)
+                if status is None:
+                    continue
+                current_state = status.value
+                machine = self.get_machine(context, action=action,
+                        state=current_state)
+                if not (machine and machine.can(action)):
+                    continue
+                event = event_factory(context, user, action=action)
+                next_state = machine.trigger(action)
+                state_event = None
+                if next_state != current_state:
+                    state_event = self.change_state(context, next_state, event)
+                performed.append((context, event, next_state, state_event))
+
+        # Notify in a single batch.
+        if not performed:
+            return []
+        items = []
+        for context, event, next_state, state_event in performed:
+            state = next_state if state_event else None
+            items.append((context, action, event, state_event, state))
+        dispatch = engine.happened_many(items)
+        results = []
+        for context, event, next_state, state_event in performed:
+            has_changed = state_event is not None
+            results.append((context, next_state, has_changed, [dispatch]))
+        return results
+
+    def perform_each(self, items, **kwargs):
+        """Perform each of the ``(context, action, event)`` ``items`` whose
+          action the context can perform. Returns a list, in the same order
+          as the ``items``, of ``None`` for the items that weren't performed,
+          otherwise the same ``(next_state, has_changed, dispatched)`` as
+          ``perform``.
+
+          As with ``perform_many``, the current states are loaded in one
+          query, the writes are deferred to one batched flush and the
+          notifications are dispatched once they've been written. Items
+          without an event fall back on the event of the context's current
+          work status.
+        """
+
+        # Compose.
+        get_statuses = kwargs.get('get_statuses', orm.get_current_work_statuses)
+        unit_cls = kwargs.get('unit_cls', deferred.DeferredFlush)
+
+        # Unpack.
+        engine = self.engine
+
+        # Bulk load the current states.
+        items = list(items)
+        statuses = get_statuses(set(context for context, _, _ in items))
+        states = dict((k, v.value) for k, v in statuses.items())
+
+        # Validate and perform the actions, deferring the writes and keeping
+        # track of the new states, in case a context appears more than once.
+        performed = []
+        with unit_cls():
+            for context, action, event in items:
+                current_state = states.get(context, None)
+                if current_state is None:
+                    performed.append(None)
+                    continue
+                machine = self.get_machine(context, action=action,
+                        state=current_state)
+                if not (machine and machine.can(action)):
+                    performed.append(None)
+                    continue
+                if event is None:
+                    event = statuses[context].event
+                next_state = machine.trigger(action)
+                state_event = None
+                if next_state != current_state:
+                    state_event = self.change_state(context, next_state, event)
+                    states[context] = next_state
+                performed.append((context, action, event, next_state,
+                        state_event))
+
+        # Notify.
+        results = []
+        for item in performed:
+            if item is None:
+                results.append(None)
+                continue
+            context, action, event, next_state, state_event = item
+            if state_event:
+                dispatch = engine.changed_and_happened(context, action,
+                        state_event, event=event, state=next_state)
+            else:
+                dispatch = engine.happened(context, action, event=event)
+            has_changed = state_event is not None
+            results.append((next_state, has_changed, [dispatch]))
+        return results
+
+    def change_state(self, context, next_state, event):
+        """Create a new activity event for ``next_state``, parented like the
+          ``event`` that triggered it, and use it to set the work status.
+        """
+
+        event_factory = repo.ActivityEventFactory(self.request)
+        event_type = event_factory.type_from_context_action(event.parent, next_state)
+        state_event = event_factory(event.parent, event.user, type_=event_type)
+        context.set_work_status(next_state, state_event)
+        return state_event
+
 get_state_changer = lambda request: StateChanger(request)
 
 def get_state_machine(request, context, action=None, **kwargs):
-    """Request method to lookup a Fysom state machine configured with action rules
+    """Request method to lookup a state machine configured with action rules
       that determine which actions are possible from any given state.
 
-      The machine returned has its current state set to the state of the context.
-      The api for validation checks is then the native Fysom api, e.g.:
+      The machine returned has its current state set to the state of the context,
+      unless a ``state`` is passed in. The api for validation checks is then the
+      Fysom-like ``can`` api, e.g.:
 
           machine = request.get_state_machine(context)
           machine.can('do_thing') # True or False depending on action config
@@ -131,41 +388,62 @@ def get_state_machine(request, context, action=None, **kwargs):
 
     # Compose.
     get_interfaces = kwargs.get('get_interfaces', util.get_interfaces)
+    provided_by = kwargs.get('provided_by', zi.providedBy)
 
     # Unpack.
-    machines = request.registry.state_action_machines
+    registry = request.registry
+    table = registry.state_action_table
+    cache = registry.state_machine_cache
+
+    # Resolve the most specific interface with matching rules, memoizing
+    # the result by the specification the context provides.
+    cache_key = (provided_by(context), action)
+    try:
+        key = cache[cache_key]
+    except KeyError:
+        key = cache[cache_key] = resolve_interface(table, context, action,
+                get_interfaces=get_interfaces)
+
+    # Return a new machine populated with the current state.
+    if key is None:
+        return None
+    state = kwargs.get('state', None)
+    if state is None:
+        state = context.work_status.value
+    return table.machine(key, state)
+
+def resolve_interface(table, context, action=None, **kwargs):
+    """Return the first of the ``context``'s interfaces, most specific first,
+      that has rules in the transition ``table`` -- and, if provided, has
+      rules for the ``action``.
+    """
+
+    # Compose.
+    get_interfaces = kwargs.get('get_interfaces', util.get_interfaces)
 
-    # Get a matching machine.
-    machine = None
     for key in get_interfaces(context):
-        fsm = machines.get(key, None)
-        if not fsm:
+        if key not in table:
             continue
-        if action and not hasattr(fsm, action):
+        if action and not table.has_action(key, action):
             continue
-        machine = fsm
-        break
-
-    # Populate the current state.
-    if machine:
-        machine.current = context.work_status.value
-    return machine
+        return key
+    return None
 
 class AddEngineAction(object):
     """We use (you might say abuse) the Pyramid two-phase configuration machinery
       by eager-building a dictionary of `state_action_rules` on the registry
-      keyed by context and name and then using this data to populate a single
-      fsm instance for each context.
+      keyed by context and name and then using this data to compile a single
+      immutable transition table.
     """
 
     def __init__(self, **kwargs):
-        self.machine_cls = kwargs.get('machine_cls', fysom.Fysom)
+        self.table_cls = kwargs.get('table_cls', TransitionTable)
 
     def __call__(self, config, context, action, from_states, to_state):
         """We use (you might say abuse) the Pyramid two-phase configuration machinery
           by eager-building a dictionary of `state_action_rules` on the registry
-          keyed by context and name and then using this data to populate a single
-          fsm instance for each context.
+          keyed by context and name and then using this data to compile a single
+          immutable transition table.
         """
         # Unpack.
         registry = config.registry
@@ -200,9 +478,9 @@ class AddEngineAction(object):
 
 
     def register(self, registry, context):
-        """Iff there isn't already a finite state machine registered for this
-          context then use the ``registry.state_action_rules`` to create and
-          register one.
+        """Iff the transition table doesn't already contain rules for this
+          context then use the ``registry.state_action_rules`` to compile and
+          register a new table.
 
           This will noop except for the first call for each given ``context``.
 
@@ -211,20 +489,13 @@ class AddEngineAction(object):
         """
 
         # Noop if we've done this already.
-        machines = registry.state_action_machines
-        if machines.has_key(context):
+        if context in registry.state_action_table:
             return
 
-        # Coerce the stored rules to an fysom.Fysom events list.
-        events = []
-        for key, value in registry.state_action_rules[context].items():
-            for allowed_states_tuple in value:
-                event = dict(name=key.encode('utf-8'), src=allowed_states_tuple[0], dst=allowed_states_tuple[1])
-                events.append(event)
-
-        # Create and register the machine.
-        machine = self.machine_cls(events=events)
-        registry.state_action_machines[context] = machine
+        # Compile and register the table, clearing any interfaces that have
+        # been resolved against the previous table.
+        registry.state_action_table = self.table_cls(registry.state_action_rules)
+        registry.state_machine_cache.clear()
 
 class IncludeMe(object):
     """Setup the action registry and provide the `add_engine_action` directive."""
@@ -247,8 +518,9 @@ class IncludeMe(object):
         config.add_request_method(get_state_changer, 'state_changer', reify=True)
 
         # Provide `register_action` directive.
-        config.registry.state_action_machines = {}
         config.registry.state_action_rules = defaultdict(dict)
+        config.registry.state_action_table = TransitionTable({})
+        config.registry.state_machine_cache = {}
         config.add_directive('add_engine_action', add_action)
 
 includeme = IncludeMe().__call__
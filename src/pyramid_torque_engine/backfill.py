@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""Provides a command to populate the denormalised current work status
+  columns of existing ``orm.CurrentWorkStatusMixin`` rows, e.g.:
+
+      engine_backfill_work_status myapp.model.Job myapp.model.Quote
+
+  Rows are updated in batches of primary key ranges, each in its own
+  transaction. Only the rows without a current work status are updated, so
+  the command can be run against a live database without overwriting the
+  statuses set in the meantime.
+"""
+
+__all__ = [
+    'backfill',
+    'run',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import argparse
+import os
+import transaction
+
+from pyramid import path
+from sqlalchemy import create_engine
+from sqlalchemy import sql
+from zope.sqlalchemy import mark_changed
+
+from pyramid_basemodel import bind_engine
+from pyramid_basemodel import Session
+
+DEFAULT_BATCH_SIZE = 10000
+
+def backfill(model_cls, batch_size=DEFAULT_BATCH_SIZE, session=Session):
+    """Backfill the current work status of all ``model_cls`` rows that don't
+      have one, returning the number of rows updated.
+    """
+
+    # Get the range of ids to update.
+    table = model_cls.__table__
+    query = session.query(sql.func.min(table.c.id), sql.func.max(table.c.id))
+    min_id, max_id = query.one()
+    if max_id is None:
+        return 0
+
+    # Update them a batch at a time.
+    count = 0
+    for start in xrange(min_id, max_id + 1, batch_size):
+        statement = model_cls.backfill_current_work_status(min_id=start,
+                max_id=start + batch_size)
+        with transaction.manager:
+            result = session.execute(statement)
+            mark_changed(session())
+            count += result.rowcount
+        logger.info(('backfilled', model_cls.__name__, start, count))
+    return count
+
+def run():
+    # Parse the dotted names of the classes to backfill.
+    parser = argparse.ArgumentParser(description='Backfill current work statuses.')
+    parser.add_argument('classes', nargs='+', metavar='dotted.ModelClass')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    # Bind to the database.
+    engine = create_engine(os.environ['DATABASE_URL'])
+    bind_engine(engine, should_create=False)
+
+    # Backfill each class in turn.
+    resolver = path.DottedNameResolver()
+    for dotted_name in args.classes:
+        model_cls = resolver.resolve(dotted_name)
+        count = backfill(model_cls, batch_size=args.batch_size)
+        print '{0}: {1} rows backfilled'.format(dotted_name, count)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""Provides a bounded pool of background worker threads, used by the
+  ``client.BackgroundDispatcher`` to make dispatches after commit without
+  blocking the request thread.
+
+  When the queue is full, the dispatcher applies its backpressure policy:
+
+  * ``block``: wait for room in the queue
+  * ``outbox``: write the dispatch to the outbox for the relay to send
+  * ``error``: raise ``Queue.Full`` to the caller, before the transaction
+    commits, if the queue is already full -- should it fill up in the
+    meantime, the dispatch is logged and dropped, as after commit hooks
+    can't raise
+
+  The workers are shared per process and are drained on shutdown.
+"""
+
+__all__ = [
+    'BACKPRESSURE_POLICIES',
+    'BLOCK',
+    'DispatchWorkers',
+    'ERROR',
+    'OUTBOX',
+    'get_workers',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import atexit
+import Queue
+import threading
+import time
+
+BLOCK = 'block'
+ERROR = 'error'
+OUTBOX = 'outbox'
+BACKPRESSURE_POLICIES = (BLOCK, ERROR, OUTBOX)
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_DRAIN_TIMEOUT = 10
+DEFAULT_QUEUE_SIZE = 1000
+
+STOP = object()
+
+class DispatchWorkers(object):
+    """A bounded queue of tasks, called in order of arrival by a fixed number
+      of daemon worker threads, which are started on demand.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY,
+            queue_size=DEFAULT_QUEUE_SIZE, **kwargs):
+        self.concurrency = concurrency
+        self.queue = kwargs.get('queue_cls', Queue.Queue)(queue_size)
+        self.thread_cls = kwargs.get('thread_cls', threading.Thread)
+        self.lock = threading.Lock()
+        self.threads = []
+        self.is_draining = False
+
+    def start(self):
+        """Start the worker threads, unless already started or drained."""
+
+        with self.lock:
+            if self.threads or self.is_draining:
+                return
+            for i in xrange(self.concurrency):
+                name = 'torque-dispatch-{0}'.format(i)
+                thread = self.thread_cls(target=self.work, name=name)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def put(self, task, block=True, timeout=None):
+        """Queue the ``task``, raising ``Queue.Full`` if there's no room for
+          it. Once draining, tasks are called in the current thread instead.
+        """
+
+        if self.is_draining:
+            return task()
+        self.start()
+        self.queue.put(task, block, timeout)
+
+    def is_full(self):
+        """Would putting a task raise ``Queue.Full`` right now?"""
+
+        return not self.is_draining and self.queue.full()
+
+    def work(self):
+        """Call queued tasks until told to stop."""
+
+        while True:
+            task = self.queue.get()
+            try:
+                if task is STOP:
+                    return
+                task()
+            except Exception:
+                logger.exception('torque.background.failed')
+            finally:
+                self.queue.task_done()
+
+    def drain(self, timeout=DEFAULT_DRAIN_TIMEOUT):
+        """Stop the workers once they've called the queued tasks, waiting up
+          to ``timeout`` seconds. Returns the number of tasks left behind.
+        """
+
+        with self.lock:
+            self.is_draining = True
+            threads, self.threads = self.threads, []
+        deadline = time.time() + timeout
+        try:
+            for thread in threads:
+                self.queue.put(STOP, True, max(0, deadline - time.time()))
+        except Queue.Full:
+            pass
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+        pending = sum(1 for task in list(self.queue.queue) if task is not STOP)
+        if pending:
+            logger.warn(('torque.background.abandoned', pending))
+        return pending
+
+_lock = threading.Lock()
+_workers = {}
+
+def get_workers(settings=None):
+    """Get or create the process wide workers configured by the ``settings``,
+      registering them to be drained when the process exits.
+    """
+
+    if settings is None:
+        settings = {}
+    concurrency = int(settings.get('torque.background_concurrency',
+            DEFAULT_CONCURRENCY))
+    queue_size = int(settings.get('torque.queue_size', DEFAULT_QUEUE_SIZE))
+    timeout = float(settings.get('torque.drain_timeout', DEFAULT_DRAIN_TIMEOUT))
+    key = (concurrency, queue_size)
+    with _lock:
+        workers = _workers.get(key, None)
+        if workers is None:
+            workers = DispatchWorkers(concurrency, queue_size)
+            atexit.register(workers.drain, timeout)
+            _workers[key] = workers
+    return workers
@@ -3,36 +3,66 @@
 """Provides `nTorque <http://ntorque.com>`_ task queue clients."""
 
 __all__ = [
+    'BackgroundDispatcher',
+    'BatchDispatcher',
+    'BatchReceiver',
     'DEFAULTS',
+    'DedupingClient',
     'HookDispatcher',
+    'InlineDispatcher',
+    'OutboxDispatcher',
     'WebTestDispatcher',
+    'Torque',
     'WorkEngineClient',
     'get_torque_api',
     'includeme',
+    'validate_inline_routes',
 ]
 
 import logging
 logger = logging.getLogger(__name__)
 
+import Queue
+import fnmatch
+import functools
 import json
 import os
+import requests
+import sys
 import threading
+import transaction
 import urlparse
+import weakref
 
 from collections import namedtuple
 from os.path import join as join_path
 
+from pyramid.decorator import reify
+from pyramid.exceptions import ConfigurationError
+from pyramid.request import Request
 from pyramid.settings import asbool
+from pyramid.settings import aslist
+from pyramid_weblayer import tx
 
 from ntorque import client
 from ntorque import model as ntorque_model
 from ntorque.model import constants as nc
 from ntorque.tests.ftests import test_client
 
+import pyramid_basemodel as bm
+
+from . import background
 from . import constants as c
+from . import hooks
+from . import orm
+from . import pool
 from . import render
 from . import util
 
+DEFAULT_BATCH_SIZE = 100
+LOCAL_HOSTS = ('localhost', '127.0.0.1')
+VALIDATE_ORDER = 10
+
 env = os.environ
 DEFAULTS = {
     'engine.api_key': util.get_var(env, c.ENGINE_API_KEY_NAMES),
@@ -50,6 +80,429 @@ def client_factory(client_cls, dispatcher, settings):
     torque_api_key = settings.get('torque.api_key')
     return client_cls(dispatcher, torque_url, torque_api_key)
 
+def batch_dispatcher_factory(settings, **kwargs):
+    """Instantiate a ``BatchDispatcher`` configured to post to the nTorque
+      batch endpoint, which defaults to ``batch`` under the ``torque.url``.
+    """
+
+    batch_url = settings.get('torque.batch_url', None)
+    if not batch_url:
+        batch_url = join_path(settings.get('torque.url'), 'batch')
+    batch_size = int(settings.get('torque.batch_size', DEFAULT_BATCH_SIZE))
+    api_key = settings.get('torque.api_key')
+    return BatchDispatcher(batch_url, batch_size=batch_size, api_key=api_key,
+            **kwargs)
+
+
+class BatchDispatcher(object):
+    """A dispatcher that buffers the dispatches made within a transaction and,
+      after it commits, posts them to an nTorque batch endpoint as one request
+      -- or as a few requests of up to ``batch_size`` tasks each.
+
+      The batch body is a JSON object with a list of ``tasks``, each of which
+      has the ``url``, ``data`` and ``headers`` the dispatch was called with.
+    """
+
+    def __init__(self, batch_url, **kwargs):
+        self.batch_url = batch_url
+        self.api_key = kwargs.get('api_key', None)
+        self.batch_size = kwargs.get('batch_size', DEFAULT_BATCH_SIZE)
+        self.post = kwargs.get('post', None) or pool.get_post()
+        self.after_commit = kwargs.get('after_commit', tx.call_in_background)
+        self.get_transaction = kwargs.get('get_transaction', transaction.get)
+        self.json_dumps = kwargs.get('json_dumps', json.dumps)
+        self.buffers = weakref.WeakKeyDictionary()
+
+    def __call__(self, url, post_data, headers):
+        """Add the dispatch to the current transaction's buffer -- which means
+          we can't wait for the response.
+        """
+
+        task = {
+            'data': post_data,
+            'headers': dict(headers),
+            'url': url,
+        }
+        self.get_buffer().append(task)
+        return client.SUCCESS, None, None
+
+    def get_buffer(self):
+        """Get the current transaction's buffer, creating it and hanging its
+          flush off a commit hook the first time. The buffer discards the
+          tasks added after a savepoint if it's rolled back.
+        """
+
+        current = self.get_transaction()
+        tasks = self.buffers.get(current, None)
+        if tasks is None or tasks.is_aborted:
+            tasks = self.buffers[current] = hooks.SavepointBuffer(current)
+            self.after_commit(self.flush, args=(tasks,))
+        return tasks
+
+    def flush(self, tasks):
+        """Post the ``tasks`` to the batch endpoint in chunks."""
+
+        # Unpack.
+        api_key = self.api_key
+        batch_size = self.batch_size
+
+        # Prepare the headers.
+        headers = {'Content-Type': 'application/json; utf-8'}
+        if api_key:
+            headers['TORQUE_API_KEY'] = api_key
+            headers['NTORQUE_API_KEY'] = api_key
+
+        # Post each chunk.
+        for i in xrange(0, len(tasks), batch_size):
+            chunk = tasks[i:i + batch_size]
+            data = self.json_dumps({'tasks': chunk})
+            r = self.post(self.batch_url, data=data, headers=headers)
+            if r.status_code > 399:
+                logger.warn(('torque.batch.failed', r.status_code, len(chunk)))
+
+class BatchReceiver(object):
+    """A local stand-in for the nTorque batch endpoint, which can be used as
+      the ``post`` function of a ``BatchDispatcher``. It unpacks each batch and
+      passes its tasks, in order, to a normal ``dispatcher``.
+    """
+
+    def __init__(self, dispatcher, **kwargs):
+        self.dispatcher = dispatcher
+        self.response_cls = kwargs.get('response_cls', requests.Response)
+        self.batches = []
+
+    def __call__(self, url, data=None, headers=None):
+        """Dispatch the tasks and respond with a list of their statuses."""
+
+        tasks = json.loads(data)['tasks']
+        self.batches.append(tasks)
+        statuses = []
+        for task in tasks:
+            status, _, _ = self.dispatcher(task['url'], task['data'],
+                    task['headers'])
+            statuses.append(status)
+        response = self.response_cls()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'application/json'
+        response._content = json.dumps({'statuses': statuses})
+        return response
+
+def is_local_url(url, hosts=LOCAL_HOSTS):
+    """Is the ``url`` a path or on a local host?"""
+
+    parts = urlparse.urlparse(url)
+    return not parts.netloc or parts.hostname in hosts
+
+class InlineDispatcher(object):
+    """Dispatch engine updates to this application's own ``/events`` and
+      ``/results`` views, using a subrequest made in the committing thread,
+      once the current transaction commits, rather than via a round trip
+      through nTorque.
+
+      Only the paths that match one of the ``patterns`` are meant to be
+      dispatched inline, so heavyweight operations can still be queued. If
+      the subrequest fails, the dispatch is handed to the ``fallback``
+      client within its own transaction, so it's queued -- e.g.: as a task
+      pushed after that transaction commits or as an outbox row -- rather
+      than lost.
+    """
+
+    def __init__(self, request, patterns=('*',), **kwargs):
+        self.request = request
+        self.patterns = patterns
+        self.fallback = kwargs.get('fallback', None)
+        self.after_commit = kwargs.get('after_commit', hooks.join_to_transaction)
+        self.fnmatch = kwargs.get('fnmatch', fnmatch.fnmatchcase)
+        self.header_prefix = kwargs.get('header_prefix', nc.PROXY_HEADER_PREFIX)
+        self.request_cls = kwargs.get('request_cls', Request)
+        self.transaction_manager = kwargs.get('transaction_manager',
+                transaction.manager)
+
+    def matches(self, path):
+        """Should the ``path`` be dispatched inline?"""
+
+        return any(self.fnmatch(path, pattern) for pattern in self.patterns)
+
+    def __call__(self, url, post_data, headers):
+        """Make the subrequest after commit -- which means we can't wait
+          for the response.
+        """
+
+        self.after_commit(self.invoke, url, post_data, dict(headers))
+        return client.SUCCESS, None, None
+
+    def invoke(self, url, post_data, headers):
+        """Make the subrequest to the path of the ``url``, falling back on
+          queueing the dispatch if it fails, and return the response.
+        """
+
+        # Unpack.
+        request = self.request
+        prefix = self.header_prefix.lower()
+
+        # Pass through the headers that nTorque would.
+        subrequest_headers = {}
+        for key, value in headers.items():
+            if key.lower().startswith(prefix):
+                key = key[len(prefix):]
+            subrequest_headers[key] = value
+
+        # Make the subrequest, in its own transaction, to the path of the
+        # url, so engines mounted under a path prefix are handled.
+        path = urlparse.urlparse(url).path or '/'
+        response = None
+        try:
+            subrequest = self.request_cls.blank(path, method='POST',
+                    headers=subrequest_headers, body=post_data or '')
+            subrequest.script_name = request.script_name
+            response = request.invoke_subrequest(subrequest, use_tweens=True)
+        except Exception:
+            logger.exception(('torque.engine.inline.error', path))
+
+        # If it failed, queue the dispatch instead, in a new transaction as
+        # the one that made it has already committed.
+        if response is None or response.status_int > 399:
+            status = response.status if response is not None else None
+            logger.warn(('torque.engine.inline.failed', path, status))
+            if self.fallback is not None:
+                with self.transaction_manager:
+                    self.fallback(url, data=post_data, headers=headers)
+        return response
+
+def validate_inline_routes(config, route_names=('events', 'results')):
+    """Make sure that, if the ``engine.inline`` setting is enabled, the
+      ``route_names`` are registered at the path of the ``engine.url``.
+    """
+
+    # Unpack.
+    settings = config.get_settings()
+    engine_url = settings.get('engine.url')
+    if not asbool(settings.get('engine.inline', False)):
+        return
+    if not is_local_url(engine_url):
+        return
+
+    # Check that the routes match the paths that inline dispatches use.
+    mapper = config.get_routes_mapper()
+    base = urlparse.urlparse(engine_url).path or '/'
+    for name in route_names:
+        route = mapper.get_route(name)
+        path = join_path(base, name, '')
+        if route is None or route.match(path) is None:
+            msg = (u'engine.inline requires the', name, u'route at', path)
+            raise ConfigurationError(msg)
+
+class BackgroundDispatcher(object):
+    """A dispatcher that, after the current transaction commits, hands the
+      dispatch to a bounded pool of background ``workers`` -- applying the
+      backpressure ``policy`` when their queue is full.
+    """
+
+    def __init__(self, workers, **kwargs):
+        self.workers = workers
+        self.post = kwargs.get('post', None) or pool.get_post()
+        self.policy = kwargs.get('policy', background.BLOCK)
+        self.block_timeout = kwargs.get('block_timeout', None)
+        self.after_commit = kwargs.get('after_commit', hooks.join_to_transaction)
+        self.get_bind = kwargs.get('get_bind', bm.Session.get_bind)
+        self.outbox_table = kwargs.get('outbox_table',
+                orm.OutboxDispatch.__table__)
+        if self.policy not in background.BACKPRESSURE_POLICIES:
+            raise ValueError(self.policy)
+
+    def __call__(self, url, post_data, headers):
+        """Enqueue the dispatch after commit -- which means we can't wait
+          for the response. With the ``error`` policy, raise ``Queue.Full``
+          now if there's no room, as after commit hooks can't raise.
+        """
+
+        if self.policy == background.ERROR and self.workers.is_full():
+            logger.warn(('torque.background.full', self.policy, url))
+            raise Queue.Full
+        self.after_commit(self.enqueue, url, post_data, dict(headers))
+        return client.SUCCESS, None, None
+
+    def enqueue(self, url, post_data, headers):
+        """Queue the request for the workers to make."""
+
+        task = functools.partial(self.post, url, data=post_data, headers=headers)
+        should_block = self.policy == background.BLOCK
+        try:
+            self.workers.put(task, block=should_block, timeout=self.block_timeout)
+        except Queue.Full:
+            if self.policy != background.OUTBOX:
+                logger.error(('torque.background.dropped', self.policy, url))
+                return
+            logger.warn(('torque.background.full', self.policy, url))
+            self.write_to_outbox(url, post_data, headers)
+
+    def write_to_outbox(self, url, post_data, headers):
+        """Write the dispatch to the outbox in its own transaction, as the
+          one that caused it has already committed.
+        """
+
+        connection = self.get_bind().connect()
+        try:
+            with connection.begin():
+                statement = self.outbox_table.insert()
+                connection.execute(statement, url=url, data=post_data,
+                        headers=headers)
+        finally:
+            connection.close()
+
+class OutboxDispatcher(object):
+    """A dispatcher that writes dispatches to the outbox table as part of
+      the current transaction. They're then sent by the ``relay`` -- so they
+      can't be lost between commit and post and don't block the request.
+    """
+
+    def __init__(self, **kwargs):
+        self.session = kwargs.get('session', bm.Session)
+        self.model_cls = kwargs.get('model_cls', orm.OutboxDispatch)
+
+    def __call__(self, url, post_data, headers):
+        """Add the dispatch to the session."""
+
+        instance = self.model_cls(url=url, data=post_data, headers=dict(headers))
+        self.session.add(instance)
+        return client.SUCCESS, None, None
+
+
+class DispatchKeys(hooks.SavepointBuffer):
+    """The keys of the dispatches made in a transaction, discarding those
+      added after a savepoint if it's rolled back.
+    """
+
+    dropped = 0
+
+    def __init__(self, txn, **kwargs):
+        super(DispatchKeys, self).__init__(txn, **kwargs)
+        self.index = set()
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def add(self, key):
+        self.append(key)
+        self.index.add(key)
+
+    def truncate(self, length):
+        super(DispatchKeys, self).truncate(length)
+        self.index = set(self)
+
+class DedupingClient(object):
+    """Wrap a torque ``client`` to drop dispatches that are identical to one
+      already made in the current transaction -- i.e.: that have the same
+      url, data, headers, method and timeout.
+
+      Keeps count of the dispatches ``dropped`` and logs how many were
+      dropped by each transaction that commits.
+    """
+
+    def __init__(self, client, **kwargs):
+        self.client = client
+        self.get_transaction = kwargs.get('get_transaction', transaction.get)
+        self.seen = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+    def __call__(self, url, data=None, headers=None, method=None, timeout=None):
+        """Dispatch, unless an identical dispatch has already been made."""
+
+        # Unpack.
+        if headers is None:
+            headers = {}
+
+        # Drop the dispatch if we've seen it already.
+        keys = self.get_seen()
+        key = (url, data, frozenset(headers.items()), method, timeout)
+        if key in keys:
+            keys.dropped += 1
+            with self.lock:
+                self.dropped += 1
+            return client.SUCCESS, None, None
+        keys.add(key)
+
+        # Otherwise dispatch it.
+        return self.client(url, data=data, headers=headers, method=method,
+                timeout=timeout)
+
+    def get_seen(self):
+        """Get the keys of the current transaction's dispatches."""
+
+        current = self.get_transaction()
+        keys = self.seen.get(current, None)
+        if keys is None or keys.is_aborted:
+            keys = self.seen[current] = DispatchKeys(current)
+            current.addAfterCommitHook(self.report, args=(keys,))
+        return keys
+
+    def report(self, succeeded, keys):
+        """Log how many dispatches were dropped."""
+
+        if succeeded and keys.dropped:
+            logger.info(('torque.dedupe.dropped', keys.dropped, len(keys)))
+
+class WebTestWorkers(object):
+    """Long lived worker threads that call functions in order, each in a
+      thread with its own transaction and db session, which is removed after
+      each call. A call made from within a worker -- e.g.: a request made
+      whilst handling another -- is passed to the next worker down, so nested
+      calls stay isolated from the calls that made them.
+    """
+
+    def __init__(self, **kwargs):
+        self.session = kwargs.get('session', bm.Session)
+        self.thread_cls = kwargs.get('thread_cls', threading.Thread)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.queues = []
+
+    def __call__(self, func, *args, **kwargs):
+        """Call ``func`` in a worker and return the result, re-raising any
+          error in the calling thread.
+        """
+
+        depth = getattr(self.local, 'depth', -1) + 1
+        result = Queue.Queue(1)
+        self.get_queue(depth).put((func, args, kwargs, result))
+        succeeded, value = result.get()
+        if not succeeded:
+            raise value[0], value[1], value[2]
+        return value
+
+    def get_queue(self, depth):
+        """Get the queue of the worker for the ``depth``, starting workers as
+          necessary.
+        """
+
+        with self.lock:
+            while len(self.queues) <= depth:
+                queue = Queue.Queue()
+                name = 'webtest-dispatch-{0}'.format(len(self.queues))
+                thread = self.thread_cls(target=self.work, name=name,
+                        args=(queue, len(self.queues)))
+                thread.daemon = True
+                thread.start()
+                self.queues.append(queue)
+            return self.queues[depth]
+
+    def work(self, queue, depth):
+        """Make the calls queued for this worker."""
+
+        self.local.depth = depth
+        while True:
+            func, args, kwargs, result = queue.get()
+            try:
+                value = (True, func(*args, **kwargs))
+            except Exception:
+                value = (False, sys.exc_info())
+            try:
+                self.session.remove()
+            finally:
+                result.put(value)
+
+webtest_workers = WebTestWorkers()
 
 class WebTestDispatcher(client.DirectDispatcher):
     """A dispatcher that skips nTorque and just makes the request directly
@@ -58,6 +511,7 @@ class WebTestDispatcher(client.DirectDispatcher):
 
     def __init__(self, webtest_poster, **kwargs):
         self.webtest_poster = webtest_poster
+        self.workers = kwargs.get('workers', webtest_workers)
         self.parse_qsl = kwargs.get('parse_qsl', urlparse.parse_qsl)
         self.header_prefix = kwargs.get('header_prefix', nc.PROXY_HEADER_PREFIX)
         self.default_method = kwargs.get('default_method', nc.DEFAULT_METHOD)
@@ -79,23 +533,14 @@ class WebTestDispatcher(client.DirectDispatcher):
                 k = key[len(self.header_prefix):]
                 headers[k] = value
 
-        # Make and handle the response.
         # Make and handle the response.
         r = self.make_request(url, post_data, headers, method=method)
         return self.handle(r)
 
-
     def make_request(self, *args, **kwargs):
-        mapping = {}
-        patched_args = (mapping,) + args
-        t = threading.Thread(target=self._make_request, args=patched_args,
-                kwargs=kwargs)
-        t.start()
-        t.join()
-        return mapping['r']
+        """Make the request in a worker thread, isolated from this one."""
 
-    def _make_request(self, mapping, *args, **kwargs):
-        mapping['r'] = self.webtest_poster(*args, **kwargs)
+        return self.workers(self.webtest_poster, *args, **kwargs)
 
 
 class HookDispatcher(object):
@@ -109,10 +554,16 @@ class HookDispatcher(object):
         # Compose.
         self.request = request
         self.join_path = kwargs.get('join_path', join_path)
-        client_cls = kwargs.get('client_cls', client.HybridTorqueClient)
-        dispatcher = kwargs.get('dispatcher', client.AfterCommitDispatcher())
-        settings = request.registry.settings
-        self.client = client_factory(client_cls, dispatcher, settings)
+        self.client = kwargs.get('client', None)
+        if self.client is None:
+            client_cls = kwargs.get('client_cls', client.HybridTorqueClient)
+            settings = request.registry.settings
+            dispatcher = kwargs.get('dispatcher', None)
+            if dispatcher is None:
+                post = pool.get_post(settings)
+                dispatcher = client.AfterCommitDispatcher(post=post,
+                        after_commit=hooks.call_in_background)
+            self.client = client_factory(client_cls, dispatcher, settings)
 
     def __call__(self, path, data=None, headers=None, timeout=None):
         """Use the request to instantiate a client and dispatch a request."""
@@ -135,7 +586,7 @@ class HookDispatcher(object):
         if not headers.has_key('Content-Type'):
             headers['Content-Type'] = 'application/json; utf-8'
             if data is not None and not isinstance(data, basestring):
-                data = render.json_dumps(request, data)
+                data = render.json_dumps_compact(request, data)
 
         # Dispatch.
         url = self.join_path(webhooks_url, path)
@@ -165,10 +616,17 @@ class WorkEngineClient(object):
         self.request = request
         self.join_path = kwargs.get('join_path', join_path)
         self.unpack = kwargs.get('unpack', util.get_unpacked_object_id)
-        client_cls = kwargs.get('client_cls', client.HybridTorqueClient)
-        dispatcher = kwargs.get('dispatcher', client.AfterCommitDispatcher())
-        settings = request.registry.settings
-        self.client = client_factory(client_cls, dispatcher, settings)
+        self.inline = kwargs.get('inline', None)
+        self.client = kwargs.get('client', None)
+        if self.client is None:
+            client_cls = kwargs.get('client_cls', client.HybridTorqueClient)
+            settings = request.registry.settings
+            dispatcher = kwargs.get('dispatcher', None)
+            if dispatcher is None:
+                post = pool.get_post(settings)
+                dispatcher = client.AfterCommitDispatcher(post=post,
+                        after_commit=hooks.call_in_background)
+            self.client = client_factory(client_cls, dispatcher, settings)
 
     def _get_traversal_path(self, route, context):
         """Get the traversal path to context, prefixed with the route.
@@ -212,12 +670,17 @@ class WorkEngineClient(object):
         if not headers.has_key('Content-Type'):
             headers['Content-Type'] = 'application/json; utf-8'
             if data is not None and not isinstance(data, basestring):
-                data = render.json_dumps(request, data)
+                data = render.json_dumps_compact(request, data)
 
-        # Dispatch.
+        # Dispatch, either inline or via nTorque.
         url = self.join_path(engine_url, path)
-        status, response_data, response_headers = self.client(url, data=data,
-                headers=headers, timeout=timeout)
+        inline = self.inline
+        if inline is not None and inline.matches(path):
+            result = inline(url, data, headers)
+        else:
+            result = self.client(url, data=data, headers=headers,
+                    timeout=timeout)
+        status, response_data, response_headers = result
 
         # Return.
         headers_dict = dict(response_headers.items()) if response_headers else {}
@@ -278,6 +741,75 @@ class WorkEngineClient(object):
         # Dispatch to the engine.
         return self.dispatch(path, data=data)
 
+    def changed_and_happened(self, context, action, state_event, event=None,
+            state=None, **kwargs):
+        """Tell the work engine that an ``action`` happened to a ``context``
+          and changed its state, in a single dispatch.
+        """
+
+        # Get the path to the context on the events route.
+        path = self._get_traversal_path('events', context)
+
+        # Either use the state passed in or look it up on the context.
+        if state is None:
+            state = context.work_status.value
+
+        # Build the post data.
+        data = {
+            'action': action,
+            'state': state,
+        }
+        if event:
+            data['event_id'] = event.id
+        if state_event:
+            data['state_event_id'] = state_event.id
+
+        logger.info((
+            'torque.engine.changed_and_happened',
+            'context: ', context.class_slug, context.id,
+            'new state: ', state,
+            'action: ', action,
+        ))
+
+        # Dispatch to the engine.
+        return self.dispatch(path, data=data)
+
+    def happened_many(self, items):
+        """Tell the work engine that actions happened to many contexts, in a
+          single dispatch to the batch events route. The ``items`` are
+          ``(context, action, event, state_event, state)`` tuples, where the
+          ``state_event`` and ``state`` are ``None`` unless the action
+          changed the context's state.
+        """
+
+        # Get the path to the batch events route.
+        path = self.join_path('events', 'batch')
+
+        # Build the post data.
+        data = []
+        for context, action, event, state_event, state in items:
+            tablename, id_ = self.unpack(context)
+            item = {
+                'tablename': tablename,
+                'id': id_,
+                'action': action,
+            }
+            if event:
+                item['event_id'] = event.id
+            if state:
+                item['state'] = state
+            if state_event:
+                item['state_event_id'] = state_event.id
+            data.append(item)
+
+        logger.info((
+            'torque.engine.happened_many',
+            'contexts: ', len(data),
+        ))
+
+        # Dispatch to the engine.
+        return self.dispatch(path, data={'items': data})
+
     def result(self, context, operation, result, event=None, event_id=None, **kwargs):
         """Tell the work engine that an ``operation`` had the specified ``result``."""
 
@@ -306,42 +838,155 @@ class WorkEngineClient(object):
         # Dispatch to the engine.
         return self.dispatch(path, data=data)
 
-def get_torque_api(request):
-    """Provide a ``request.torque`` api, where the dispatchers used depend
-      on whether we're ftesting or not.
+    def results(self, contexts, operation, result, event=None, event_id=None,
+            **kwargs):
+        """Tell the work engine that an ``operation`` had the specified
+          ``result`` for each of the ``contexts``, in a single dispatch.
+        """
+
+        # Get the path to the batch results route.
+        path = self.join_path('results', 'batch')
+
+        # Build the post data.
+        if event:
+            event_id = event.id
+        elif not event_id:
+            raise Exception('You either need an event or an event_id.')
+        items = []
+        for context in contexts:
+            tablename, id_ = self.unpack(context)
+            items.append({
+                'tablename': tablename,
+                'id': id_,
+                'operation': operation,
+                'result': result,
+                'event_id': event_id,
+            })
+
+        logger.info((
+            'torque.engine.results',
+            'contexts: ', len(items),
+            'operation: ', operation,
+            'result', result,
+        ))
+
+        # Dispatch to the engine.
+        return self.dispatch(path, data={'items': items})
+
+TorqueClients = namedtuple('TorqueClients', ['default', 'immediate'])
+
+def make_clients(settings, is_testing=False):
+    """Instantiate the ``default`` and ``immediate`` torque clients, where the
+      dispatchers used depend on the settings and whether we're ftesting.
     """
 
+    # Unpack.
+    should_batch = asbool(settings.get('torque.batch_dispatch', False))
+    should_use_outbox = asbool(settings.get('torque.outbox', False))
+    should_use_background = asbool(settings.get('torque.background_dispatch',
+            False))
+
     # Are we ftesting and do we explicitly want to enable dispatch anyway?
-    is_testing = request.environ.get('paste.testing', False)
     if is_testing:
-        settings = request.registry.settings
         key = 'torque.enable_ftesting_dispatch'
         should_enable = asbool(settings.get(key, False))
         if should_enable:
             poster = test_client.WebTestPoster(settings['webtest_app'])
             default = WebTestDispatcher(poster)
             immediate = WebTestDispatcher(poster)
+            if should_batch:
+                receiver = BatchReceiver(default)
+                default = batch_dispatcher_factory(settings, post=receiver)
         else:
             default = client.NoopDispatcher()
             immediate = client.NoopDispatcher()
 
         client_cls=client.HTTPTorqueClient
     else:
-        default = client.AfterCommitDispatcher()
-        immediate = client.DirectDispatcher()
+        post = pool.get_post(settings)
+        if should_use_outbox:
+            default = OutboxDispatcher()
+        elif should_use_background:
+            workers = background.get_workers(settings)
+            policy = settings.get('torque.backpressure', background.BLOCK)
+            default = BackgroundDispatcher(workers, post=post, policy=policy)
+        elif should_batch:
+            default = batch_dispatcher_factory(settings, post=post)
+        else:
+            default = client.AfterCommitDispatcher(post=post,
+                    after_commit=hooks.call_in_background)
+        immediate = client.DirectDispatcher(post=post)
         client_cls=client.HybridTorqueClient
 
-    # Provide the api.
-    api = {
-        'dispatch': HookDispatcher(request, dispatcher=default,
-                client_cls=client_cls),
-        'dispatch_now': HookDispatcher(request, dispatcher=immediate,
-                client_cls=client_cls),
-        'engine': WorkEngineClient(request, dispatcher=default,
-                client_cls=client_cls),
-    }
-    keys, values = zip(*api.items())
-    return namedtuple('Torque', keys)(*values)
+    # Drop identical dispatches within a transaction, iff configured.
+    default_client = client_factory(client_cls, default, settings)
+    if asbool(settings.get('torque.dedupe_dispatches', False)):
+        default_client = DedupingClient(default_client)
+
+    return TorqueClients(
+        default_client,
+        client_factory(client_cls, immediate, settings),
+    )
+
+def get_clients(request):
+    """Get the torque clients shared by all the requests to the registry,
+      instantiating them the first time they're needed.
+    """
+
+    # Unpack.
+    registry = request.registry
+    is_testing = bool(request.environ.get('paste.testing', False))
+
+    # Use the registry's cache, if there is one.
+    cache = getattr(registry, 'torque_clients', None)
+    if cache is None:
+        return make_clients(registry.settings, is_testing)
+    clients = cache.get(is_testing, None)
+    if clients is None:
+        clients = cache[is_testing] = make_clients(registry.settings, is_testing)
+    return clients
+
+class Torque(object):
+    """The ``request.torque`` api, whose dispatchers are instantiated on first
+      access, so requests that don't dispatch anything don't pay for them.
+    """
+
+    def __init__(self, request):
+        self.request = request
+
+    @reify
+    def clients(self):
+        return get_clients(self.request)
+
+    @reify
+    def dispatch(self):
+        return HookDispatcher(self.request, client=self.clients.default)
+
+    @reify
+    def dispatch_now(self):
+        return HookDispatcher(self.request, client=self.clients.immediate)
+
+    @reify
+    def engine(self):
+        # Unpack.
+        request = self.request
+        settings = request.registry.settings
+
+        # Dispatch engine updates inline, iff configured and the engine is local.
+        inline = None
+        if asbool(settings.get('engine.inline', False)):
+            if is_local_url(settings.get('engine.url')):
+                patterns = aslist(settings.get('engine.inline_paths', '*'))
+                inline = InlineDispatcher(request, patterns=patterns,
+                        fallback=self.clients.default)
+
+        return WorkEngineClient(request, client=self.clients.default,
+                inline=inline)
+
+def get_torque_api(request):
+    """Provide a lazy ``request.torque`` api."""
+
+    return Torque(request)
 
 def includeme(config, **kwargs):
     """Apply default settings and register the torque application id."""
@@ -354,6 +999,7 @@ def includeme(config, **kwargs):
     for key, value in DEFAULTS.items():
         settings.setdefault(key, value)
     config.add_request_method(get_torque_api, 'torque', reify=True)
+    config.registry.torque_clients = {}
 
     # Register the api authenticated torque `application.id`.
     api_key = settings.get(c.TORQUE_API_KEY, None)
@@ -361,3 +1007,8 @@ def includeme(config, **kwargs):
         app = lookup(api_key)
         if app:
             settings.setdefault('torque.api_authenticated_app_id', app.id)
+
+    # Make sure inline dispatches have views to go to, once the routes
+    # have been registered.
+    config.action(None, validate_inline_routes, args=(config,),
+            order=VALIDATE_ORDER)
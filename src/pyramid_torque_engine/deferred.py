@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+"""Provides a deferred flush unit of work mode, in which the activity events
+  and work statuses created by state changes aren't flushed one at a time.
+  Instead, their ids are prefetched in blocks from their PostgreSQL sequences
+  and the rows are written in one batched flush before commit.
+
+  Use it explicitly as a context manager:
+
+      with DeferredFlush():
+          state_changer.perform(context, action, event)
+
+  Or enable it for every request using the ``engine.deferred_flush`` setting.
+
+  The unit keeps track of the pending work statuses, so that reading a
+  context's ``work_status`` within the unit of work returns the pending
+  status without autoflushing. Other queries still autoflush.
+"""
+
+__all__ = [
+    'DeferredFlush',
+    'flush',
+    'get_deferred_flush',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+from collections import defaultdict
+from collections import deque
+
+from pyramid import events
+from pyramid.settings import asbool
+from sqlalchemy import orm
+from sqlalchemy import schema
+from sqlalchemy import sql
+
+import pyramid_basemodel as bm
+
+DEFAULT_BLOCK_SIZE = 32
+SESSION_KEY = 'engine.deferred_flush'
+
+def get_deferred_flush(session=None):
+    """Return the ``DeferredFlush`` active for the ``session``, if any."""
+
+    if session is None:
+        session = bm.Session
+    return session().info.get(SESSION_KEY, None)
+
+def flush(session, *instances):
+    """Flush the ``session``, unless a deferred flush is active, in which case
+      just make sure the ``instances`` have ids.
+    """
+
+    unit = get_deferred_flush(session)
+    if unit is None or not unit.allocate_ids(instances):
+        session.flush()
+
+class DeferredFlush(object):
+    """Context manager that defers flushing and prefetches ids."""
+
+    def __init__(self, session=None, **kwargs):
+        self.session = bm.Session if session is None else session
+        self.block_size = kwargs.get('block_size', DEFAULT_BLOCK_SIZE)
+        self.object_mapper = kwargs.get('object_mapper', orm.object_mapper)
+        self.ids = defaultdict(deque)
+        self.sequences = {}
+        self.statuses = defaultdict(list)
+        self.previous = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.session.flush()
+        finally:
+            self.stop()
+
+    def start(self):
+        """Activate for the current session, remembering any outer unit."""
+
+        info = self.session().info
+        self.previous = info.get(SESSION_KEY, None)
+        info[SESSION_KEY] = self
+
+    def stop(self):
+        """Deactivate, restoring any outer unit."""
+
+        self.statuses.clear()
+        info = self.session().info
+        if self.previous is None:
+            info.pop(SESSION_KEY, None)
+        else:
+            info[SESSION_KEY] = self.previous
+
+    def allocate_ids(self, instances):
+        """Give each of the ``instances`` that doesn't have one an id from
+          its table's sequence. Returns ``False`` if the session isn't bound
+          to PostgreSQL, as ids can only be prefetched from sequences.
+        """
+
+        bind = self.session.get_bind()
+        if bind.dialect.name != 'postgresql':
+            return False
+        for instance in instances:
+            if instance.id is None:
+                table = self.object_mapper(instance).local_table
+                instance.id = self.next_id(table)
+        return True
+
+    def add_status(self, parent, status):
+        """Keep track of a pending work ``status`` set on the ``parent``."""
+
+        self.statuses[parent].append(status)
+
+    def pending_status(self, parent, value=None):
+        """Return the most recent pending work status set on the ``parent``
+          within the unit, optionally filtered by ``value``, or ``None``.
+        """
+
+        for status in reversed(self.statuses.get(parent, ())):
+            if value is None or status.value == value:
+                return status
+        return None
+
+    def sequence_name(self, table):
+        """Return the name of the sequence that the ``table``'s ids come from,
+          either as declared or as looked up from the column's serial default.
+        """
+
+        name = self.sequences.get(table.fullname, None)
+        if name is None:
+            default = table.c.id.default
+            if isinstance(default, schema.Sequence):
+                name = default.name
+                if default.schema:
+                    name = '{0}.{1}'.format(default.schema, name)
+            else:
+                query = sql.text("SELECT pg_get_serial_sequence(:table, 'id')")
+                params = {'table': table.fullname}
+                name = self.session.execute(query, params).scalar()
+            self.sequences[table.fullname] = name
+        return name
+
+    def next_id(self, table):
+        """Return the next prefetched id for the ``table``, fetching another
+          block of ids from its sequence when needed.
+        """
+
+        ids = self.ids[table.name]
+        if not ids:
+            query = sql.text(
+                'SELECT nextval(:sequence) FROM generate_series(1, :size)'
+            )
+            params = {
+                'sequence': self.sequence_name(table),
+                'size': self.block_size,
+            }
+            rows = self.session.execute(query, params)
+            ids.extend(row[0] for row in rows)
+        return ids.popleft()
+
+def start_for_request(event):
+    """``NewRequest`` subscriber that defers flushing until the end of the
+      request, if enabled by the ``engine.deferred_flush`` setting.
+    """
+
+    request = event.request
+    settings = request.registry.settings
+    if not asbool(settings.get('engine.deferred_flush', False)):
+        return
+    unit = DeferredFlush()
+    unit.start()
+    request.add_finished_callback(lambda request: unit.stop())
+
+def includeme(config):
+    """Enable deferred flushing per request, iff configured."""
+
+    config.add_subscriber(start_for_request, events.NewRequest)
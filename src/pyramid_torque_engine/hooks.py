@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""Provides savepoint aware buffers and after commit hooks, so that the
+  dispatches made after a transaction savepoint are discarded if it's rolled
+  back -- e.g.: by a failed item in a ``/events/batch`` request -- rather than
+  being made after commit regardless.
+
+  Use ``join_to_transaction`` and ``call_in_background`` as drop in
+  replacements for the ``pyramid_weblayer.tx`` functions:
+
+      join_to_transaction(dispatch, url, data, headers)
+
+  Or buffer things per transaction using a ``SavepointBuffer``.
+"""
+
+__all__ = [
+    'AfterCommitHooks',
+    'SavepointBuffer',
+    'call_in_background',
+    'get_hooks',
+    'join_to_transaction',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import threading
+import transaction
+import weakref
+
+from pyramid_weblayer import tx
+
+class BufferSavepoint(object):
+    """Roll a ``SavepointBuffer`` back to its ``length`` at the savepoint."""
+
+    def __init__(self, buffer, length):
+        self.buffer = buffer
+        self.length = length
+
+    def rollback(self):
+        self.buffer.truncate(self.length)
+
+class SavepointBuffer(list):
+    """A list that's joined to a ``transaction`` as a data manager, so that
+      the items appended after a savepoint are discarded when it's rolled
+      back. Once aborted, ``is_aborted`` is set and the buffer should be
+      replaced, as it's no longer joined to the transaction.
+
+      Once the transaction has voted to commit, the buffer is kept as is,
+      unless the commit is then rolled back, so that after commit hooks --
+      including ones that read it in a background thread -- see the items.
+    """
+
+    def __init__(self, txn, **kwargs):
+        super(SavepointBuffer, self).__init__()
+        self.transaction_manager = kwargs.get('transaction_manager',
+                transaction.manager)
+        self.is_aborted = False
+        self.is_voted = False
+        txn.join(self)
+
+    def truncate(self, length):
+        """Discard the items after ``length``."""
+
+        del self[length:]
+
+    def savepoint(self):
+        return BufferSavepoint(self, len(self))
+
+    def abort(self, txn):
+        if self.is_voted:
+            return
+        self.rollback()
+
+    def rollback(self):
+        """Discard all the items."""
+
+        self.truncate(0)
+        self.is_aborted = True
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        self.is_voted = True
+
+    def tpc_finish(self, txn):
+        pass
+
+    def tpc_abort(self, txn):
+        self.rollback()
+
+    def sortKey(self):
+        return 'pyramid_torque_engine.hooks:{0}'.format(id(self))
+
+    # Compare by identity, so that buffers can be used as data managers.
+    __eq__ = object.__eq__
+    __ne__ = object.__ne__
+    __hash__ = object.__hash__
+
+class AfterCommitHooks(SavepointBuffer):
+    """Savepoint aware ``(callable_, args, kwargs)`` hooks that are called in
+      order iff the transaction commits.
+    """
+
+    def __init__(self, txn, **kwargs):
+        super(AfterCommitHooks, self).__init__(txn, **kwargs)
+        txn.addAfterCommitHook(self)
+
+    def __call__(self, succeeded):
+        """Call the hooks, logging rather than raising any errors."""
+
+        if not succeeded:
+            return
+        for callable_, args, kwargs in list(self):
+            try:
+                callable_(*args, **kwargs)
+            except Exception:
+                logger.exception(('torque.hooks.failed', callable_))
+
+_lock = threading.Lock()
+_hooks = weakref.WeakKeyDictionary()
+
+def get_hooks(get_transaction=None):
+    """Get the current transaction's ``AfterCommitHooks``, creating them
+      the first time or if they've been aborted.
+    """
+
+    if get_transaction is None:
+        get_transaction = transaction.get
+    current = get_transaction()
+    with _lock:
+        hooks = _hooks.get(current, None)
+        if hooks is None or hooks.is_aborted:
+            hooks = _hooks[current] = AfterCommitHooks(current)
+    return hooks
+
+def join_to_transaction(callable_, *args, **kwargs):
+    """Call ``callable_(*args, **kwargs)`` after the current transaction
+      commits, unless a savepoint taken before it was added is rolled back.
+    """
+
+    get_hooks().append((callable_, args, kwargs))
+
+def call_in_background(target, args=None, kwargs=None, **kw):
+    """Like ``tx.call_in_background`` but joined using the savepoint aware
+      ``join_to_transaction``.
+    """
+
+    kw.setdefault('join', join_to_transaction)
+    return tx.call_in_background(target, args=args, kwargs=kwargs, **kw)
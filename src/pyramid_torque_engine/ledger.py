@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""Provides an optional ledger of the event deliveries that have been
+  handled, keyed by ``(event_id, route, context)``, so that when nTorque
+  retries or replays a delivery, the ``/events`` and ``/results`` views
+  short circuit with the cached response instead of re-running the
+  subscribers and transitions.
+
+  Enable it using the ``engine.event_ledger`` setting. Entries expire after
+  ``engine.event_ledger_ttl`` seconds and can be pruned using, e.g.:
+
+      engine_prune_ledger
+      engine_prune_ledger --ttl 86400
+"""
+
+__all__ = [
+    'EventLedger',
+    'LedgerView',
+    'run',
+    'wrap_view',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import argparse
+import json
+import os
+import transaction
+
+from datetime import datetime
+from datetime import timedelta
+
+from pyramid.settings import asbool
+from sqlalchemy import create_engine
+
+import pyramid_basemodel as bm
+
+from . import orm
+from . import render
+from . import util
+
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+# The payload params that distinguish deliveries about the same event.
+KEY_PARAMS = ('state', 'action', 'operation', 'result')
+
+class EventLedger(object):
+    """Record, lookup and prune processed event deliveries."""
+
+    def __init__(self, **kwargs):
+        self.session = kwargs.get('session', bm.Session)
+        self.model_cls = kwargs.get('model_cls', orm.ProcessedEvent)
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
+        self.ttl = kwargs.get('ttl', DEFAULT_TTL)
+
+    def expiry(self):
+        """Entries created before this have expired."""
+
+        return self.utcnow() - timedelta(seconds=self.ttl)
+
+    def lookup(self, event_id, route, context):
+        """Return the unexpired entry for the delivery, or ``None``."""
+
+        instance = self.session.query(self.model_cls).get(
+                (event_id, route, context))
+        if instance is None or instance.created < self.expiry():
+            return None
+        return instance
+
+    def record(self, event_id, route, context, response):
+        """Record the delivery with its JSON encoded ``response``, replacing
+          any expired entry.
+        """
+
+        instance = self.model_cls(event_id=event_id, route=route,
+                context=context, response=response, created=self.utcnow())
+        return self.session.merge(instance)
+
+    def prune(self):
+        """Delete the expired entries, returning the number deleted."""
+
+        model_cls = self.model_cls
+        query = self.session.query(model_cls)
+        query = query.filter(model_cls.created < self.expiry())
+        return query.delete(synchronize_session=False)
+
+class LedgerView(object):
+    """Wrap a view so that replayed deliveries return the cached response."""
+
+    def __init__(self, view, **kwargs):
+        self.view = view
+        self.ledger = kwargs.get('ledger', EventLedger())
+        self.get_object_id = kwargs.get('get_object_id', util.get_object_id)
+        self.json_dumps = kwargs.get('json_dumps', render.json_dumps_compact)
+        self.json_loads = kwargs.get('json_loads', json.loads)
+
+    def __call__(self, request):
+        """Return the cached response or call the view and record its
+          response in the same transaction.
+        """
+
+        key = self.key(request)
+        if key is None:
+            return self.view(request)
+
+        # Short circuit replays.
+        entry = self.ledger.lookup(*key)
+        if entry is not None:
+            logger.info(('torque.ledger.replayed', key))
+            return self.json_loads(entry.response)
+
+        # Otherwise call the view, recording the data it returns to render.
+        response = self.view(request)
+        if isinstance(response, dict):
+            data = self.json_dumps(request, response)
+            self.ledger.record(*key, response=data)
+        return response
+
+    def key(self, request):
+        """Return the ``(event_id, route, context)`` the request delivers,
+          or ``None`` if it can't be identified.
+        """
+
+        # Unpack.
+        context = request.context
+        route = request.matched_route
+        try:
+            data = request.json
+        except ValueError:
+            return None
+        if not (hasattr(data, 'get') and route and context):
+            return None
+        if getattr(context, 'id', None) is None:
+            return None
+
+        # Identify the event.
+        try:
+            event_id = int(data.get('event_id', None))
+        except (TypeError, ValueError):
+            return None
+
+        # Distinguish the deliveries about the same event by route and params.
+        parts = [route.name]
+        parts.extend(data[k] for k in KEY_PARAMS if data.get(k))
+        return event_id, u' '.join(parts), self.get_object_id(context)
+
+def wrap_view(view, settings):
+    """Wrap the ``view`` with a ``LedgerView``, iff enabled by the
+      ``engine.event_ledger`` setting.
+    """
+
+    if settings is None:
+        settings = {}
+    if not asbool(settings.get('engine.event_ledger', False)):
+        return view
+    ttl = int(settings.get('engine.event_ledger_ttl', DEFAULT_TTL))
+    return LedgerView(view, ledger=EventLedger(ttl=ttl))
+
+def run():
+    # Parse the options.
+    parser = argparse.ArgumentParser(description='Prune expired ledger entries.')
+    parser.add_argument('--ttl', type=int, default=DEFAULT_TTL)
+    args = parser.parse_args()
+
+    # Bind to the database.
+    engine = create_engine(os.environ['DATABASE_URL'])
+    bm.bind_engine(engine, should_create=False)
+
+    # Prune.
+    ledger = EventLedger(ttl=args.ttl)
+    with transaction.manager:
+        count = ledger.prune()
+    print '{0} ledger entries pruned'.format(count)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""Provides a migration helper that creates any of the indexes declared on
+  the engine's tables that don't exist yet, without locking the tables
+  against writes, e.g.:
+
+      engine_create_indexes
+      engine_create_indexes work_statuses activity_events
+
+  Note that ``CREATE INDEX CONCURRENTLY`` can't run inside a transaction, so
+  the indexes are created using a dedicated autocommit connection.
+"""
+
+__all__ = [
+    'ENGINE_TABLES',
+    'create_indexes_concurrently',
+    'run',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import argparse
+import os
+
+from sqlalchemy import create_engine
+from sqlalchemy import sql
+from sqlalchemy.schema import CreateIndex
+
+import pyramid_basemodel as bm
+
+from . import orm
+
+ENGINE_TABLES = (
+    orm.ActivityEvent.__tablename__,
+    orm.WorkStatus.__tablename__,
+    orm.Notification.__tablename__,
+    orm.NotificationDispatch.__tablename__,
+    orm.NotificationPreference.__tablename__,
+    orm.OutboxDispatch.__tablename__,
+    orm.ProcessedEvent.__tablename__,
+)
+
+def create_indexes_concurrently(engine, tablenames=ENGINE_TABLES, metadata=None):
+    """Create the missing indexes declared on the ``tablenames``' tables,
+      returning a list of the names of the indexes created.
+    """
+
+    # Compose.
+    if metadata is None:
+        metadata = bm.Base.metadata
+
+    # Unpack.
+    dialect = engine.dialect
+
+    # Connect outside of a transaction.
+    connection = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        query = sql.text('SELECT indexname FROM pg_indexes')
+        existing = set(row[0] for row in connection.execute(query))
+        created = []
+        for tablename in tablenames:
+            table = metadata.tables[tablename]
+            for index in sorted(table.indexes, key=lambda item: item.name):
+                if index.name in existing:
+                    continue
+                options = index.dialect_options['postgresql']
+                options['concurrently'] = True
+                try:
+                    statement = CreateIndex(index).compile(dialect=dialect)
+                finally:
+                    options['concurrently'] = False
+                logger.info(('creating index', index.name))
+                connection.execute(str(statement))
+                created.append(index.name)
+    finally:
+        connection.close()
+    return created
+
+def run():
+    # Parse the names of the tables to index.
+    parser = argparse.ArgumentParser(description='Create missing indexes.')
+    parser.add_argument('tablenames', nargs='*', metavar='tablename',
+            default=ENGINE_TABLES)
+    args = parser.parse_args()
+
+    # Create the indexes.
+    engine = create_engine(os.environ['DATABASE_URL'])
+    for name in create_indexes_concurrently(engine, tablenames=args.tablenames):
+        print 'created {0}'.format(name)
+
+
+if __name__ == '__main__':
+    run()
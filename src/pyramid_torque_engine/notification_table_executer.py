@@ -6,12 +6,12 @@ from pyramid_torque_engine import repo
 from sqlalchemy import create_engine
 from pyramid_basemodel import bind_engine, save, Session
 from . import constants as c
+from . import pool
 from . import util
 
 import os
 import datetime
 import json
-import requests
 import transaction
 
 AVAILABLE_CHANNELS = ['sms', 'email']
@@ -28,7 +28,8 @@ def post_notification_dispatch(dispatch):
         key = '{0}'.format(item)
         headers[key] = ENGINE_API_KEY
 
-    _ = requests.post(
+    post = pool.get_post()
+    _ = post(
                     SINGLE_EMAIL_ENDPOINT,
                     headers=headers,
                     data=json.dumps(
@@ -12,7 +12,6 @@ __all__ = [
 import logging
 logger = logging.getLogger(__name__)
 
-import fysom
 import pyramid_basemodel as bm
 
 from . import repo
@@ -107,15 +106,12 @@ class Perform(object):
         state_changer = request.state_changer
         event_factory = repo.ActivityEventFactory(request)
         for target in targets:
-            if state_changer.can_perform(target, action):
-                action_event = event_factory(target, user, action=action)
-                try:
-                    _, _, dispatched = state_changer.perform(target, action,
-                            action_event)
-                except fysom.FysomError as err:
-                    logger.warn(err)
-                else:
-                    all_dispatched.extend(dispatched)
+            get_event = lambda: event_factory(target, user, action=action)
+            performed = state_changer.try_perform(target, action,
+                    get_event=get_event)
+            if performed is not None:
+                _, _, dispatched = performed
+                all_dispatched.extend(dispatched)
         return {op: all_dispatched}
 
 class Result(object):
@@ -138,10 +134,18 @@ class Result(object):
         # Get the targets.
         targets = get_targets(context, self.attr)
 
-        # Tell them about the result of the operation.
+        # Tell them about the result of the operation, in one batch if
+        # there's more than one of them.
         dispatched = []
         engine = request.torque.engine
-        for target in targets:
-            dispatch = engine.result(target, op, self.result, event_id=event.id)
+        targets = list(targets)
+        if len(targets) > 1:
+            dispatch = engine.results(targets, op, self.result,
+                    event_id=event.id)
             dispatched.append(dispatch)
+        else:
+            for target in targets:
+                dispatch = engine.result(target, op, self.result,
+                        event_id=event.id)
+                dispatched.append(dispatch)
         return {op: dispatched}
@@ -7,11 +7,16 @@
 
 __all__ = [
     'ActivityEvent',
+    'CurrentWorkStatusMixin',
     'Notification',
     'NotificationDispatch',
     'NotificationPreference',
+    'OutboxDispatch',
+    'ProcessedEvent',
     'WorkStatus',
     'WorkStatusMixin',
+    'get_current_work_statuses',
+    'load_associations',
 ]
 
 import os
@@ -19,6 +24,7 @@ import os
 from datetime import datetime
 
 from sqlalchemy import event
+from sqlalchemy import exc
 from sqlalchemy import orm
 from sqlalchemy import schema
 from sqlalchemy import sql
@@ -33,6 +39,7 @@ from pyramid_basemodel import util as bm_util
 from pyramid_simpleauth import model as simpleauth_model
 
 import zope.interface as zi
+from . import deferred
 from . import interfaces
 
 # XXX It may be better to require the code that creates a work status to
@@ -61,6 +68,14 @@ class ActivityEvent(bm.Base, bm.BaseMixin):
             # ('c', 'created'),
             'c',
         ]
+    ) + (
+        # Supports looking up the events for an association, most recent first.
+        schema.Index(
+            'activity_events_association_id_c_id_idx',
+            'association_id',
+            'c',
+            'id',
+        ),
     )
 
     # ... whilst allowing sub classes to add fields by specifying a discriminator.
@@ -156,6 +171,14 @@ class WorkStatus(bm.Base, bm.BaseMixin):
             # ('c', 'created'),
             'c',
         ]
+    ) + (
+        # Supports looking up the most recent status for an association.
+        schema.Index(
+            'work_statuses_association_id_c_id_idx',
+            'association_id',
+            'c',
+            'id',
+        ),
     )
 
     # Must have a string status value
@@ -201,6 +224,87 @@ class WorkStatus(bm.Base, bm.BaseMixin):
         }
         return data
 
+def get_dialect_name(session=None):
+    """Return the name of the database dialect that the ``session`` is bound
+      to, or ``None`` if it isn't bound.
+    """
+
+    if session is None:
+        session = bm.Session
+    try:
+        bind = session.get_bind()
+    except exc.UnboundExecutionError:
+        return None
+    return bind.dialect.name
+
+def status_value_clause(column, value_or_values, negate=False):
+    """Return a clause that matches a status ``column`` against one or more
+      values.
+    """
+
+    if hasattr(value_or_values, '__iter__'):
+        clause = column.in_(value_or_values)
+    else:
+        clause = column==value_or_values
+    if negate:
+        clause = ~clause
+    return clause
+
+def get_current_work_statuses(instances, model_cls=WorkStatus):
+    """Return a dict that maps each of the ``instances`` to its current work
+      status, using at most one query for all of the instances that don't
+      have a denormalised current status.
+    """
+
+    # Use the denormalised status where we can.
+    statuses = {}
+    missing = {}
+    for instance in instances:
+        status = getattr(instance, 'current_work_status', None)
+        if status is not None:
+            statuses[instance] = status
+        elif instance.work_status_association_id is not None:
+            missing[instance.work_status_association_id] = instance
+    if not missing:
+        return statuses
+
+    # Otherwise select the most recent status for each association.
+    query = model_cls.query.options(orm.lazyload('event'))
+    query = query.filter(model_cls.association_id.in_(missing.keys()))
+    query = query.order_by(model_cls.association_id, model_cls.created.desc(),
+            model_cls.id.desc())
+    if get_dialect_name() == 'postgresql':
+        query = query.distinct(model_cls.association_id)
+    for status in query:
+        instance = missing.pop(status.association_id, None)
+        if instance is not None:
+            statuses[instance] = status
+    return statuses
+
+def load_associations(instances, session=None):
+    """Eager load the work status and activity event associations of the
+      ``instances``, using one query per class, so that appending statuses
+      and events to them doesn't lazy load each association in turn.
+    """
+
+    # Compose.
+    if session is None:
+        session = bm.Session
+
+    # Group the instance ids by class.
+    ids_by_cls = {}
+    for instance in instances:
+        if instance.id is not None:
+            ids_by_cls.setdefault(instance.__class__, set()).add(instance.id)
+
+    # Load the associations onto the instances in the identity map.
+    for cls, ids in ids_by_cls.items():
+        query = session.query(cls).options(
+            orm.joinedload('work_status_association'),
+            orm.joinedload('activity_event_association'),
+        )
+        query.filter(cls.id.in_(ids)).all()
+
 @zi.implementer(interfaces.IWorkStatus)
 class WorkStatusMixin(object):
     """Mixin a collection of work_statuses and activity_events to each target
@@ -210,6 +314,7 @@ class WorkStatusMixin(object):
       - `work_statuses` is a collection of `WorkStatusEntry` instances
       - use the `parent.work_status` property to get the most recent entry
       - use `set_work_status(value, event)` to update the work status
+      - use `add_activity_event(event)` to append an activity event
     """
 
     @classmethod
@@ -285,33 +390,70 @@ class WorkStatusMixin(object):
         # Make sure we're not detatched o_O.
         bm.Session.add(self)
 
-        # Add a new entry to the status collection.
-        status = model_cls(value=value, event=event)
-        if self.work_statuses:
-            self.work_statuses.append(status)
-        else:
-            self.work_statuses = [status]
+        # Add a new entry to the status collection, without loading it.
+        with bm.Session.no_autoflush:
+            association = self.work_status_association
+        if association is None:
+            association = self.WorkStatusAssociation()
+            self.work_status_association = association
+        status = model_cls(value=value, event=event, association=association)
+
+        # Update any denormalised current status.
+        self.update_current_work_status(status)
 
         # Update timestamps.
         self.modified = datetime.utcnow()
 
-        # Make sure everything gets saved.
+        # Make sure everything gets saved (n.b.: flushing may be deferred, in
+        # which case the unit keeps track of the pending status).
         bm.Session.add_all([self, status])
-        bm.Session.flush()
+        deferred.flush(bm.Session, status)
+        unit = deferred.get_deferred_flush(bm.Session)
+        if unit is not None:
+            unit.add_status(self, status)
 
         # Return the new status instance.
         return status
 
+    def add_activity_event(self, event):
+        """Append an ``event`` to the activity event collection by pointing
+          it at the association, rather than loading the collection.
+        """
+
+        with bm.Session.no_autoflush:
+            association = self.activity_event_association
+        if association is None:
+            association = self.ActivityEventAssociation()
+            self.activity_event_association = association
+        event.association = association
+        return event
+
+    def update_current_work_status(self, status):
+        """Hook to denormalise the current ``status`` -- a noop unless
+          overridden, e.g.: by the ``CurrentWorkStatusMixin``.
+        """
+
 
     def get_work_status(self, value=None, model_cls=WorkStatus):
-        """Return the most recent work status, optionally filtered by value."""
+        """Return the most recent work status, optionally filtered by value.
+
+          Within a deferred flush unit of work, pending statuses take
+          precedence and the query doesn't autoflush.
+        """
 
         query = model_cls.query
         query = query.filter_by(association_id=self.work_status_association_id)
         if value is not None:
             query = query.filter_by(value=value)
-        query = query.order_by(model_cls.created.desc())
-        return query.first()
+        query = query.order_by(model_cls.created.desc(), model_cls.id.desc())
+        unit = deferred.get_deferred_flush(bm.Session)
+        if unit is None:
+            return query.first()
+        status = unit.pending_status(self, value=value)
+        if status is not None:
+            return status
+        with bm.Session.no_autoflush:
+            return query.first()
 
 
     @property
@@ -319,12 +461,42 @@ class WorkStatusMixin(object):
         return self.get_work_status()
 
     @classmethod
-    def status_query(cls, value_or_values, negate=False, model_cls=WorkStatus):
+    def status_query(cls, value_or_values, negate=False, model_cls=WorkStatus,
+            **kwargs):
         """Returns a query for ``cls`` instances whose current work_status
           value matches the ``value_or_values`` provided.
 
-          As you can see from the implementation, this is non-trivial, so
-          handy to have as a class method.
+          On PostgreSQL, this looks up the most recent status for each row
+          using a correlated subquery that's satisfied by the
+          ``work_statuses_association_id_c_id_idx`` index. Otherwise it
+          falls back on the portable ``anti_join_status_query``.
+        """
+
+        # Compose.
+        dialect_name = kwargs.get('dialect_name', None)
+        if dialect_name is None:
+            dialect_name = get_dialect_name()
+
+        # Use the anti-join unless we know the backend supports better.
+        if dialect_name != 'postgresql':
+            return cls.anti_join_status_query(value_or_values, negate=negate,
+                    model_cls=model_cls)
+
+        # Select the most recent status value for each instance.
+        clause = model_cls.association_id==cls.work_status_association_id
+        latest = sql.select([model_cls.value]).where(clause)
+        latest = latest.order_by(model_cls.created.desc(), model_cls.id.desc())
+        latest = latest.limit(1).correlate(cls).as_scalar()
+
+        # And filter by it.
+        clause = status_value_clause(latest, value_or_values, negate=negate)
+        return cls.query.filter(clause)
+
+    @classmethod
+    def anti_join_status_query(cls, value_or_values, negate=False,
+            model_cls=WorkStatus):
+        """Portable implementation of ``status_query``. As you can see from the
+          implementation, this is non-trivial, so handy to have as a class method.
 
           The solution was ported from http://stackoverflow.com/a/2111420
         """
@@ -358,22 +530,115 @@ class WorkStatusMixin(object):
         query = query.filter(ws2.id==None)
 
         # Before filtering for the status value or values.
-        if hasattr(value_or_values, '__iter__'):
-            values = value_or_values
-            clause = ws1.value.in_(values)
-        else:
-            value = value_or_values
-            clause = ws1.value==value
-        if negate:
-            clause = ~clause
-        query = query.filter(clause)
-        return query
+        clause = status_value_clause(ws1.value, value_or_values, negate=negate)
+        return query.filter(clause)
+
+class CurrentWorkStatusMixin(WorkStatusMixin):
+    """Opt-in alternative to the ``WorkStatusMixin`` that denormalises the
+      current work status onto the parent's table, so that reading the
+      ``work_status`` is an attribute access rather than a query:
+
+      - `current_work_status_id` references the most recent entry
+      - `current_work_status_value` is a copy of its value
+
+      The columns are kept up to date by ``set_work_status``. Existing rows
+      can be populated using the ``engine_backfill_work_status`` command.
+    """
+
+    @declarative.declared_attr
+    def current_work_status_id(cls):
+        return schema.Column(
+            types.Integer,
+            schema.ForeignKey('work_statuses.id'),
+        )
+
+    @declarative.declared_attr
+    def current_work_status_value(cls):
+        return schema.Column(types.Unicode(64), index=True)
+
+    @declarative.declared_attr
+    def current_work_status(cls):
+        return orm.relationship(WorkStatus, lazy='joined', uselist=False)
+
+    def update_current_work_status(self, status):
+        """Denormalise the current ``status``."""
+
+        self.current_work_status = status
+        self.current_work_status_value = status.value
+
+    @property
+    def work_status(self):
+        """Return the denormalised status, falling back on a query for rows
+          that haven't been backfilled yet.
+        """
+
+        status = self.current_work_status
+        if status is None:
+            status = self.get_work_status()
+        return status
+
+    @classmethod
+    def status_query(cls, value_or_values, negate=False, model_cls=WorkStatus,
+            **kwargs):
+        """Returns a query for ``cls`` instances whose current work_status
+          value matches the ``value_or_values`` provided, using the indexed
+          ``current_work_status_value`` column.
+
+          Note that rows that haven't been backfilled won't match.
+        """
+
+        column = cls.current_work_status_value
+        clause = status_value_clause(column, value_or_values, negate=negate)
+        return cls.query.filter(clause)
+
+    @classmethod
+    def backfill_current_work_status(cls, min_id=None, max_id=None,
+            model_cls=WorkStatus):
+        """Return an update statement that populates the denormalised
+          columns from the most recent work status, optionally limited
+          to the rows with ids in the range ``min_id <= id < max_id``.
+
+          Only rows without a current work status are updated, so the rows
+          that ``set_work_status`` is already keeping current are left alone.
+        """
+
+        # Select the most recent work status for each row.
+        table = cls.__table__
+        def latest(column):
+            clause = model_cls.association_id==table.c.work_status_association_id
+            query = sql.select([column]).where(clause)
+            query = query.order_by(model_cls.created.desc(), model_cls.id.desc())
+            return query.limit(1).as_scalar()
+
+        # And use it to update the parent table's missing values.
+        statement = table.update()
+        statement = statement.where(table.c.current_work_status_id == None)
+        if min_id is not None:
+            statement = statement.where(table.c.id >= min_id)
+        if max_id is not None:
+            statement = statement.where(table.c.id < max_id)
+        return statement.values(
+            current_work_status_id=latest(model_cls.id),
+            current_work_status_value=latest(model_cls.value),
+        )
 
 class NotificationDispatch(bm.Base, bm.BaseMixin):
     """A notification dispatch to an user, holds information about how to deliver
     and when."""
 
     __tablename__ = 'notifications_dispatch'
+    __table_args__ = bm_util.table_args_indexes(
+        'notifications_dispatch', [
+            'notification_id',
+        ]
+    ) + (
+        # Supports looking up the dispatches that are due to be sent.
+        schema.Index(
+            'notifications_dispatch_due_unsent_idx',
+            'due',
+            postgresql_where=sql.text('sent IS NULL'),
+        ),
+    )
 
     # Has a due date.
     due = schema.Column(types.DateTime)
@@ -403,6 +668,18 @@ class Notification(bm.Base, bm.BaseMixin):
     """A notification about an event that should be sent to an user."""
 
     __tablename__ = 'notifications'
+    __table_args__ = bm_util.table_args_indexes(
+        'notifications', [
+            'event_id',
+        ]
+    ) + (
+        # Supports looking up a user's unread notifications.
+        schema.Index(
+            'notifications_user_id_unread_idx',
+            'user_id',
+            postgresql_where=sql.text('read IS NULL'),
+        ),
+    )
 
     # has an user.
     user_id = schema.Column(
@@ -451,6 +728,11 @@ class NotificationPreference(bm.Base, bm.BaseMixin):
     """Encapsulate user's notification preferences."""
 
     __tablename__ = 'notification_preferences'
+    __table_args__ = bm_util.table_args_indexes(
+        'notification_preferences', [
+            'user_id',
+        ]
+    )
 
     # Belongs to a user.
     user_id = schema.Column(types.Integer, schema.ForeignKey('auth_users.id'))
@@ -470,3 +752,60 @@ class NotificationPreference(bm.Base, bm.BaseMixin):
             'channel': self.channel,
             'user_id': self.user_id,
         }
+
+class OutboxDispatch(bm.Base, bm.BaseMixin):
+    """A torque dispatch written to the outbox in the same transaction as the
+      changes that caused it, to be sent by the ``relay`` once committed.
+    """
+
+    __tablename__ = 'torque_outbox'
+    __table_args__ = (
+        # Supports looking up the dispatches that are due to be sent.
+        schema.Index(
+            'torque_outbox_due_unsent_idx',
+            'due',
+            postgresql_where=sql.text('sent IS NULL'),
+        ),
+    )
+
+    # The request to make.
+    url = schema.Column(types.Text, nullable=False)
+    data = schema.Column(types.Text)
+    headers = schema.Column(postgresql.JSON, default={}, nullable=False)
+
+    # Has a due date, which is pushed back each time sending fails.
+    due = schema.Column(types.DateTime, default=datetime.utcnow, nullable=False)
+
+    # Has a sent date.
+    sent = schema.Column(types.DateTime)
+
+    # Keeps track of the failed attempts to send it.
+    attempts = schema.Column(types.Integer, default=0, nullable=False)
+    last_status = schema.Column(types.Unicode(96))
+
+class ProcessedEvent(bm.Base):
+    """An event delivery that's been handled, recorded by the ``ledger`` with
+      its response so that replayed deliveries can be short circuited.
+    """
+
+    __tablename__ = 'torque_processed_events'
+    __table_args__ = (
+        # Supports pruning the expired entries.
+        schema.Index(
+            'torque_processed_events_created_idx',
+            'created',
+        ),
+    )
+
+    # Keyed by the event, route and context the delivery was for.
+    event_id = schema.Column(types.Integer, primary_key=True,
+            autoincrement=False)
+    route = schema.Column(types.Unicode(255), primary_key=True)
+    context = schema.Column(types.Unicode(96), primary_key=True)
+
+    # Has the JSON encoded response.
+    response = schema.Column(types.Text)
+
+    # Has a created date, used to expire it.
+    created = schema.Column(types.DateTime, default=datetime.utcnow,
+            nullable=False)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""Provides process wide, thread safe pools of keep-alive HTTP connections,
+  shared by all the dispatchers so that each dispatch reuses an established
+  connection to nTorque (or the notification endpoint) instead of paying for
+  connection setup per task.
+
+  The pool is configured using the ``torque.pool_size`` and
+  ``torque.keep_alive`` settings, e.g.:
+
+      post = get_post(request.registry.settings)
+      post(url, data=data, headers=headers)
+"""
+
+__all__ = [
+    'DEFAULT_POOL_SIZE',
+    'SessionPool',
+    'get_post',
+    'get_session',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import requests
+import threading
+
+from pyramid.settings import asbool
+from requests import adapters
+
+DEFAULT_POOL_SIZE = 10
+
+class SessionPool(object):
+    """Lazily create and share a ``requests.Session`` per pool configuration."""
+
+    def __init__(self, **kwargs):
+        self.session_cls = kwargs.get('session_cls', requests.Session)
+        self.adapter_cls = kwargs.get('adapter_cls', adapters.HTTPAdapter)
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def __call__(self, pool_size=DEFAULT_POOL_SIZE, keep_alive=True):
+        """Get or create the session for the pool configuration."""
+
+        key = (pool_size, keep_alive)
+        session = self.sessions.get(key, None)
+        if session is None:
+            with self.lock:
+                session = self.sessions.get(key, None)
+                if session is None:
+                    session = self.create(pool_size, keep_alive)
+                    self.sessions[key] = session
+        return session
+
+    def create(self, pool_size, keep_alive):
+        """Create a session that keeps up to ``pool_size`` connections per
+          host open, or that closes them after each request.
+        """
+
+        session = self.session_cls()
+        adapter = self.adapter_cls(pool_connections=pool_size,
+                pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+get_session = SessionPool()
+
+def get_post(settings=None):
+    """Return a ``post`` function that uses the shared session configured
+      by the ``settings``.
+    """
+
+    if settings is None:
+        settings = {}
+    pool_size = int(settings.get('torque.pool_size', DEFAULT_POOL_SIZE))
+    keep_alive = asbool(settings.get('torque.keep_alive', True))
+    return get_session(pool_size=pool_size, keep_alive=keep_alive).post
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""Provides a relay that sends the dispatches written to the outbox by the
+  ``client.OutboxDispatcher``, e.g.:
+
+      engine_outbox_relay
+      engine_outbox_relay --batch-size 500 --concurrency 16 --loop
+
+  Due dispatches are claimed in batches using ``SELECT ... FOR UPDATE SKIP
+  LOCKED``, so several relays can run side by side. Claiming leases the
+  batch by pushing back its due date in a short transaction, so that the
+  dispatches can be posted concurrently, using a pool of threads, without
+  holding row locks. The results are then recorded in a second short
+  transaction. Failed dispatches are retried with exponential backoff
+  until they run out of attempts.
+"""
+
+__all__ = [
+    'Relay',
+    'run',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import argparse
+import os
+import requests
+import time
+import transaction
+
+from datetime import datetime
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import create_engine
+
+import pyramid_basemodel as bm
+
+from . import orm
+from . import pool
+
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_CONCURRENCY = 8
+DEFAULT_LEASE = 60
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_TIMEOUT = 10
+MAX_BACKOFF = 3600
+
+class Relay(object):
+    """Claim due outbox dispatches and post them."""
+
+    def __init__(self, **kwargs):
+        self.session = kwargs.get('session', bm.Session)
+        self.model_cls = kwargs.get('model_cls', orm.OutboxDispatch)
+        self.pool_cls = kwargs.get('pool_cls', ThreadPool)
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
+        self.batch_size = kwargs.get('batch_size', DEFAULT_BATCH_SIZE)
+        self.concurrency = kwargs.get('concurrency', DEFAULT_CONCURRENCY)
+        self.post = kwargs.get('post', None)
+        if self.post is None:
+            session = pool.get_session(pool_size=self.concurrency)
+            self.post = session.post
+        self.max_attempts = kwargs.get('max_attempts', DEFAULT_MAX_ATTEMPTS)
+        self.timeout = kwargs.get('timeout', DEFAULT_TIMEOUT)
+        self.lease = kwargs.get('lease', DEFAULT_LEASE)
+
+    def __call__(self):
+        """Send batches until there are no due dispatches left, returning the
+          number of dispatches sent.
+        """
+
+        count = 0
+        workers = self.pool_cls(self.concurrency)
+        try:
+            while True:
+                sent, claimed = self.relay_batch(workers)
+                count += sent
+                if claimed < self.batch_size:
+                    break
+        finally:
+            workers.close()
+        return count
+
+    def claim(self, now):
+        """Lock and return a batch of due dispatches that aren't already
+          locked by another relay.
+        """
+
+        model_cls = self.model_cls
+        query = self.session.query(model_cls)
+        query = query.filter(model_cls.sent == None)
+        query = query.filter(model_cls.due <= now)
+        query = query.filter(model_cls.attempts < self.max_attempts)
+        query = query.order_by(model_cls.due, model_cls.id)
+        query = query.limit(self.batch_size).with_for_update()
+        return query.suffix_with('SKIP LOCKED').all()
+
+    def relay_batch(self, workers):
+        """Claim, send and record a batch, returning the number sent and the
+          number claimed.
+        """
+
+        claimed = self.lease_batch()
+        results = workers.map(self.send, [item[1:] for item in claimed])
+        sent = self.record(claimed, results)
+        logger.info(('relayed', sent, len(claimed)))
+        return sent, len(claimed)
+
+    def lease_batch(self):
+        """Claim a batch and push back its due date by the lease, committing
+          straight away. Returns a list of ``(id, url, data, headers)``.
+        """
+
+        with transaction.manager:
+            now = self.utcnow()
+            leased_until = now + timedelta(seconds=self.lease)
+            claimed = []
+            for instance in self.claim(now):
+                instance.due = leased_until
+                claimed.append((instance.id, instance.url, instance.data,
+                        instance.headers))
+            self.session.flush()
+        return claimed
+
+    def record(self, claimed, results):
+        """Record the ``results`` of sending the ``claimed`` dispatches,
+          returning the number sent.
+        """
+
+        if not claimed:
+            return 0
+        model_cls = self.model_cls
+        with transaction.manager:
+            now = self.utcnow()
+            ids = [item[0] for item in claimed]
+            query = self.session.query(model_cls)
+            query = query.filter(model_cls.id.in_(ids))
+            instances = dict((item.id, item) for item in query)
+            sent = 0
+            for item, (ok, status) in zip(claimed, results):
+                instance = instances.get(item[0], None)
+                if instance is None:
+                    continue
+                instance.last_status = status
+                if ok:
+                    instance.sent = now
+                    sent += 1
+                else:
+                    instance.attempts += 1
+                    backoff = min(2 ** instance.attempts, MAX_BACKOFF)
+                    instance.due = now + timedelta(seconds=backoff)
+            self.session.flush()
+        return sent
+
+    def send(self, args):
+        """Make the request, returning whether it succeeded and its status."""
+
+        url, data, headers = args
+        try:
+            r = self.post(url, data=data, headers=headers, timeout=self.timeout)
+        except requests.exceptions.RequestException as err:
+            return False, unicode(err.__class__.__name__)
+        return r.status_code < 400, unicode(r.status_code)
+
+def run():
+    # Parse the relay options.
+    parser = argparse.ArgumentParser(description='Relay outbox dispatches.')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS)
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT)
+    parser.add_argument('--lease', type=int, default=DEFAULT_LEASE,
+            help='Seconds to lease claimed dispatches for.')
+    parser.add_argument('--loop', action='store_true',
+            help='Keep polling for due dispatches.')
+    parser.add_argument('--interval', type=float, default=1.0)
+    args = parser.parse_args()
+
+    # Bind to the database.
+    engine = create_engine(os.environ['DATABASE_URL'])
+    bm.bind_engine(engine, should_create=False)
+
+    # Relay.
+    relay = Relay(batch_size=args.batch_size, concurrency=args.concurrency,
+            max_attempts=args.max_attempts, timeout=args.timeout,
+            lease=args.lease)
+    while True:
+        count = relay()
+        print '{0} dispatches relayed'.format(count)
+        if not args.loop:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    run()
@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
 
 """Provide a function that serialises JSON using the pyramid default
-  registered json renderer.
+  registered json renderer and a faster, compact serializer for dispatch
+  bodies.
 """
 
 import json
 import decimal
 
 from pyramid import interfaces as pi
+from pyramid import renderers
+from zope.interface import providedBy
+
+try:
+    import simplejson
+except ImportError: # pragma: no cover
+    simplejson = None
 
 def get_json_renderer(request):
     registry = request.registry
@@ -28,6 +36,73 @@ def json_dumps(request, value):
     # Use it to dumps.
     return renderer(value, {})
 
+class CompactJSONSerializer(object):
+    """Serialize to a compact JSON string, using the C accelerated encoder.
+      Another ``backend`` with a compatible ``dumps`` function, such as
+      ``simplejson``, can be used instead.
+
+      Keeps the same conventions as the registered json renderer: objects
+      are serialised using their ``__json__(request)`` method or the adapters
+      registered with the renderer. Otherwise ``Decimal``s become ints or
+      floats. When the registered renderer isn't a plain ``renderers.JSON``,
+      e.g.: it has a custom ``serializer``, it's used instead.
+    """
+
+    def __init__(self, **kwargs):
+        self.backend = kwargs.get('backend', json)
+        self.separators = kwargs.get('separators', (',', ':'))
+        self.cache_key = kwargs.get('cache_key', 'engine_json_renderer_factory')
+        self.json_dumps = kwargs.get('json_dumps', json_dumps)
+
+    def get_renderer_factory(self, registry):
+        """Get the registry's json renderer factory, which is looked up once
+          per registry, when registered.
+        """
+
+        cache = vars(registry)
+        factory = cache.get(self.cache_key, None)
+        if factory is None:
+            factory = registry.queryUtility(pi.IRendererFactory, name='json')
+            if factory is not None:
+                cache[self.cache_key] = factory
+        return factory
+
+    def is_plain(self, factory):
+        """Is the ``factory`` a ``renderers.JSON`` with the default options?"""
+
+        return (type(factory) is renderers.JSON and
+                factory.serializer is json.dumps and not factory.kw)
+
+    def __call__(self, request, value):
+        """Serialize the ``value``."""
+
+        # Use the registered renderer, unless it's a plain one, whose
+        # adapters are tried before the defaults.
+        adapters = None
+        factory = self.get_renderer_factory(request.registry)
+        if factory is not None:
+            if not self.is_plain(factory):
+                return self.json_dumps(request, value)
+            adapters = factory.components.adapters
+
+        def default(o):
+            if hasattr(o, '__json__'):
+                return o.__json__(request)
+            if adapters is not None:
+                adapter = adapters.lookup((providedBy(o),), pi.IJSONAdapter)
+                if adapter is not None:
+                    return adapter(o, request)
+            if isinstance(o, decimal.Decimal):
+                return _decimal(o)
+            raise TypeError('{0!r} is not JSON serializable'.format(o))
+
+        kwargs = {'default': default, 'separators': self.separators}
+        if self.backend is simplejson:
+            kwargs['use_decimal'] = False
+        return self.backend.dumps(value, **kwargs)
+
+json_dumps_compact = CompactJSONSerializer()
+
 
 
 """
@@ -45,12 +120,15 @@ class DecimalEncoder(json.JSONEncoder):
         if hasattr(o, "__json__"):
             return o.__json__()
         if isinstance(o, decimal.Decimal):
-            if o.to_integral_value() == o:
-                return int(o)
-            else:
-                return float(o)
+            return _decimal(o)
         return super(DecimalEncoder, self).default(o)
 
+def _decimal(o):
+    if o.is_finite() and o.to_integral_value() == o:
+        return int(o)
+    else:
+        return float(o)
+
 
 def _json_loads(as_json):
     return json.loads(as_json, parse_float=decimal.Decimal, parse_int=decimal.Decimal)
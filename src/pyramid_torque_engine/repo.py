@@ -4,6 +4,7 @@
 
 __all__ = [
     'ActivityEventFactory',
+    'BatchLoader',
     'LookupActivityEvent',
     'NotificationFactory',
     'LookupNotification',
@@ -18,6 +19,7 @@ logger = logging.getLogger(__name__)
 import json
 import pyramid_basemodel as bm
 
+from . import deferred
 from . import orm
 from . import render
 from . import util
@@ -30,7 +32,7 @@ class DefaultJSONifier(object):
         self.request = request
 
     def __call__(self, instance):
-        return render.json_dumps(self.request, instance)
+        return render.json_dumps_compact(self.request, instance)
 
 class ActivityEventFactory(object):
     """Boilerplate to create and save ``ActivityEvent``s."""
@@ -54,16 +56,13 @@ class ActivityEventFactory(object):
 
     def save(self, instance):
         self.session.add(instance)
-        self.session.flush()
+        deferred.flush(self.session, instance)
         return instance
 
     def factory(self, properties):
         parent = properties.pop('parent', None)
         instance = self.model_cls(**properties)
-        if parent.activity_events:
-            parent.activity_events.append(instance)
-        else:
-            parent.activity_events = [instance]
+        parent.add_activity_event(instance)
         return self.save(instance)
 
     def inline(self, instance):
@@ -156,6 +155,65 @@ class LookupActivityEvent(object):
         # Ok, we got a match.
         return instance
 
+class BatchLoader(object):
+    """Load the contexts and activity events referred to by a batch of
+      ``{tablename, id, event_id, ...}`` items in bulk.
+    """
+
+    def __init__(self, **kwargs):
+        self.event_cls = kwargs.get('event_cls', orm.ActivityEvent)
+        self.session = kwargs.get('session', bm.Session)
+
+    def to_id(self, value):
+        """Coerce ``value`` to a valid instance id, or ``None``."""
+
+        try:
+            id_ = int(value)
+        except (TypeError, ValueError):
+            return None
+        return id_ if id_ > 0 else None
+
+    def key(self, item):
+        """Return the ``(tablename, id)`` that the ``item`` refers to."""
+
+        return item.get('tablename'), self.to_id(item.get('id'))
+
+    def contexts(self, mapping, items):
+        """Query the contexts for each tablename in one go, returning a dict
+          of ``{(tablename, id): context}``.
+        """
+
+        ids_by_tablename = {}
+        for item in items:
+            tablename, id_ = self.key(item)
+            if tablename in mapping and id_ is not None:
+                ids_by_tablename.setdefault(tablename, set()).add(id_)
+        contexts = {}
+        for tablename, ids in ids_by_tablename.items():
+            model_cls = mapping[tablename][0]
+            query = self.session.query(model_cls)
+            for instance in query.filter(model_cls.id.in_(ids)):
+                contexts[(tablename, instance.id)] = instance
+        return contexts
+
+    def events(self, items, keys=('event_id',)):
+        """Query the events identified by the ``keys`` of each item in one
+          go, returning a dict of ``{id: event}``. This also leaves them in
+          the session's identity map for any subsequent lookups by id.
+        """
+
+        ids = set()
+        for item in items:
+            for key in keys:
+                id_ = self.to_id(item.get(key))
+                if id_ is not None:
+                    ids.add(id_)
+        if not ids:
+            return {}
+        event_cls = self.event_cls
+        query = self.session.query(event_cls).filter(event_cls.id.in_(ids))
+        return dict((event.id, event) for event in query)
+
 class NotificationFactory(object):
     """Boilerplate to create and save ``Notification``s."""
 
@@ -13,48 +13,134 @@
       # Subscribe to an action happening.
       config.add_engine_subscriber(IFoo, 'action:DECLINE', notify_user)
 
-  And dispatch to them using `torque.engine.changed(context, event)`.
+  And dispatch to them using `torque.engine.changed(context, event)`,
+  `torque.engine.happened(context, action)` or, to notify about both
+  in one request, `torque.engine.changed_and_happened(...)`.
   Plus it provides `request.activity_event` to lookup an activity event
   identified by the `event_id` request param.
+
+  Many events can also be posted in one request to `/events/batch`, as a
+  list of `{tablename, id, state|action, event_id}` items.
+
+  Handlers added using a plain `config.add_subscriber(handler, IFoo)` are
+  still called, for every event about an `IFoo` context, with a
+  `(request, context, event)` tuple.
 """
 
 __all__ = [
     'AddEngineSubscriber',
     'AsterixSubscriber',
+    'BatchStateChangeHandler',
+    'CombinedArgs',
     'GetActivityEvent',
     'ParamAwareSubscriber',
     'StateChangeHandler',
+    'SubscriberIndex',
     'operation_config',
 ]
 
 import logging
 logger = logging.getLogger(__name__)
 
+import itertools
+import transaction
+
+from collections import defaultdict
+
 import zope.interface as zi
 import pyramid_basemodel as bm
 
+from zope.interface.interfaces import ISpecification
+
 from . import constants
+from . import ledger
 from . import repo
 
+# The params that a combined state change and action payload provides.
+COMBINED_PARAMS = ('state', 'action')
+
+# Run the freeze action after the default ordered registration actions.
+FREEZE_ORDER = 10
+
+# Give up re-dispatching failed batch items after this many attempts.
+MAX_BATCH_ATTEMPTS = 5
+
+class CombinedArgs(tuple):
+    """The ``(request, context, event)`` tuple that subscribers are called
+      with, which also carries the ``params`` they should match against --
+      as these differ from the ``request.json`` for combined payloads.
+    """
+
+    params = None
+
+    def __new__(cls, request, context, event, params=None):
+        instance = super(CombinedArgs, cls).__new__(cls,
+                (request, context, event))
+        instance.params = params
+        return instance
+
 class StateChangeHandler(object):
-    """Dispatch state changed events to registered subscribers."""
+    """Dispatch state changed events to registered subscribers.
+
+      A combined payload, with both a ``state`` and an ``action``, runs the
+      state subscribers with the state event and then the action subscribers
+      with the action event, exactly as if they'd been two requests.
+    """
 
     def __init__(self, **kwargs):
-        self.providedBy = kwargs.get('providedBy', zi.providedBy)
+        self.lookup = kwargs.get('lookup', repo.LookupActivityEvent())
         self.session = kwargs.get('session', bm.Session)
 
     def __call__(self, request):
         """Log and call."""
 
+        return self.handle(request, request.context, request.activity_event,
+                request.json)
+
+    def handle(self, request, context, event, data):
+        """Dispatch the ``data`` payload about the ``context``."""
+
+        # Dispatch single payloads to all matching subscribers.
+        is_combined = all(data.get(key) for key in COMBINED_PARAMS)
+        if not is_combined:
+            return {'handlers': self.dispatch(request, context, event, data)}
+
+        # Dispatch combined payloads in turn.
+        state_event = self.get_state_event(data, event)
+        handlers_by_param = {
+            'state': self.dispatch(request, context, state_event,
+                    params={'state': data['state']}),
+            'action': self.dispatch(request, context, event,
+                    params={'action': data['action']}),
+        }
+        return {
+            'handlers': handlers_by_param['state'] + handlers_by_param['action'],
+            'handlers_by_param': handlers_by_param,
+        }
+
+    def get_state_event(self, data, event):
+        """Lookup the state event of a combined payload, falling back on the
+          ``event``.
+        """
+
+        try:
+            event_id = int(data.get('state_event_id', None))
+        except (TypeError, ValueError):
+            return event
+        state_event = self.lookup(event_id)
+        return state_event if state_event else event
+
+    def dispatch(self, request, context, event, params):
+        """Call the subscribers registered for the context, passing through
+          the ``params`` that param aware subscribers should match against.
+        """
+
         # Unpack.
-        context = request.context
-        event = request.activity_event
-        registry = request.registry
-        subscriptions = registry.adapters.subscriptions
+        index = request.registry.engine_subscribers
 
         # Dispatch.
         results = []
-        for handler in subscriptions([self.providedBy(context)], None):
+        for handler in index.lookup_context(context, params):
             # XXX it seems that subscription handlers can cause the context to be
             # detatched, perhaps just in tests. So just sanity check / make sure
             # the instance is in the session before passing to each handler.
@@ -62,9 +148,248 @@ class StateChangeHandler(object):
             self.session.add(context)
             # Note that we pass through the args as a single tuple
             # as the Pyramid events machinery expects a single value.
-            combined_args = (request, context, event)
+            combined_args = CombinedArgs(request, context, event, params)
             results.append(handler(combined_args))
-        return {'handlers': [item for item in results if item is not None]}
+        return [item for item in results if item is not None]
+
+class BatchStateChangeHandler(object):
+    """Dispatch a batch of state changed events, posted as a list of
+      ``{tablename, id, state|action, event_id}`` items, e.g. when nTorque
+      replays a backlog of events.
+
+      The contexts and events are loaded in bulk and then each item is
+      dispatched by the ``StateChangeHandler`` within its own savepoint, so
+      one failing item doesn't roll back the rest. Rolling back the savepoint
+      also discards the dispatches made by the failed item's subscribers, as
+      they're held in savepoint aware buffers until commit.
+
+      The response is always a 200, as the items that succeeded are committed
+      and mustn't be run again. Instead, the indexes of the failed items are
+      listed as ``failed`` and just those items are re-dispatched as a new
+      batch after commit, up to ``max_attempts`` times.
+    """
+
+    def __init__(self, **kwargs):
+        self.handler = kwargs.get('handler', StateChangeHandler())
+        self.loader = kwargs.get('loader', repo.BatchLoader())
+        self.get_transaction = kwargs.get('get_transaction', transaction.get)
+        self.max_attempts = kwargs.get('max_attempts', MAX_BATCH_ATTEMPTS)
+
+    def __call__(self, request):
+        """Dispatch each item, returning a list of results in the same order."""
+
+        # Unpack.
+        data = request.json
+        items = data.get('items', []) if hasattr(data, 'get') else data
+        loader = self.loader
+        mapping = getattr(request.registry, 'engine_resource_mapping', {})
+
+        # Load the contexts and events.
+        contexts = loader.contexts(mapping, items)
+        events = loader.events(items, keys=('event_id', 'state_event_id'))
+
+        # Dispatch each item in turn.
+        results = []
+        failed = []
+        for i, item in enumerate(items):
+            key = loader.key(item)
+            context = contexts.get(key, None)
+            if context is None:
+                results.append({'status': 404})
+                continue
+            event = events.get(loader.to_id(item.get('event_id')), None)
+            if event is None:
+                status = getattr(context, 'work_status', None)
+                event = status.event if status else None
+            savepoint = self.get_transaction().savepoint()
+            try:
+                response = self.handler.handle(request, context, event, item)
+            except Exception as err:
+                logger.warn('torque.events.batch.failed', exc_info=True)
+                savepoint.rollback()
+                results.append({'status': 500, 'error': unicode(err)})
+                failed.append(i)
+            else:
+                results.append({'status': 200, 'response': response})
+
+        # Re-dispatch just the items that failed.
+        if failed:
+            attempts = data.get('attempts', 1) if hasattr(data, 'get') else 1
+            dispatched = self.redispatch(request, [items[i] for i in failed],
+                    attempts)
+            return {'results': results, 'failed': failed,
+                    'dispatched': dispatched}
+        return {'results': results}
+
+    def redispatch(self, request, items, attempts):
+        """Dispatch the failed ``items`` to be retried as a new batch, unless
+          they've already been attempted ``max_attempts`` times.
+        """
+
+        if attempts >= self.max_attempts:
+            logger.error(('torque.events.batch.abandoned', attempts, items))
+            return []
+        path = 'events/batch'
+        data = {'items': items, 'attempts': attempts + 1}
+        return [request.torque.engine.dispatch(path, data=data)]
+
+class SubscriberIndex(object):
+    """Index the engine subscribers by ``(interface, param_name, value)``,
+      with the asterix subscribers listed separately by interface, so that
+      an event only calls the subscribers that match it.
+
+      Subscribers are returned in the same order as the registry's
+      subscription lookup: from the least to the most specific interface
+      and then in registration order.
+
+      The subscribers that apply to a context class are also compiled into
+      a table of frozen, ordered tuples per ``(param_name, value)``, which is
+      precomputed for the engine resource classes when the configuration is
+      committed and cached for any other class on first use.
+    """
+
+    def __init__(self, **kwargs):
+        self.implementedBy = kwargs.get('implementedBy', zi.implementedBy)
+        self.providedBy = kwargs.get('providedBy', zi.providedBy)
+        self.counter = itertools.count()
+        self.items = []
+        self.by_param = defaultdict(list)
+        self.asterix = defaultdict(list)
+        self.tables = {}
+
+    def add(self, context, param, value, subscriber):
+        """Add a ``subscriber`` for the ``context`` interface (or class),
+          where ``param`` is ``None`` for asterix subscribers.
+        """
+
+        if not ISpecification.providedBy(context):
+            context = self.implementedBy(context)
+        item = (next(self.counter), subscriber)
+        self.items.append((context, param, value) + item)
+        if param is None:
+            self.asterix[context].append(item)
+        else:
+            self.by_param[(context, param, value)].append(item)
+        # Any compiled tables may now be out of date.
+        self.tables.clear()
+
+    def sync(self, registrations):
+        """Re-sequence the subscribers in the order of the registry's handler
+          ``registrations``, adding any handler that was registered for a
+          single interface without being indexed -- e.g.: using a plain
+          ``config.add_subscriber(handler, IFoo)`` -- as an asterix subscriber,
+          so it's dispatched to exactly as the registry would.
+        """
+
+        # Unpack.
+        items = self.items
+        by_subscriber = dict((id(item[4]), item) for item in items)
+
+        # Order the items as registered, picking up the unindexed handlers.
+        ordered = []
+        for registration in registrations:
+            if len(registration.required) != 1:
+                continue
+            item = by_subscriber.pop(id(registration.handler), None)
+            if item is None:
+                item = (registration.required[0], None, None, None,
+                        registration.handler)
+            ordered.append(item)
+        ordered.extend(item for item in items if id(item[4]) in by_subscriber)
+
+        # Re-index them.
+        self.counter = itertools.count()
+        self.items = []
+        self.by_param.clear()
+        self.asterix.clear()
+        for context, param, value, _, subscriber in ordered:
+            self.add(context, param, value, subscriber)
+
+    def lookup(self, provided, params):
+        """Return the subscribers for the ``provided`` specification that
+          match the ``params``.
+        """
+
+        # Unpack.
+        asterix = self.asterix
+        by_param = self.by_param
+        keys = [(k, v) for k, v in params.items() if isinstance(v, basestring)]
+
+        # Collect the matching subscribers.
+        subscribers = []
+        for iface in reversed(provided.__sro__):
+            items = list(asterix.get(iface, ()))
+            for name, value in keys:
+                items.extend(by_param.get((iface, name, value), ()))
+            items.sort()
+            subscribers.extend(subscriber for _, subscriber in items)
+        return subscribers
+
+    def compile(self, cls):
+        """Return the frozen table of subscribers that apply to instances of
+          the ``cls``, keyed by the ``(param_name, value)`` they match, with
+          the asterix subscribers merged in, or by ``None`` for the asterix
+          subscribers alone.
+
+          Each entry is a ``(subscribers, ranked)`` pair of tuples in lookup
+          order, where ``ranked`` pairs each subscriber with its position in
+          that order, so entries can be merged when several params match.
+        """
+
+        # Rank the items that apply by interface specificity and sequence.
+        sro = reversed(self.implementedBy(cls).__sro__)
+        positions = dict((iface, i) for i, iface in enumerate(sro))
+        asterix = []
+        by_key = defaultdict(list)
+        for iface, param, value, seq, subscriber in self.items:
+            position = positions.get(iface, None)
+            if position is None:
+                continue
+            item = ((position, seq), subscriber)
+            if param is None:
+                asterix.append(item)
+            else:
+                by_key[(param, value)].append(item)
+
+        # Freeze the ordered subscribers for each key.
+        table = {}
+        for key, items in by_key.items() + [(None, [])]:
+            ranked = tuple(sorted(asterix + items))
+            table[key] = (tuple(subscriber for _, subscriber in ranked), ranked)
+        return table
+
+    def freeze(self, classes):
+        """Precompute the tables for the ``classes``."""
+
+        for cls in classes:
+            self.tables[cls] = self.compile(cls)
+
+    def lookup_context(self, context, params):
+        """Return the subscribers for the ``context`` that match the
+          ``params``, using the table compiled for its class unless the
+          instance directly provides extra interfaces.
+        """
+
+        if '__provides__' in getattr(context, '__dict__', ()):
+            return self.lookup(self.providedBy(context), params)
+        cls = context.__class__
+        table = self.tables.get(cls, None)
+        if table is None:
+            table = self.tables[cls] = self.compile(cls)
+
+        # Find the entries for the params, usually at most one.
+        keys = [(k, v) for k, v in params.items()
+                if isinstance(v, basestring) and (k, v) in table]
+        if not keys:
+            return table[None][0]
+        if len(keys) == 1:
+            return table[keys[0]][0]
+
+        # Merge several entries by rank, which also dedupes the asterixes.
+        merged = {}
+        for key in keys:
+            merged.update(table[key][1])
+        return tuple(merged[rank] for rank in sorted(merged))
 
 class ParamAwareSubscriber(object):
     """Wrap an activity event handler with a callable that only calls the
@@ -76,18 +401,26 @@ class ParamAwareSubscriber(object):
         self.value = value
         self.handler = handler
 
+    def matches(self, params):
+        """Does the named param in the ``params`` dict match?"""
+
+        return params.get(self.param, None) == self.value
+
     def __call__(self, combined_args):
         """Validate that the request param matches and, if so, call the
           handler function.
         """
 
-        # Unpack the combined args into `request, *args`.
+        # Unpack the combined args into `request, *args`, matching against
+        # their params, falling back on the request's.
         request = combined_args[0]
         args = combined_args[1:]
+        params = getattr(combined_args, 'params', None)
+        if params is None:
+            params = request.json
 
         # Validate the state param matches.
-        param_value = request.json.get(self.param, None)
-        if param_value != self.value:
+        if not self.matches(params):
             return None
 
         # If so, call the handler.
@@ -131,24 +464,33 @@ class AddEngineSubscriber(object):
             events = (events,)
 
         # For each event, add a subscriber.
+        entries = []
         for value in events:
             if value == constants.ASTERIX:
                 # Subscribe to everything.
+                param_name = None
                 subscriber = self.asterix_cls(op_handler)
             else:
                 # Split e.g.: `'state:FOO'` into `('state', 'FOO')`.
                 param_name = value.split(':')[0]
                 # Add a request param aware subscriber.
                 subscriber = self.wrapper_cls(param_name, value, op_handler)
-            config.add_subscriber(subscriber, context)
-
-        # Followed up by a discriminator to prevent unintentional duplicated
-        # event subscription -- note that we have already registered the
-        # subscribers and the function we pass to config.action is a noop
-        # because ``config.add_subscriber`` itself hooks into the config commit
-        # machinery and if we delay calling it until later, our subscriptions
-        # are not actually registered.
-        noop = lambda: None
+            entries.append((param_name, value, subscriber))
+
+        # Register and index the subscribers when the configuration is
+        # committed. They're registered with the registry directly, rather
+        # than using ``config.add_subscriber``, so the registered handlers
+        # are the indexed subscribers themselves -- which lets the index tell
+        # them apart from handlers added using ``config.add_subscriber``.
+        registry = config.registry
+        def register():
+            for param_name, value, subscriber in entries:
+                registry.registerHandler(subscriber, (context,))
+                registry.engine_subscribers.add(context, param_name, value,
+                        subscriber)
+
+        # Using a discriminator to prevent unintentional duplicated
+        # event subscription.
         key = 'engine.subscribe'
         discriminator = [key, context, operation, handler]
         discriminator.extend(events)
@@ -160,7 +502,7 @@ class AddEngineSubscriber(object):
                                      type_name=None)
         intr['value'] = (context, events, operation)
 
-        config.action(tuple(discriminator), noop, introspectables=(intr,))
+        config.action(tuple(discriminator), register, introspectables=(intr,))
 
 class GetActivityEvent(object):
     """Request method to lookup ActivityEvent instance from the value in the
@@ -194,6 +536,8 @@ class IncludeMe(object):
 
     def __init__(self, **kwargs):
         self.handler = kwargs.get('handler', StateChangeHandler())
+        self.batch_handler = kwargs.get('batch_handler',
+                BatchStateChangeHandler(handler=self.handler))
         self.add_subscriber = kwargs.get('add_subscriber', AddEngineSubscriber())
         self.get_activity_event = kwargs.get('get_activity_event',
                 GetActivityEvent().__call__)
@@ -203,17 +547,40 @@ class IncludeMe(object):
 
         # Unpack.
         handler = self.handler
+        batch_handler = self.batch_handler
         add_subscriber = self.add_subscriber
         get_activity_event = self.get_activity_event
 
-        # Handle `POST {state, event_id} /events/:tablename/:id`.
+        # Handle `POST [{tablename, id, state, event_id}, ...] /events/batch`,
+        # registering the route first so that it takes precedence.
+        config.add_route('events_batch', '/events/batch')
+        config.add_view(batch_handler, renderer='json', request_method='POST',
+                route_name='events_batch')
+
+        # Handle `POST {state, event_id} /events/:tablename/:id`, short
+        # circuiting replayed deliveries iff the event ledger is enabled.
         config.add_route('events', '/events/*traverse')
-        config.add_view(handler, renderer='json', request_method='POST',
+        view = ledger.wrap_view(handler, config.get_settings())
+        config.add_view(view, renderer='json', request_method='POST',
                 route_name='events')
 
-        # Provide `add_state_change_subscriber` directive.
+        # Provide `add_state_change_subscriber` directive, indexing the
+        # subscribers in `registry.engine_subscribers`.
+        registry = config.registry
+        registry.engine_subscribers = SubscriberIndex()
         config.add_directive('add_engine_subscriber', add_subscriber)
 
+        # Once the resources and subscribers are registered, index any plain
+        # subscribers and precompute the subscribers for each engine resource
+        # class.
+        def freeze():
+            mapping = getattr(registry, 'engine_resource_mapping', {})
+            classes = [value[0] for value in mapping.values()]
+            index = registry.engine_subscribers
+            index.sync(registry.registeredHandlers())
+            index.freeze(classes)
+        config.action(None, freeze, order=FREEZE_ORDER)
+
         # Provide `request.activity_event`.
         config.add_request_method(get_activity_event, 'activity_event', reify=True)
 
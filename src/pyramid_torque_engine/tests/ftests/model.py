@@ -27,6 +27,9 @@ class IBar(IModel):
 class IBarContainer(IContainer):
     pass
 
+class IBaz(IModel):
+    pass
+
 @zi.implementer(IModel)
 class Model(bm.Base, bm.BaseMixin, orm.WorkStatusMixin):
     __tablename__ = 'models'
@@ -48,6 +51,13 @@ class Bar(bm.Base, bm.BaseMixin, orm.WorkStatusMixin):
     def __json__(self, request=None):
         return {}
 
+@zi.implementer(IBaz)
+class Baz(bm.Base, bm.BaseMixin, orm.CurrentWorkStatusMixin):
+    __tablename__ = 'bazs'
+
+    def __json__(self, request=None):
+        return {}
+
 def factory(cls=Model, initial_state=orm.DEFAULT_STATE, **kwargs):
     with tx.manager:
         instance = cls(**kwargs)
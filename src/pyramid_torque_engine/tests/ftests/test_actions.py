@@ -5,11 +5,18 @@
 import logging
 logger = logging.getLogger(__name__)
 
+from datetime import timedelta
+
 import fysom
+import mock
 import transaction
 import pyramid_basemodel as bm
 
 from pyramid import config as pyramid_config
+from sqlalchemy import event as sa_event
+from sqlalchemy import inspect
+from sqlalchemy import schema
+from sqlalchemy import types
 
 from pyramid_torque_engine import unpack
 a, o, r, s = unpack.constants()
@@ -17,6 +24,8 @@ a, o, r, s = unpack.constants()
 from . import boilerplate
 from . import model
 
+from pyramid_torque_engine import backfill
+from pyramid_torque_engine import deferred
 from pyramid_torque_engine import repo
 
 class TestAllowedActions(boilerplate.AppTestCase):
@@ -369,3 +378,403 @@ class TestInterfaceSpecificity(boilerplate.AppTestCase):
 
         # But not a model.
         self.assertFalse(state_changer.can_perform(m, a.POKE))
+
+class TestCurrentWorkStatus(boilerplate.AppTestCase):
+    """Test the denormalised ``orm.CurrentWorkStatusMixin``."""
+
+    @classmethod
+    def includeme(cls, config):
+        """Setup the test configuration."""
+
+        allow, on, after = unpack.directives(config)
+        config.add_engine_resource(model.Baz, model.IContainer)
+        s.register('CREATED', 'STARTED',)
+        a.register('START',)
+
+        allow(model.IModel, a.START, (s.CREATED), s.STARTED)
+
+    def test_set_work_status(self):
+        """Performing an action updates the denormalised columns."""
+
+        # Prepare.
+        app = self.factory()
+        request = self.getRequest(app)
+        context = model.factory(cls=model.Baz)
+        self.assertEqual(context.current_work_status_value, s.CREATED)
+
+        # Create a dummy event and get it back.
+        event_id = boilerplate.createEvent(context)
+        event = repo.LookupActivityEvent()(event_id)
+
+        # Perform the action.
+        state_changer = request.state_changer
+        with transaction.manager:
+            bm.Session.add(event)
+            bm.Session.add(context)
+            state_changer.perform(context, a.START, event)
+            context_id = context.id
+
+        # The columns are updated and the status is loaded with the row.
+        context = model.Baz.query.get(context_id)
+        self.assertEqual(context.current_work_status_value, s.STARTED)
+        self.assertEqual(context.work_status.value, s.STARTED)
+        self.assertEqual(context.work_status, context.get_work_status())
+
+    def test_backfill(self):
+        """The backfill command populates the denormalised columns."""
+
+        # Prepare a row that hasn't been denormalised.
+        context = model.factory(cls=model.Baz, initial_state=s.STARTED)
+        with transaction.manager:
+            bm.Session.add(context)
+            status_id = context.current_work_status_id
+            context_id = context.id
+            context.current_work_status = None
+            context.current_work_status_value = None
+
+        # Falls back on querying.
+        context = model.Baz.query.get(context_id)
+        self.assertTrue(context.current_work_status_id is None)
+        self.assertEqual(context.work_status.value, s.STARTED)
+
+        # Backfill.
+        count = backfill.backfill(model.Baz, batch_size=1)
+        self.assertTrue(count >= 1)
+        bm.Session.expire_all()
+        context = model.Baz.query.get(context_id)
+        self.assertEqual(context.current_work_status_id, status_id)
+        self.assertEqual(context.current_work_status_value, s.STARTED)
+
+    def test_backfill_keeps_current(self):
+        """The backfill leaves the rows that already have a current status."""
+
+        # Prepare a row whose current status isn't the latest by timestamp,
+        # e.g.: as set by a concurrent ``set_work_status``.
+        context = model.factory(cls=model.Baz, initial_state=s.CREATED)
+        with transaction.manager:
+            bm.Session.add(context)
+            first = context.get_work_status()
+            status = context.set_work_status(s.STARTED)
+            status.created = first.created - timedelta(seconds=1)
+            context_id = context.id
+            status_id = status.id
+
+        # Backfill.
+        backfill.backfill(model.Baz)
+        bm.Session.expire_all()
+        context = model.Baz.query.get(context_id)
+        self.assertEqual(context.current_work_status_id, status_id)
+        self.assertEqual(context.current_work_status_value, s.STARTED)
+
+class TestStatusQuery(boilerplate.AppTestCase):
+    """Test querying instances by their current work status."""
+
+    @classmethod
+    def includeme(cls, config):
+        """Setup the test configuration."""
+
+        config.add_engine_resource(model.Model, model.IContainer)
+        s.register('CREATED', 'STARTED', 'COMPLETED',)
+
+    def getMatches(self, model_cls, query_name, value, ids, **kwargs):
+        query = getattr(model_cls, query_name)(value, **kwargs)
+        ids = set(ids)
+        matched = set(item.id for item in query if item.id in ids)
+        return matched
+
+    def test_status_query_implementations(self):
+        """The index friendly and anti-join queries match the same rows."""
+
+        # Prepare.
+        for model_cls in (model.Model, model.Baz):
+            ids = []
+            for value in (s.CREATED, s.STARTED, s.COMPLETED):
+                instance = model.factory(cls=model_cls, initial_state=s.CREATED)
+                with transaction.manager:
+                    bm.Session.add(instance)
+                    if value != s.CREATED:
+                        instance.set_work_status(value)
+                    ids.append(instance.id)
+            created, started, completed = ids
+
+            # Match the current status, not the previous ones.
+            for query_name in ('status_query', 'anti_join_status_query'):
+                matched = self.getMatches(model_cls, query_name, s.CREATED, ids)
+                self.assertEqual(matched, set([created]))
+                matched = self.getMatches(model_cls, query_name,
+                        (s.STARTED, s.COMPLETED), ids)
+                self.assertEqual(matched, set([started, completed]))
+                matched = self.getMatches(model_cls, query_name, s.STARTED,
+                        ids, negate=True)
+                self.assertEqual(matched, set([created, completed]))
+
+    def test_get_work_status_tiebreak(self):
+        """Statuses created at the same time are ordered by id, to match the
+          status queries.
+        """
+
+        # Prepare two statuses with the same timestamp.
+        instance = model.factory(initial_state=s.CREATED)
+        with transaction.manager:
+            bm.Session.add(instance)
+            created = instance.get_work_status().created
+            status = instance.set_work_status(s.STARTED)
+            status.created = created
+            instance_id = instance.id
+
+        # The later one is current.
+        instance = model.Model.query.get(instance_id)
+        self.assertEqual(instance.get_work_status().value, s.STARTED)
+        matched = self.getMatches(model.Model, 'status_query', s.STARTED,
+                [instance_id])
+        self.assertEqual(matched, set([instance_id]))
+
+class TestAppendOnlyWrites(boilerplate.AppTestCase):
+    """Test that adding statuses and events doesn't load the history."""
+
+    @classmethod
+    def includeme(cls, config):
+        """Setup the test configuration."""
+
+        config.add_engine_resource(model.Model, model.IContainer)
+        s.register('CREATED', 'STARTED',)
+
+    def test_append_only(self):
+        """The status and event collections are left unloaded."""
+
+        # Prepare a context with some history.
+        context = model.factory()
+        boilerplate.createEvent(context)
+        with transaction.manager:
+            bm.Session.add(context)
+            context.set_work_status(s.STARTED)
+            context_id = context.id
+
+        # Add a status and an event.
+        context = model.Model.query.get(context_id)
+        with transaction.manager:
+            event = repo.ActivityEventFactory(mock.Mock())(context, None)
+            status = context.set_work_status(s.CREATED, event)
+            ws_state = inspect(context.work_status_association)
+            ae_state = inspect(context.activity_event_association)
+            self.assertTrue('work_statuses' in ws_state.unloaded)
+            self.assertTrue('activity_events' in ae_state.unloaded)
+            status_id = status.id
+
+        # They were still appended.
+        context = model.Model.query.get(context_id)
+        self.assertEqual(len(context.work_statuses), 3)
+        self.assertEqual(len(context.activity_events), 2)
+        self.assertEqual(context.work_status.id, status_id)
+
+class TestDeferredFlush(boilerplate.AppTestCase):
+    """Test the ``deferred.DeferredFlush`` unit of work mode."""
+
+    @classmethod
+    def includeme(cls, config):
+        """Setup the test configuration."""
+
+        allow, on, after = unpack.directives(config)
+        config.add_engine_resource(model.Model, model.IContainer)
+        config.add_engine_resource(model.Baz, model.IContainer)
+        s.register('CREATED', 'STARTED', 'FINISHED',)
+        a.register('START', 'FINISH',)
+
+        allow(model.IModel, a.START, (s.CREATED), s.STARTED)
+        allow(model.IModel, a.FINISH, (s.STARTED), s.FINISHED)
+
+    def test_deferred_flush(self):
+        """State changes are written in a single flush with prefetched ids."""
+
+        # Prepare.
+        app = self.factory()
+        request = self.getRequest(app)
+        context = model.factory(cls=model.Baz)
+        event_id = boilerplate.createEvent(context)
+        event = repo.LookupActivityEvent()(event_id)
+
+        # Count the flushes.
+        flushes = []
+        session = bm.Session()
+        listener = lambda *args: flushes.append(args)
+        sa_event.listen(session, 'after_flush', listener)
+
+        # Perform the action.
+        state_changer = request.state_changer
+        with transaction.manager:
+            bm.Session.add(event)
+            bm.Session.add(context)
+            with deferred.DeferredFlush():
+                state_changer.perform(context, a.START, event)
+                status = context.work_status
+                self.assertTrue(status.id is not None)
+                self.assertTrue(status.event.id is not None)
+                self.assertTrue(inspect(status).pending)
+                self.assertEqual(len(flushes), 0)
+            self.assertEqual(len(flushes), 1)
+            self.assertTrue(inspect(status).persistent)
+            status_id = status.id
+            context_id = context.id
+        sa_event.remove(session, 'after_flush', listener)
+
+        # The state change was saved.
+        context = model.Baz.query.get(context_id)
+        self.assertEqual(context.get_work_status().id, status_id)
+        self.assertEqual(context.work_status.value, s.STARTED)
+
+    def test_deferred_flush_without_current_status(self):
+        """Reading the work status of a plain ``WorkStatusMixin`` model within
+          the unit returns the pending status without flushing.
+        """
+
+        # Prepare.
+        app = self.factory()
+        request = self.getRequest(app)
+        context = model.factory()
+        event_id = boilerplate.createEvent(context)
+        event = repo.LookupActivityEvent()(event_id)
+
+        # Count the flushes.
+        flushes = []
+        session = bm.Session()
+        listener = lambda *args: flushes.append(args)
+        sa_event.listen(session, 'after_flush', listener)
+
+        # Perform two actions in turn.
+        state_changer = request.state_changer
+        with transaction.manager:
+            bm.Session.add(event)
+            bm.Session.add(context)
+            with deferred.DeferredFlush():
+                state_changer.perform(context, a.START, event)
+                state_changer.perform(context, a.FINISH, event)
+                self.assertEqual(context.work_status.value, s.FINISHED)
+                self.assertEqual(len(flushes), 0)
+            self.assertEqual(len(flushes), 1)
+            context_id = context.id
+        sa_event.remove(session, 'after_flush', listener)
+
+        # The state changes were saved.
+        context = model.Model.query.get(context_id)
+        self.assertEqual(context.work_status.value, s.FINISHED)
+        self.assertEqual(len(context.work_statuses), 3)
+
+    def test_sequence_name(self):
+        """Ids come from the declared or the serial sequence."""
+
+        unit = deferred.DeferredFlush()
+        table = bm.Base.metadata.tables['activity_events']
+        self.assertEqual(unit.sequence_name(table),
+                'public.activity_events_id_seq')
+        sequence = schema.Sequence('custom_id_seq')
+        table = schema.Table('customs', schema.MetaData(),
+                schema.Column('id', types.Integer, sequence, primary_key=True))
+        self.assertEqual(unit.sequence_name(table), 'custom_id_seq')
+
+class TestPerformMany(boilerplate.AppTestCase):
+    """Test performing an action on many contexts at once."""
+
+    @classmethod
+    def includeme(cls, config):
+        """Setup the test configuration."""
+
+        allow, on, after = unpack.directives(config)
+        config.add_engine_resource(model.Model, model.IContainer)
+        config.add_engine_resource(model.Baz, model.IContainer)
+        s.register('CREATED', 'STARTED', 'EXPIRED',)
+        a.register('EXPIRE', 'POKE',)
+
+        allow(model.IModel, a.EXPIRE, (s.CREATED, s.STARTED), s.EXPIRED)
+        allow(model.IModel, a.POKE, '*', Ellipsis)
+
+    def test_perform_many(self):
+        """Valid contexts change state and invalid ones are skipped."""
+
+        # Prepare.
+        app = self.factory()
+        request = self.getRequest(app)
+        contexts = [
+            model.factory(),
+            model.factory(initial_state=s.STARTED),
+            model.factory(initial_state=s.EXPIRED),
+            model.factory(cls=model.Baz),
+        ]
+
+        # Perform.
+        state_changer = request.state_changer
+        with transaction.manager:
+            bm.Session.add_all(contexts)
+            results = state_changer.perform_many(contexts, a.EXPIRE, None)
+            performed = [item[0] for item in results]
+            next_states = set(item[1] for item in results)
+            dispatched = [len(item[3]) for item in results]
+            ids = [(item.__class__, item.id) for item in performed]
+
+        # The expired context was skipped.
+        self.assertEqual(performed, contexts[:2] + contexts[3:])
+        self.assertEqual(next_states, set([s.EXPIRED]))
+        self.assertEqual(dispatched, [1, 1, 1])
+        for model_cls, id_ in ids:
+            context = model_cls.query.get(id_)
+            self.assertEqual(context.work_status.value, s.EXPIRED)
+            self.assertEqual(len(context.activity_events), 2)
+
+    def test_perform_many_batches_loads_and_notifications(self):
+        """The associations are loaded up front and the notifications are
+          sent in a single batch.
+        """
+
+        # Prepare.
+        app = self.factory()
+        request = self.getRequest(app)
+        contexts = [model.factory() for i in range(3)]
+
+        # Record the association selects.
+        statements = []
+        engine = bm.Session().get_bind().engine
+        def listener(conn, cursor, statement, *args):
+            if statement.startswith('SELECT'):
+                statements.append(statement)
+        sa_event.listen(engine, 'before_cursor_execute', listener)
+
+        # Perform.
+        state_changer = request.state_changer
+        try:
+            with transaction.manager:
+                bm.Session.add_all(contexts)
+                results = state_changer.perform_many(contexts, a.EXPIRE, None)
+                dispatches = [item[3][0] for item in results]
+        finally:
+            sa_event.remove(engine, 'before_cursor_execute', listener)
+
+        # The associations were loaded in one query.
+        selects = [item for item in statements
+                if 'FROM work_status_associations' in item]
+        self.assertEqual(len(selects), 0)
+        joined = [item for item in statements
+                if 'JOIN work_status_associations' in item]
+        self.assertEqual(len(joined), 1)
+
+        # And the notifications were sent in one dispatch.
+        self.assertEqual(len(set(id(item) for item in dispatches)), 1)
+        self.assertEqual(dispatches[0]['path'], 'events/batch')
+        results = dispatches[0]['response']['results']
+        self.assertEqual([item['status'] for item in results], [200] * 3)
+
+    def test_perform_many_without_state_change(self):
+        """Actions that don't change the state just notify."""
+
+        # Prepare.
+        app = self.factory()
+        request = self.getRequest(app)
+        contexts = [model.factory(), model.factory(cls=model.Baz)]
+
+        # Perform.
+        state_changer = request.state_changer
+        with transaction.manager:
+            bm.Session.add_all(contexts)
+            results = state_changer.perform_many(contexts, a.POKE, None)
+            has_changed = [item[2] for item in results]
+            states = [item.work_status.value for item in contexts]
+        self.assertEqual(has_changed, [False, False])
+        self.assertEqual(states, [s.CREATED, s.CREATED])
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+"""High level integration / functional tests of the dispatch machinery."""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import Queue
+import json
+import mock
+import transaction
+import urllib
+
+from datetime import datetime
+import pyramid_basemodel as bm
+
+from ntorque import client as ntorque_client
+from pyramid.exceptions import ConfigurationError
+from pyramid.request import Request
+from pyramid.router import Router
+
+from pyramid_torque_engine import client
+from pyramid_torque_engine import orm
+from pyramid_torque_engine import repo
+from pyramid_torque_engine import relay
+from pyramid_torque_engine import unpack
+a, o, r, s = unpack.constants()
+
+from . import boilerplate
+from . import model
+
+class TestOutbox(boilerplate.AppTestCase):
+    """Test the ``client.OutboxDispatcher`` and the ``relay.Relay``."""
+
+    @classmethod
+    def includeme(cls, config):
+        """Setup the test configuration."""
+
+        config.add_engine_resource(model.Model, model.IContainer)
+        s.register('CREATED',)
+        a.register('POKE',)
+
+    def makeClient(self, app):
+        request = self.getRequest(app)
+        return client.WorkEngineClient(request,
+                client_cls=ntorque_client.HTTPTorqueClient,
+                dispatcher=client.OutboxDispatcher())
+
+    def makeResponse(self, status_code):
+        response = mock.Mock()
+        response.status_code = status_code
+        return response
+
+    def test_dispatches_are_written_in_the_transaction(self):
+        """Dispatches are stored with the changes and only kept if they commit."""
+
+        app = self.factory()
+        engine = self.makeClient(app)
+        context = model.factory()
+        with transaction.manager:
+            bm.Session.add(context)
+            bm.Session.flush()
+            engine.happened(context, a.POKE)
+        try:
+            with transaction.manager:
+                engine.happened(bm.Session.merge(context), a.POKE)
+                raise ValueError
+        except ValueError:
+            pass
+        dispatches = orm.OutboxDispatch.query.all()
+        self.assertEqual(len(dispatches), 1)
+        self.assertEqual(json.loads(dispatches[0].data)['action'], a.POKE)
+        self.assertTrue(dispatches[0].sent is None)
+
+    def test_relay(self):
+        """The relay sends due dispatches and backs off failed ones."""
+
+        app = self.factory()
+        engine = self.makeClient(app)
+        context = model.factory()
+        with transaction.manager:
+            bm.Session.add(context)
+            bm.Session.flush()
+            for i in range(5):
+                engine.happened(context, a.POKE)
+
+        # The first two fail, the rest are sent, in batches of two.
+        mock_post = mock.Mock()
+        mock_post.side_effect = [self.makeResponse(502)] * 2 + [
+                self.makeResponse(200)] * 3
+        relay_ = relay.Relay(post=mock_post, batch_size=2, concurrency=1)
+        self.assertEqual(relay_(), 3)
+        self.assertEqual(mock_post.call_count, 5)
+        dispatches = orm.OutboxDispatch.query.order_by(orm.OutboxDispatch.id)
+        attempts = [(item.sent is None, item.attempts) for item in dispatches]
+        self.assertEqual(attempts, [(True, 1)] * 2 + [(False, 0)] * 3)
+
+        # The failed ones aren't due again yet.
+        self.assertEqual(relay_(), 0)
+        self.assertEqual(mock_post.call_count, 5)
+
+    def test_relay_leases_before_sending(self):
+        """Dispatches are leased and committed before they're sent."""
+
+        app = self.factory()
+        engine = self.makeClient(app)
+        context = model.factory()
+        with transaction.manager:
+            bm.Session.add(context)
+            bm.Session.flush()
+            engine.happened(context, a.POKE)
+
+        # While sending, the dispatch is leased rather than locked.
+        now = datetime.utcnow()
+        leases = []
+        def post(*args, **kwargs):
+            dispatch = orm.OutboxDispatch.query.one()
+            leases.append((dispatch.due - now).total_seconds())
+            transaction.abort()
+            return self.makeResponse(200)
+        relay_ = relay.Relay(post=post, concurrency=1, lease=60)
+        self.assertEqual(relay_(), 1)
+        self.assertTrue(55 < leases[0] < 65)
+        self.assertTrue(orm.OutboxDispatch.query.one().sent is not None)
+
+    def test_background_overflow(self):
+        """Dispatches that overflow the background queue can be written to
+          the outbox after commit.
+        """
+
+        mock_workers = mock.Mock()
+        mock_workers.put.side_effect = Queue.Full
+        dispatcher = client.BackgroundDispatcher(mock_workers, policy='outbox')
+        with transaction.manager:
+            dispatcher('http://torque/?url=hook', '{}', {'Foo': 'bar'})
+        dispatches = orm.OutboxDispatch.query.all()
+        self.assertEqual(len(dispatches), 1)
+        self.assertEqual(dispatches[0].headers, {'Foo': 'bar'})
+        self.assertEqual(dispatches[0].attempts, 0)
+
+
+BEEPED = []
+
+def beep(request, context, event, op, **kwargs):
+    BEEPED.append(context.id)
+    return {op: context.id}
+
+class TestInline(boilerplate.AppTestCase):
+    """Test the ``client.InlineDispatcher``."""
+
+    @classmethod
+    def includeme(cls, config):
+        """Setup the test configuration."""
+
+        allow, on, after = unpack.directives(config)
+        config.add_engine_resource(model.Model, model.IContainer)
+        s.register('CREATED',)
+        a.register('POKE',)
+        o.register('BEEP',)
+
+        allow(model.IModel, a.POKE, '*', Ellipsis)
+        on(model.IModel, a.POKE, o.BEEP, beep)
+
+    def test_invoke(self):
+        """Inline dispatches run the subscribers using a subrequest."""
+
+        # Prepare.
+        app = self.factory()
+        context = model.factory()
+        event_id = boilerplate.createEvent(context)
+        request = Request.blank('/')
+        request.registry = app.registry
+        request.invoke_subrequest = Router(app.registry).invoke_subrequest
+
+        # Dispatch an action inline, with a synchronous after commit.
+        invoked = []
+        def after_commit(target, *args):
+            invoked.append(target(*args))
+        inline = client.InlineDispatcher(request, after_commit=after_commit)
+        engine = client.WorkEngineClient(request,
+                dispatcher=ntorque_client.NoopDispatcher(),
+                client_cls=ntorque_client.HTTPTorqueClient, inline=inline)
+        context = model.Model.query.one()
+        event = repo.LookupActivityEvent()(event_id)
+        engine.happened(context, a.POKE, event=event)
+
+        # The subscriber ran.
+        response = invoked[0]
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.json['handlers'], [{o.BEEP: context.id}])
+
+    def test_invoke_after_commit(self):
+        """With the real after commit hook, the subrequest is made once the
+          transaction commits and a failed one is written to the outbox.
+        """
+
+        # Prepare.
+        app = self.factory()
+        context = model.factory()
+        context_id = context.id
+        event_id = boilerplate.createEvent(context)
+        request = Request.blank('/')
+        request.registry = app.registry
+        request.invoke_subrequest = Router(app.registry).invoke_subrequest
+        fallback = ntorque_client.HTTPTorqueClient(client.OutboxDispatcher(),
+                'http://torque')
+        inline = client.InlineDispatcher(request, fallback=fallback)
+        engine = client.WorkEngineClient(request,
+                dispatcher=ntorque_client.NoopDispatcher(),
+                client_cls=ntorque_client.HTTPTorqueClient, inline=inline)
+
+        # The subscriber runs after commit.
+        del BEEPED[:]
+        with transaction.manager:
+            context = model.Model.query.get(context_id)
+            event = repo.LookupActivityEvent()(event_id)
+            engine.happened(context, a.POKE, event=event)
+            self.assertEqual(BEEPED, [])
+        self.assertEqual(BEEPED, [context_id])
+        self.assertEqual(orm.OutboxDispatch.query.count(), 0)
+
+        # A failed subrequest is queued in the outbox instead.
+        missing = model.Model(id=context_id + 1000)
+        with transaction.manager:
+            engine.happened(missing, a.POKE)
+        dispatches = orm.OutboxDispatch.query.all()
+        self.assertEqual(len(dispatches), 1)
+        url = urllib.unquote(dispatches[0].url)
+        self.assertTrue(url.endswith('/events/models/{0}'.format(missing.id)))
+
+    def test_inline_routes(self):
+        """Enabling inline dispatch works when the engine routes are at the
+          path of the ``engine.url``.
+        """
+
+        app = self.factory(**{'engine.inline': 'true'})
+        request = Request.blank('/')
+        request.registry = app.registry
+        self.assertTrue(client.Torque(request).engine.inline is not None)
+
+    def test_inline_routes_missing(self):
+        """Otherwise it's refused at configuration time."""
+
+        settings = {'engine.inline': 'true', 'engine.url': 'http://localhost/x'}
+        self.assertRaises(ConfigurationError, self.factory, **settings)
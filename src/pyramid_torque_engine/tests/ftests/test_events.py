@@ -9,11 +9,17 @@ import json
 import fysom
 import transaction
 
+from datetime import datetime
+from datetime import timedelta
+
 import pyramid_basemodel as bm
 
 from pyramid import config as pyramid_config
 
 from pyramid_torque_engine import constants
+from pyramid_torque_engine import hooks
+from pyramid_torque_engine import ledger
+from pyramid_torque_engine import orm
 from pyramid_torque_engine import operations as ops
 from pyramid_torque_engine import unpack
 from pyramid_torque_engine import repo
@@ -21,6 +27,7 @@ a, o, r, s = unpack.constants()
 
 from . import boilerplate
 from . import model
+from . import settings
 
 def get_handlers_for(dispatched, event, names_only=False):
     names = []
@@ -29,7 +36,11 @@ def get_handlers_for(dispatched, event, names_only=False):
         data = json.loads(dispatch['data'])
         type_ = event.split(':')[0]
         if data.get(type_) == event:
-            handlers.extend(dispatch['response']['handlers'])
+            response = dispatch['response']
+            if 'handlers_by_param' in response:
+                handlers.extend(response['handlers_by_param'][type_])
+            else:
+                handlers.extend(response['handlers'])
     if names_only:
         for item in handlers:
             names.extend(item.keys())
@@ -201,6 +212,61 @@ class TestSubscriptions(boilerplate.AppTestCase):
         self.assertEqual(handlers[0], o.BEEP)
         self.assertEqual(len(handlers), 1)
 
+PLAIN = []
+
+def plain(combined_args):
+    request, context, event = combined_args
+    PLAIN.append(context.id)
+
+class TestPlainSubscribers(boilerplate.AppTestCase):
+    """Test handlers added using a plain ``config.add_subscriber``."""
+
+    @classmethod
+    def includeme(cls, config):
+        """Setup the test configuration."""
+
+        # Unpack.
+        allow, on, after = unpack.directives(config)
+
+        # Traversal.
+        config.add_engine_resource(model.Model, model.IContainer)
+
+        # Declare constants.
+        s.register('CREATED', 'STARTED',)
+        a.register('START',)
+
+        # Declare actions.
+        allow(model.IModel, a.START, (s.CREATED), s.STARTED)
+
+        # Subscribe without using the engine directives.
+        config.add_subscriber(plain, model.IModel)
+
+    def test_plain_subscriber(self):
+        """Plain subscribers are called with a three tuple of combined args
+          for every event.
+        """
+
+        # Prepare.
+        app = self.factory()
+        request = self.getRequest(app)
+        context = model.factory()
+        context_id = context.id
+        del PLAIN[:]
+
+        # Create a dummy event and get it back.
+        event_id = boilerplate.createEvent(context)
+        event = repo.LookupActivityEvent()(event_id)
+
+        # Perform a state change.
+        state_changer = request.state_changer
+        with transaction.manager:
+            bm.Session.add(event)
+            bm.Session.add(context)
+            state_changer.perform(context, a.START, event)
+
+        # The handler was called for the action and the state change.
+        self.assertEqual(PLAIN, [context_id, context_id])
+
 class TestTransitions(boilerplate.AppTestCase):
     """Test ``after(context, operation, result, action)`` rules."""
 
@@ -326,3 +392,247 @@ class TestTransitions(boilerplate.AppTestCase):
         events = triggered_events(dispatch, 'action')
         self.assertEqual(events[0], a.DISPUTE)
         self.assertEqual(len(events), 1)
+
+    def test_batch_results(self):
+        """Test binding an operation result for many contexts in one go."""
+
+        # Prepare.
+        app = self.factory()
+        request = self.getRequest(app)
+        model_id = model.factory(initial_state=s.STARTED).id
+        foo_id = model.factory(cls=model.Foo, initial_state=s.STARTED).id
+        created_id = model.factory().id
+        event_id = boilerplate.createEvent(model.Model.query.get(model_id))
+
+        # Reporting back success for all of them ...
+        notify = request.torque.engine
+        with transaction.manager:
+            contexts = [
+                model.Model.query.get(model_id),
+                model.Foo.query.get(foo_id),
+                model.Model.query.get(created_id),
+            ]
+            dispatch = notify.results(contexts, o.DOIT, r.SUCCESS,
+                    event_id=event_id)
+
+        # ... finishes the started contexts, leaving the other one be.
+        results = dispatch['response']['results']
+        self.assertEqual([item['status'] for item in results], [200, 200, 200])
+        self.assertEqual(model.Model.query.get(model_id).work_status.value,
+                s.FINISHED)
+        self.assertEqual(model.Foo.query.get(foo_id).work_status.value,
+                s.FINISHED)
+        self.assertEqual(model.Model.query.get(created_id).work_status.value,
+                s.CREATED)
+        self.assertEqual(results[2]['dispatched'], [])
+
+        # Failure uses the most specific transition.
+        with transaction.manager:
+            contexts = [
+                model.Model.query.get(model_id),
+                model.Foo.query.get(foo_id),
+            ]
+            notify.results(contexts, o.DOIT, r.FAILURE, event_id=event_id)
+        self.assertEqual(model.Model.query.get(model_id).work_status.value,
+                s.FAILED)
+        self.assertEqual(model.Foo.query.get(foo_id).work_status.value,
+                s.DISPUTED)
+
+        # Results without a transition are a noop.
+        with transaction.manager:
+            context = model.Model.query.get(model_id)
+            dispatch = notify.results([context], u'operation:UNKNOWN',
+                    r.SUCCESS, event_id=event_id)
+        results = dispatch['response']['results']
+        self.assertEqual([item['status'] for item in results], [204])
+
+class TestDirectTransitions(TestTransitions):
+    """Run the transition tests with the ``engine.direct_transitions``
+      single ``/results`` view.
+    """
+
+    @classmethod
+    def setup_class(cls):
+        super(TestDirectTransitions, cls).setup_class()
+        test_settings = settings.TEST_SETTINGS.copy()
+        test_settings['engine.direct_transitions'] = True
+        cls.factory.test_settings = test_settings
+
+    def test_single_results_view(self):
+        """The transitions aren't registered as views."""
+
+        app = self.factory()
+        introspector = app.registry.introspector
+        views = introspector.get_category('views')
+        results_views = [item for item in views
+                if item['introspectable']['route_name'] == 'results']
+        self.assertEqual(len(results_views), 1)
+
+DISPATCHED = []
+
+def touch(request, context, event, operation):
+    context.set_work_status(s.TOUCHED, event=event)
+    hooks.join_to_transaction(DISPATCHED.append, context.id)
+    return {operation: context.id}
+
+def explode(request, context, event, operation):
+    context.set_work_status(s.TOUCHED, event=event)
+    hooks.join_to_transaction(DISPATCHED.append, context.id)
+    bm.Session.flush()
+    raise ValueError(u'Boom')
+
+class TestBatchEvents(boilerplate.AppTestCase):
+    """Test posting many events to ``/events/batch``."""
+
+    @classmethod
+    def includeme(cls, config):
+        """Setup the test configuration."""
+
+        # Unpack.
+        allow, on, after = unpack.directives(config)
+
+        # Traversal.
+        config.add_engine_resource(model.Model, model.IContainer)
+        config.add_engine_resource(model.Foo, model.IFooContainer)
+
+        # Declare constants.
+        s.register('CREATED', 'STARTED', 'TOUCHED',)
+        a.register('POKE',)
+        o.register('TOUCH', 'EXPLODE',)
+
+        # Subscribe.
+        on(model.IModel, s.STARTED, o.TOUCH, touch)
+        on(model.IFoo, a.POKE, o.EXPLODE, explode)
+
+    def test_batch(self):
+        """Each item is dispatched in its own savepoint."""
+
+        # Prepare.
+        app = self.factory()
+        a_id = model.factory().id
+        b_id = model.factory().id
+        foo_id = model.factory(cls=model.Foo).id
+        event_id = boilerplate.createEvent(model.Model.query.get(a_id))
+        items = [
+            {'tablename': u'models', 'id': a_id, 'state': s.STARTED,
+                    'event_id': event_id},
+            {'tablename': u'foos', 'id': foo_id, 'action': a.POKE},
+            {'tablename': u'models', 'id': 12345, 'state': s.STARTED},
+            {'tablename': u'models', 'id': b_id, 'state': s.STARTED},
+        ]
+
+        # Post the batch.
+        del DISPATCHED[:]
+        res = app.post_json('/events/batch', items)
+
+        # Every item has a result, in order, and the failure is reported.
+        results = res.json['results']
+        self.assertEqual([item['status'] for item in results],
+                [200, 500, 404, 200])
+        self.assertEqual(res.json['failed'], [1])
+
+        # Just the failed item is re-dispatched.
+        dispatched, = res.json['dispatched']
+        self.assertTrue(dispatched['url'].endswith('/events/batch'))
+        data = json.loads(dispatched['data'])
+        self.assertEqual(data, {'items': [items[1]], 'attempts': 2})
+        handlers = results[0]['response']['handlers']
+        self.assertEqual(handlers, [{o.TOUCH: a_id}])
+
+        # The failed item was rolled back and the others were saved.
+        self.assertEqual(model.Model.query.get(a_id).work_status.value,
+                s.TOUCHED)
+        self.assertEqual(model.Model.query.get(b_id).work_status.value,
+                s.TOUCHED)
+        self.assertEqual(model.Foo.query.get(foo_id).work_status.value,
+                s.CREATED)
+
+        # Along with the dispatches it made.
+        self.assertEqual(DISPATCHED, [a_id, b_id])
+
+        # Until the failed items have been attempted too many times.
+        data = {'items': [items[1]], 'attempts': 5}
+        res = app.post_json('/events/batch', data)
+        self.assertEqual(res.json['failed'], [0])
+        self.assertEqual(res.json['dispatched'], [])
+
+CALLS = []
+
+def count(request, context, event, operation):
+    CALLS.append(operation)
+    return {operation: len(CALLS)}
+
+class TestEventLedger(boilerplate.AppTestCase):
+    """Test short circuiting replayed deliveries with the event ledger."""
+
+    @classmethod
+    def includeme(cls, config):
+        """Setup the test configuration."""
+
+        # Unpack.
+        allow, on, after = unpack.directives(config)
+
+        # Traversal.
+        config.add_engine_resource(model.Model, model.IContainer)
+
+        # Declare constants.
+        s.register('CREATED',)
+        a.register('POKE', 'PROD',)
+        o.register('COUNT',)
+
+        # Subscribe.
+        on(model.IModel, (a.POKE, a.PROD), o.COUNT, count)
+
+    @classmethod
+    def setup_class(cls):
+        super(TestEventLedger, cls).setup_class()
+        test_settings = settings.TEST_SETTINGS.copy()
+        test_settings['engine.event_ledger'] = True
+        cls.factory.test_settings = test_settings
+
+    def setUp(self):
+        super(TestEventLedger, self).setUp()
+        del CALLS[:]
+
+    def test_replay(self):
+        """Replayed deliveries return the cached response."""
+
+        # Prepare.
+        app = self.factory()
+        context_id = model.factory().id
+        event_id = boilerplate.createEvent(model.Model.query.get(context_id))
+        path = '/events/models/{0}'.format(context_id)
+
+        # Deliver the same event twice.
+        data = {'action': a.POKE, 'event_id': event_id}
+        first = app.post_json(path, data).json
+        second = app.post_json(path, data).json
+        self.assertEqual(CALLS, [o.COUNT])
+        self.assertEqual(first, second)
+
+        # A different delivery about the same event isn't a replay.
+        app.post_json(path, {'action': a.PROD, 'event_id': event_id})
+        self.assertEqual(CALLS, [o.COUNT, o.COUNT])
+
+    def test_prune(self):
+        """Expired entries are ignored and pruned."""
+
+        # Prepare.
+        app = self.factory()
+        context_id = model.factory().id
+        event_id = boilerplate.createEvent(model.Model.query.get(context_id))
+        path = '/events/models/{0}'.format(context_id)
+        data = {'action': a.POKE, 'event_id': event_id}
+        app.post_json(path, data)
+
+        # Once expired, the entry no longer matches ...
+        later = lambda: datetime.utcnow() + timedelta(days=8)
+        event_ledger = ledger.EventLedger(utcnow=later)
+        entry = bm.Session.query(orm.ProcessedEvent).one()
+        self.assertTrue(event_ledger.lookup(entry.event_id, entry.route,
+                entry.context) is None)
+
+        # ... and is pruned.
+        with transaction.manager:
+            self.assertEqual(event_ledger.prune(), 1)
+        self.assertEqual(bm.Session.query(orm.ProcessedEvent).count(), 0)
@@ -15,6 +15,7 @@ import pyramid_basemodel as bm
 from pyramid import config as pyramid_config
 
 from pyramid_torque_engine import constants
+from pyramid_torque_engine import migrate
 from pyramid_torque_engine import operations as ops
 from pyramid_torque_engine import unpack
 from pyramid_torque_engine import repo
@@ -91,3 +92,26 @@ class TestNotifications(boilerplate.AppTestCase):
             notification_preference = user.notification_preference
             self.assertIsNone(notification_preference.frequency)
             self.assertEqual(notification_preference.channel, 'email')
+
+class TestIndexes(boilerplate.AppTestCase):
+    """Test the ``migrate.create_indexes_concurrently`` helper."""
+
+    @classmethod
+    def includeme(cls, config):
+        pass
+
+    def test_create_missing_indexes(self):
+        """Missing indexes are created and existing ones are left alone."""
+
+        # Drop an index.
+        engine = self.factory.engine
+        name = 'notifications_dispatch_due_unsent_idx'
+        engine.execute('DROP INDEX IF EXISTS {0}'.format(name))
+
+        # It's recreated.
+        created = migrate.create_indexes_concurrently(engine)
+        self.assertEqual(created, [name])
+
+        # And only once.
+        created = migrate.create_indexes_concurrently(engine)
+        self.assertEqual(created, [])
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""Test the compiled state action ``TransitionTable``."""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import fysom
+import unittest
+
+import zope.interface as zi
+
+from mock import MagicMock as Mock
+
+from pyramid_torque_engine import action
+
+class IFoo(zi.Interface):
+    pass
+
+class IBar(zi.Interface):
+    pass
+
+RULES = {
+    IFoo: {
+        u'action:START': [((u'state:CREATED',), u'state:STARTED')],
+        u'action:CANCEL': [(('*',), u'state:CANCELLED')],
+        u'action:POKE': [(('*',), Ellipsis)],
+        u'action:COMPLETE': [
+            ((u'state:STARTED',), u'state:COMPLETED'),
+            ((u'state:COMPLETED',), Ellipsis),
+        ],
+    },
+}
+
+class TestTransitionTable(unittest.TestCase):
+    """Test the ``pyramid_torque_engine.action.TransitionTable``."""
+
+    def makeOne(self):
+        return action.TransitionTable(RULES)
+
+    def test_explicit_rules(self):
+        """Explicit from states map to their to state."""
+
+        table = self.makeOne()
+        to_state = table.lookup(IFoo, u'state:CREATED', u'action:START')
+        self.assertEqual(to_state, u'state:STARTED')
+        to_state = table.lookup(IFoo, u'state:STARTED', u'action:START')
+        self.assertTrue(to_state is None)
+
+    def test_asterix_and_ellipsis(self):
+        """Wildcard rules match any state and ellipsis means no change."""
+
+        table = self.makeOne()
+        for state in (u'state:STARTED', u'state:UNKNOWN'):
+            to_state = table.lookup(IFoo, state, u'action:CANCEL')
+            self.assertEqual(to_state, u'state:CANCELLED')
+            to_state = table.lookup(IFoo, state, u'action:POKE')
+            self.assertEqual(to_state, state)
+        to_state = table.lookup(IFoo, u'state:COMPLETED', u'action:COMPLETE')
+        self.assertEqual(to_state, u'state:COMPLETED')
+
+    def test_contains(self):
+        """The table knows which contexts and actions it has rules for."""
+
+        table = self.makeOne()
+        self.assertTrue(IFoo in table)
+        self.assertFalse(IBar in table)
+        self.assertTrue(table.has_action(IFoo, u'action:POKE'))
+        self.assertFalse(table.has_action(IBar, u'action:POKE'))
+
+    def test_machines_are_independent(self):
+        """Triggering an action on one machine doesn't affect another."""
+
+        table = self.makeOne()
+        m1 = table.machine(IFoo, u'state:CREATED')
+        m2 = table.machine(IFoo, u'state:CREATED')
+        self.assertEqual(m1.trigger(u'action:START'), u'state:STARTED')
+        self.assertEqual(m1.current, u'state:STARTED')
+        self.assertEqual(m2.current, u'state:CREATED')
+        self.assertFalse(m1.can(u'action:START'))
+        self.assertTrue(m2.can(u'action:START'))
+
+    def test_invalid_trigger(self):
+        """Triggering an invalid action raises a ``FysomError``."""
+
+        machine = self.makeOne().machine(IFoo, u'state:CREATED')
+        self.assertRaises(fysom.FysomError, machine.trigger, u'action:COMPLETE')
+        self.assertEqual(machine.current, u'state:CREATED')
+
+class TestGetStateMachine(unittest.TestCase):
+    """Test the ``pyramid_torque_engine.action.get_state_machine`` lookup."""
+
+    def setUp(self):
+        self.mock_request = Mock()
+        registry = self.mock_request.registry
+        registry.state_action_table = action.TransitionTable(RULES)
+        registry.state_machine_cache = {}
+
+    def makeContext(self):
+        context = Mock()
+        context.work_status.value = u'state:CREATED'
+        zi.alsoProvides(context, IFoo)
+        return context
+
+    def test_resolution_is_memoized(self):
+        """Interfaces are resolved once per provided specification and action."""
+
+        mock_get_interfaces = Mock()
+        mock_get_interfaces.return_value = (IBar, IFoo)
+        context = self.makeContext()
+        for i in range(3):
+            machine = action.get_state_machine(self.mock_request, context,
+                    action=u'action:START', get_interfaces=mock_get_interfaces)
+            self.assertTrue(machine.can(u'action:START'))
+        self.assertEqual(mock_get_interfaces.call_count, 1)
+
+    def test_unmatched_action(self):
+        """Returns ``None`` when no interface has rules for the action."""
+
+        context = self.makeContext()
+        machine = action.get_state_machine(self.mock_request, context,
+                action=u'action:UNKNOWN')
+        self.assertTrue(machine is None)
+
+class TestTryPerform(unittest.TestCase):
+    """Test the ``pyramid_torque_engine.action.StateChanger.try_perform``."""
+
+    def setUp(self):
+        self.table = action.TransitionTable(RULES)
+        self.mock_get_machine = Mock()
+        self.mock_get_event = Mock()
+
+    def makeOne(self):
+        return action.StateChanger(Mock(), engine=Mock(),
+                get_machine=self.mock_get_machine)
+
+    def test_invalid_action(self):
+        """Returns ``None`` without creating an event."""
+
+        machine = self.table.machine(IFoo, u'state:CREATED')
+        self.mock_get_machine.return_value = machine
+        state_changer = self.makeOne()
+        performed = state_changer.try_perform(Mock(), u'action:COMPLETE',
+                get_event=self.mock_get_event)
+        self.assertTrue(performed is None)
+        self.assertFalse(self.mock_get_event.called)
+
+    def test_valid_action(self):
+        """Resolves the machine once and performs with it."""
+
+        machine = self.table.machine(IFoo, u'state:CREATED')
+        self.mock_get_machine.return_value = machine
+        state_changer = self.makeOne()
+        state_changer.change_state = Mock()
+        performed = state_changer.try_perform(Mock(), u'action:POKE',
+                get_event=self.mock_get_event)
+        next_state, has_changed, dispatched = performed
+        self.assertEqual(next_state, u'state:CREATED')
+        self.assertFalse(has_changed)
+        self.assertEqual(len(dispatched), 1)
+        self.assertEqual(self.mock_get_machine.call_count, 1)
+        self.assertEqual(self.mock_get_event.call_count, 1)
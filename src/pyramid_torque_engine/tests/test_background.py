@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""Test the background dispatch workers."""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import Queue
+import threading
+import unittest
+
+from mock import MagicMock as Mock
+
+from pyramid_torque_engine import background
+
+class TestDispatchWorkers(unittest.TestCase):
+    """Test the ``pyramid_torque_engine.background.DispatchWorkers``."""
+
+    def test_tasks_are_called_in_order(self):
+        """Queued tasks are called in order and drained on shutdown."""
+
+        workers = background.DispatchWorkers(concurrency=1, queue_size=10)
+        called = []
+        for i in range(5):
+            workers.put(lambda i=i: called.append(i))
+        self.assertEqual(workers.drain(timeout=5), 0)
+        self.assertEqual(called, range(5))
+
+    def test_queue_full(self):
+        """A full queue raises ``Queue.Full`` unless told to block."""
+
+        release = threading.Event()
+        workers = background.DispatchWorkers(concurrency=1, queue_size=1)
+        workers.put(release.wait)
+        workers.put(Mock())
+        self.assertRaises(Queue.Full, workers.put, Mock(), block=False)
+        self.assertRaises(Queue.Full, workers.put, Mock(), timeout=0.01)
+        self.assertTrue(workers.is_full())
+        release.set()
+        self.assertEqual(workers.drain(timeout=5), 0)
+        self.assertFalse(workers.is_full())
+
+    def test_after_drain(self):
+        """Once drained, tasks are called in the current thread."""
+
+        workers = background.DispatchWorkers()
+        workers.drain(timeout=1)
+        mock_task = Mock()
+        workers.put(mock_task)
+        self.assertTrue(mock_task.called)
+        self.assertEqual(workers.threads, [])
@@ -5,12 +5,18 @@
 import logging
 logger = logging.getLogger(__name__)
 
+import Queue
 import json
+import threading
+import time
+import transaction
 import unittest
 
 from mock import MagicMock as Mock
 
 from ntorque import client as ntorque_client
+from pyramid import testing
+from pyramid.exceptions import ConfigurationError
 from pyramid_torque_engine import client as engine_client
 
 class TestConfiguration(unittest.TestCase):
@@ -48,6 +54,25 @@ class TestConfiguration(unittest.TestCase):
         self.assertTrue(hasattr(api, 'dispatch_now'))
         self.assertTrue(hasattr(api, 'engine'))
 
+    def test_api_is_lazy(self):
+        """The ``request.torque`` clients are instantiated on first access
+          and shared by requests to the same registry.
+        """
+
+        mock_request = Mock()
+        mock_request.registry.settings = engine_client.DEFAULTS
+        mock_request.registry.torque_clients = {}
+        mock_request.environ = {}
+        api = engine_client.get_torque_api(mock_request)
+        self.assertFalse('engine' in api.__dict__)
+        self.assertEqual(mock_request.registry.torque_clients, {})
+        engine = api.engine
+        self.assertTrue(api.engine is engine)
+        other = engine_client.get_torque_api(mock_request)
+        self.assertTrue(other.engine.client is engine.client)
+        self.assertTrue(other.dispatch.client is engine.client)
+        self.assertFalse(other.dispatch_now.client is engine.client)
+
 class TestHookDispatcher(unittest.TestCase):
     """Test the the ``pyramid_torque_engine.client.HookDispatcher``."""
 
@@ -139,6 +164,34 @@ class TestWorkEngineClient(unittest.TestCase):
         data = json.loads(self.mock_dispatcher.call_args[0][1])
         self.assertTrue(data['action'].endswith('SPAMMED'))
 
+    def test_changed_and_happened(self):
+        """Test dispatching a combined state change and action notification."""
+
+        # Pretend we're updating jobs#1234.
+        mock_context = Mock()
+        mock_state_event = Mock()
+        mock_state_event.id = 2
+        mock_event = Mock()
+        mock_event.id = 1
+        self.mock_unpack.return_value = ('jobs', 1234)
+
+        # Dispatch an update.
+        client = self.makeOne()
+        return_value = client.changed_and_happened(mock_context, 'action:POKE',
+                mock_state_event, event=mock_event, state=u'state:POKED')
+
+        # The return value includes the status of the dispatch.
+        status = return_value['status']
+        self.assertTrue(status == u'DISPATCHED')
+
+        # And a single dispatch carried both the state and the action.
+        self.assertEqual(self.mock_dispatcher.call_count, 1)
+        data = json.loads(self.mock_dispatcher.call_args[0][1])
+        self.assertTrue(data['state'] == u'state:POKED')
+        self.assertTrue(data['action'] == u'action:POKE')
+        self.assertTrue(data['event_id'] == 1)
+        self.assertTrue(data['state_event_id'] == 2)
+
     def test_operation_result(self):
         """Test dispatching a work engine operation result."""
 
@@ -159,3 +212,339 @@ class TestWorkEngineClient(unittest.TestCase):
         data = json.loads(self.mock_dispatcher.call_args[0][1])
         self.assertTrue(data['operation'].endswith('VERB'))
         self.assertTrue(data['result'].endswith('NOUN'))
+
+    def test_operation_results(self):
+        """Test dispatching an operation result for many contexts, identified
+          the same way as the other dispatches.
+        """
+
+        # Pretend we're updating jobs#1234.
+        mock_context = Mock()
+        self.mock_unpack.return_value = ('jobs', 1234)
+
+        # Dispatch an update.
+        client = self.makeOne()
+        client.results([mock_context], 'o:VERB', 'r:NOUN', event_id=1)
+
+        # The items were unpacked from the contexts.
+        self.mock_unpack.assert_called_with(mock_context)
+        data = json.loads(self.mock_dispatcher.call_args[0][1])
+        item = data['items'][0]
+        self.assertEqual(item['tablename'], 'jobs')
+        self.assertEqual(item['id'], 1234)
+        self.assertEqual(item['result'], 'r:NOUN')
+
+class TestBatchDispatcher(unittest.TestCase):
+    """Test the the ``pyramid_torque_engine.client.BatchDispatcher``."""
+
+    def setUp(self):
+        self.mock_after_commit = Mock()
+        self.mock_get_transaction = Mock()
+        self.mock_get_transaction.return_value = Mock()
+        self.mock_dispatcher = Mock()
+        self.mock_dispatcher.return_value = u'DISPATCHED', {}, {}
+
+    def makeOne(self, **kwargs):
+        kwargs.setdefault('after_commit', self.mock_after_commit)
+        kwargs.setdefault('get_transaction', self.mock_get_transaction)
+        kwargs.setdefault('post', engine_client.BatchReceiver(self.mock_dispatcher))
+        return engine_client.BatchDispatcher('http://torque/batch', **kwargs)
+
+    def test_buffers_until_commit(self):
+        """Dispatches are buffered with a single commit hook per transaction."""
+
+        dispatcher = self.makeOne()
+        for i in range(3):
+            status, _, _ = dispatcher('url{0}'.format(i), '{}', {})
+            self.assertTrue(status == u'DISPATCHED')
+        self.assertEqual(self.mock_after_commit.call_count, 1)
+        self.assertFalse(self.mock_dispatcher.called)
+
+    def test_savepoint_rollback(self):
+        """Dispatches made after a rolled back savepoint aren't flushed."""
+
+        transaction.begin()
+        try:
+            dispatcher = self.makeOne(get_transaction=transaction.get)
+            dispatcher('url0', '{}', {})
+            savepoint = transaction.savepoint()
+            dispatcher('url1', '{}', {})
+            savepoint.rollback()
+            dispatcher('url2', '{}', {})
+            flush, = self.mock_after_commit.call_args[0]
+            tasks, = self.mock_after_commit.call_args[1]['args']
+            self.assertEqual([task['url'] for task in tasks], ['url0', 'url2'])
+        finally:
+            transaction.abort()
+
+    def test_flush_in_background_after_commit(self):
+        """With the real background flush, every committed batch is posted."""
+
+        posted = []
+        mock_post = Mock()
+        mock_post.side_effect = lambda url, data=None, headers=None: (
+                posted.append(data) or Mock(status_code=200))
+        dispatcher = engine_client.BatchDispatcher('http://torque/batch',
+                post=mock_post)
+        for i in range(20):
+            with transaction.manager:
+                dispatcher('url{0}'.format(i), '{}', {})
+        deadline = time.time() + 5
+        while len(posted) < 20 and time.time() < deadline:
+            time.sleep(0.01)
+        urls = [json.loads(data)['tasks'][0]['url'] for data in posted]
+        self.assertEqual(sorted(urls), sorted('url{0}'.format(i)
+                for i in range(20)))
+
+    def test_flush_in_chunks(self):
+        """After commit, the buffer is posted in chunks and the receiver
+          dispatches the tasks in order.
+        """
+
+        dispatcher = self.makeOne(batch_size=2)
+        for i in range(5):
+            dispatcher('url{0}'.format(i), '{}', {})
+        flush = self.mock_after_commit.call_args[0][0]
+        tasks, = self.mock_after_commit.call_args[1]['args']
+        flush(tasks)
+        self.assertEqual([len(item) for item in dispatcher.post.batches], [2, 2, 1])
+        urls = [item[0][0] for item in self.mock_dispatcher.call_args_list]
+        self.assertEqual(urls, ['url0', 'url1', 'url2', 'url3', 'url4'])
+
+    def test_buffer_per_transaction(self):
+        """Each transaction gets its own buffer."""
+
+        dispatcher = self.makeOne()
+        dispatcher('url', '{}', {})
+        self.mock_get_transaction.return_value = Mock()
+        dispatcher('url', '{}', {})
+        self.assertEqual(self.mock_after_commit.call_count, 2)
+
+class TestBackgroundDispatcher(unittest.TestCase):
+    """Test the the ``pyramid_torque_engine.client.BackgroundDispatcher``."""
+
+    def setUp(self):
+        self.mock_after_commit = Mock()
+        self.mock_workers = Mock()
+        self.mock_get_bind = Mock()
+        self.mock_post = Mock()
+
+    def makeOne(self, **kwargs):
+        kwargs.setdefault('after_commit', self.mock_after_commit)
+        kwargs.setdefault('get_bind', self.mock_get_bind)
+        kwargs.setdefault('post', self.mock_post)
+        return engine_client.BackgroundDispatcher(self.mock_workers, **kwargs)
+
+    def test_enqueue_after_commit(self):
+        """Dispatches are queued after commit and posted by the workers."""
+
+        dispatcher = self.makeOne()
+        status, _, _ = dispatcher('url', '{}', {})
+        self.assertTrue(status == u'DISPATCHED')
+        self.assertFalse(self.mock_workers.put.called)
+        enqueue, url, data, headers = self.mock_after_commit.call_args[0]
+        enqueue(url, data, headers)
+        task = self.mock_workers.put.call_args[0][0]
+        self.assertEqual(self.mock_workers.put.call_args[1]['block'], True)
+        task()
+        self.mock_post.assert_called_with('url', data='{}', headers={})
+
+    def test_backpressure(self):
+        """When the queue fills up before commit, dispatches are either
+          dropped or written to the outbox, depending on the policy.
+        """
+
+        self.mock_workers.put.side_effect = Queue.Full
+        dispatcher = self.makeOne(policy='error')
+        dispatcher.enqueue('url', '{}', {})
+        self.assertFalse(self.mock_get_bind.called)
+        dispatcher = self.makeOne(policy='outbox')
+        dispatcher.enqueue('url', '{}', {})
+        connection = self.mock_get_bind.return_value.connect.return_value
+        self.assertEqual(connection.execute.call_args[1]['url'], 'url')
+        self.assertRaises(ValueError, self.makeOne, policy='drop')
+
+    def test_error_policy_raises_to_caller(self):
+        """With the ``error`` policy, the caller sees ``Queue.Full`` before
+          commit, rather than the dispatch being dropped by the hook.
+        """
+
+        self.mock_workers.is_full.return_value = True
+        dispatcher = self.makeOne(policy='error')
+        self.assertRaises(Queue.Full, dispatcher, 'url', '{}', {})
+        self.assertFalse(self.mock_after_commit.called)
+        self.mock_workers.is_full.return_value = False
+        status, _, _ = dispatcher('url', '{}', {})
+        self.assertEqual(status, u'DISPATCHED')
+        self.assertTrue(self.mock_after_commit.called)
+
+class TestInlineDispatcher(unittest.TestCase):
+    """Test the the ``pyramid_torque_engine.client.InlineDispatcher``."""
+
+    def setUp(self):
+        self.mock_request = Mock()
+        self.mock_request.registry.settings = engine_client.DEFAULTS
+        self.mock_dispatcher = Mock()
+        self.mock_dispatcher.return_value = u'DISPATCHED', {}, {}
+        self.mock_after_commit = Mock()
+        self.mock_unpack = Mock()
+        self.mock_unpack.return_value = ('jobs', 1234)
+
+    def makeOne(self, **kwargs):
+        kwargs.setdefault('after_commit', self.mock_after_commit)
+        kwargs.setdefault('transaction_manager', Mock())
+        return engine_client.InlineDispatcher(self.mock_request, **kwargs)
+
+    def makeClient(self, patterns):
+        inline = self.makeOne(patterns=patterns)
+        return engine_client.WorkEngineClient(self.mock_request,
+                client_cls=ntorque_client.HTTPTorqueClient,
+                dispatcher=self.mock_dispatcher, unpack=self.mock_unpack,
+                inline=inline)
+
+    def test_matching_paths_are_inline(self):
+        """Only the paths that match are dispatched inline, after commit."""
+
+        client = self.makeClient(['events/*'])
+        client.happened(Mock(), 'action:POKE')
+        self.assertFalse(self.mock_dispatcher.called)
+        invoke, url, data, headers = self.mock_after_commit.call_args[0]
+        self.assertEqual(url, '/engine/events/jobs/1234')
+        client.result(Mock(), 'o:VERB', 'r:NOUN', event_id=1)
+        self.assertEqual(self.mock_dispatcher.call_count, 1)
+        self.assertEqual(self.mock_after_commit.call_count, 1)
+
+    def test_invoke_at_engine_path(self):
+        """The subrequest is made to the path of the engine url."""
+
+        self.mock_request.script_name = ''
+        self.mock_request.invoke_subrequest.return_value.status_int = 200
+        mock_fallback = Mock()
+        inline = self.makeOne(fallback=mock_fallback)
+        inline.invoke('/engine/events/jobs/1234', '{}', {})
+        subrequest = self.mock_request.invoke_subrequest.call_args[0][0]
+        self.assertEqual(subrequest.path_info, '/engine/events/jobs/1234')
+        self.assertFalse(mock_fallback.called)
+
+    def test_invoke_falls_back(self):
+        """Failed subrequests are handed to the fallback client, within
+          their own transaction.
+        """
+
+        self.mock_request.script_name = ''
+        self.mock_request.invoke_subrequest.side_effect = ValueError
+        mock_fallback = Mock()
+        mock_manager = Mock()
+        inline = self.makeOne(fallback=mock_fallback,
+                transaction_manager=mock_manager)
+        url = 'http://localhost/events/jobs/1234'
+        inline.invoke(url, '{}', {'Foo': 'bar'})
+        mock_fallback.assert_called_with(url, data='{}', headers={'Foo': 'bar'})
+        self.assertTrue(mock_manager.__enter__.called)
+        self.assertTrue(mock_manager.__exit__.called)
+        self.mock_request.invoke_subrequest.side_effect = None
+        self.mock_request.invoke_subrequest.return_value.status_int = 404
+        inline.invoke(url, '{}', {})
+        self.assertEqual(mock_fallback.call_count, 2)
+
+    def test_validate_inline_routes(self):
+        """Enabling ``engine.inline`` requires the engine routes at the
+          path of the ``engine.url``.
+        """
+
+        settings = {'engine.inline': 'true', 'engine.url': '/engine'}
+        config = testing.setUp(settings=settings)
+        try:
+            config.add_route('events', '/events/*traverse')
+            config.add_route('results', '/results/*traverse')
+            config.commit()
+            self.assertRaises(ConfigurationError,
+                    engine_client.validate_inline_routes, config)
+            config.registry.settings['engine.url'] = 'http://localhost'
+            engine_client.validate_inline_routes(config)
+            config.registry.settings['engine.inline'] = 'false'
+            config.registry.settings['engine.url'] = '/engine'
+            engine_client.validate_inline_routes(config)
+        finally:
+            testing.tearDown()
+
+    def test_is_local_url(self):
+        """Only paths and local hosts are local."""
+
+        self.assertTrue(engine_client.is_local_url('/engine'))
+        self.assertTrue(engine_client.is_local_url('http://localhost:6543'))
+        self.assertFalse(engine_client.is_local_url('https://engine.example.com'))
+
+class TestDedupingClient(unittest.TestCase):
+    """Test the the ``pyramid_torque_engine.client.DedupingClient``."""
+
+    def setUp(self):
+        self.mock_client = Mock()
+        self.mock_client.return_value = u'DISPATCHED', {}, {}
+        self.mock_get_transaction = Mock()
+        self.mock_get_transaction.return_value = Mock()
+
+    def makeOne(self):
+        return engine_client.DedupingClient(self.mock_client,
+                get_transaction=self.mock_get_transaction)
+
+    def test_identical_dispatches_are_dropped(self):
+        """Only the first of identical dispatches in a transaction is made."""
+
+        client = self.makeOne()
+        for i in range(3):
+            status, _, _ = client('url', data='{"a":1}', headers={'k': 'v'})
+            self.assertTrue(status == u'DISPATCHED')
+        client('url', data='{"a":2}', headers={'k': 'v'})
+        client('url', data='{"a":1}', headers={'k': 'w'})
+        self.assertEqual(self.mock_client.call_count, 3)
+        self.assertEqual(client.dropped, 2)
+
+        # The count is reported after commit.
+        tx = self.mock_get_transaction.return_value
+        report = tx.addAfterCommitHook.call_args[0][0]
+        keys, = tx.addAfterCommitHook.call_args[1]['args']
+        self.assertEqual(keys.dropped, 2)
+        report(True, keys)
+
+    def test_per_transaction(self):
+        """Dispatches in another transaction aren't dropped."""
+
+        client = self.makeOne()
+        client('url', data='{}')
+        self.mock_get_transaction.return_value = Mock()
+        client('url', data='{}')
+        self.assertEqual(self.mock_client.call_count, 2)
+        self.assertEqual(client.dropped, 0)
+
+class TestWebTestWorkers(unittest.TestCase):
+    """Test the the ``pyramid_torque_engine.client.WebTestWorkers``."""
+
+    def makeOne(self):
+        return engine_client.WebTestWorkers(session=Mock())
+
+    def test_calls_are_made_in_reused_workers(self):
+        """Calls are made in order, in the same long lived thread."""
+
+        workers = self.makeOne()
+        names = [workers(lambda: threading.current_thread().name)
+                for i in range(3)]
+        self.assertEqual(len(set(names)), 1)
+        self.assertFalse(threading.current_thread().name in names)
+        self.assertEqual(workers.session.remove.call_count, 3)
+
+    def test_nested_calls(self):
+        """Nested calls are made in the next worker down."""
+
+        workers = self.makeOne()
+        current = lambda: threading.current_thread().name
+        outer, inner = workers(lambda: (current(), workers(current)))
+        self.assertNotEqual(outer, inner)
+        self.assertEqual(len(workers.queues), 2)
+
+    def test_errors_are_raised(self):
+        """Errors are re-raised in the calling thread."""
+
+        workers = self.makeOne()
+        self.assertRaises(ZeroDivisionError, workers, lambda: 1 / 0)
+        self.assertEqual(workers(lambda: 1), 1)
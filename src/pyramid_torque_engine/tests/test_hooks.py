@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""Test the savepoint aware after commit hooks."""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import transaction
+import unittest
+
+from pyramid_torque_engine import hooks
+
+class TestJoinToTransaction(unittest.TestCase):
+    """Test the ``pyramid_torque_engine.hooks.join_to_transaction`` function."""
+
+    def setUp(self):
+        self.called = []
+        transaction.begin()
+
+    def tearDown(self):
+        transaction.abort()
+
+    def test_called_after_commit(self):
+        """Hooks are called in order iff the transaction commits."""
+
+        hooks.join_to_transaction(self.called.append, 'a')
+        hooks.join_to_transaction(self.called.append, 'b')
+        self.assertEqual(self.called, [])
+        transaction.commit()
+        self.assertEqual(self.called, ['a', 'b'])
+        hooks.join_to_transaction(self.called.append, 'c')
+        transaction.abort()
+        self.assertEqual(self.called, ['a', 'b'])
+
+    def test_savepoint_rollback(self):
+        """Hooks added after a rolled back savepoint are discarded, including
+          when the hooks were first joined after the savepoint was taken.
+        """
+
+        savepoint = transaction.savepoint()
+        hooks.join_to_transaction(self.called.append, 'a')
+        savepoint.rollback()
+        hooks.join_to_transaction(self.called.append, 'b')
+        savepoint = transaction.savepoint()
+        hooks.join_to_transaction(self.called.append, 'c')
+        savepoint.rollback()
+        hooks.join_to_transaction(self.called.append, 'd')
+        transaction.commit()
+        self.assertEqual(self.called, ['b', 'd'])
+
+    def test_errors_are_logged(self):
+        """A failing hook doesn't stop the others."""
+
+        def fail():
+            raise ValueError
+        hooks.join_to_transaction(fail)
+        hooks.join_to_transaction(self.called.append, 'a')
+        transaction.commit()
+        self.assertEqual(self.called, ['a'])
+
+class TestSavepointBuffer(unittest.TestCase):
+    """Test the ``pyramid_torque_engine.hooks.SavepointBuffer``."""
+
+    def test_kept_after_commit(self):
+        """The items survive the commit, so hooks can read them later, but
+          are discarded when the transaction is rolled back.
+        """
+
+        with transaction.manager as txn:
+            buffer = hooks.SavepointBuffer(txn)
+            buffer.append('a')
+        buffer.abort(txn)
+        self.assertEqual(buffer, ['a'])
+        txn = transaction.begin()
+        buffer = hooks.SavepointBuffer(txn)
+        buffer.append('b')
+        transaction.abort()
+        self.assertEqual(buffer, [])
+        self.assertTrue(buffer.is_aborted)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+"""Test the shared HTTP connection pools."""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import threading
+import unittest
+
+from mock import MagicMock as Mock
+
+from pyramid_torque_engine import pool
+
+class TestSessionPool(unittest.TestCase):
+    """Test the ``pyramid_torque_engine.pool.SessionPool``."""
+
+    def makeOne(self, **kwargs):
+        kwargs.setdefault('session_cls', Mock)
+        kwargs.setdefault('adapter_cls', Mock)
+        return pool.SessionPool(**kwargs)
+
+    def test_sessions_are_shared(self):
+        """Sessions are created once per configuration and shared across
+          threads.
+        """
+
+        get_session = self.makeOne()
+        sessions = []
+        threads = [threading.Thread(target=lambda: sessions.append(get_session()))
+                for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set(sessions)), 1)
+        self.assertFalse(get_session(pool_size=20) in sessions)
+
+    def test_pool_size(self):
+        """The pool size is used for the mounted adapters."""
+
+        mock_adapter_cls = Mock()
+        get_session = self.makeOne(adapter_cls=mock_adapter_cls)
+        session = get_session(pool_size=20)
+        mock_adapter_cls.assert_called_with(pool_connections=20, pool_maxsize=20)
+        self.assertEqual(session.mount.call_count, 2)
+
+    def test_get_post(self):
+        """``get_post`` uses the session configured by the settings."""
+
+        settings = {'torque.pool_size': '4', 'torque.keep_alive': 'false'}
+        post = pool.get_post(settings)
+        self.assertTrue(post.__self__ is pool.get_session(4, False))
+        self.assertEqual(post.__self__.headers['Connection'], 'close')
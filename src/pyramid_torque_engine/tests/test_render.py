@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""Test the JSON serialisation conventions."""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import datetime
+import decimal
+import json
+import unittest
+
+from mock import MagicMock as Mock
+
+from pyramid import interfaces as pi
+from pyramid import registry
+from pyramid import renderers
+
+from pyramid_torque_engine import render
+
+class Thing(object):
+    def __json__(self, request=None):
+        return {'request': request.name}
+
+class TestCompactJSONSerializer(unittest.TestCase):
+    """Test the ``pyramid_torque_engine.render.CompactJSONSerializer``."""
+
+    def setUp(self):
+        self.request = Mock()
+        self.request.name = 'req'
+        self.request.registry = registry.Registry()
+
+    def test_conventions(self):
+        """Decimals and ``__json__`` are serialised the usual way, compactly."""
+
+        value = {'a': decimal.Decimal('2'), 'b': decimal.Decimal('1.5'),
+                'thing': Thing()}
+        for backend in (json, render.simplejson):
+            if backend is None:
+                continue
+            dumps = render.CompactJSONSerializer(backend=backend)
+            data = dumps(self.request, value)
+            self.assertFalse(' ' in data)
+            self.assertEqual(json.loads(data),
+                    {'a': 2, 'b': 1.5, 'thing': {'request': 'req'}})
+
+    def test_renderer_adapters(self):
+        """Anything else uses the adapters registered with the renderer."""
+
+        factory = renderers.JSON()
+        factory.add_adapter(datetime.date, lambda obj, request: obj.isoformat())
+        self.request.registry.registerUtility(factory, pi.IRendererFactory,
+                name='json')
+        dumps = render.CompactJSONSerializer()
+        data = dumps(self.request, [datetime.date(2015, 1, 2)])
+        self.assertEqual(json.loads(data), ['2015-01-02'])
+        self.assertRaises(TypeError, dumps, self.request, [object()])
+
+    def test_renderer_decimal_adapter(self):
+        """A ``Decimal`` adapter registered with the renderer takes precedence
+          over the default conversion.
+        """
+
+        factory = renderers.JSON()
+        factory.add_adapter(decimal.Decimal, lambda obj, request: str(obj))
+        self.request.registry.registerUtility(factory, pi.IRendererFactory,
+                name='json')
+        dumps = render.CompactJSONSerializer()
+        data = dumps(self.request, [decimal.Decimal('2')])
+        self.assertEqual(json.loads(data), ['2'])
+
+    def test_adapters_added_later(self):
+        """Adapters added after the first call are used."""
+
+        factory = renderers.JSON()
+        self.request.registry.registerUtility(factory, pi.IRendererFactory,
+                name='json')
+        dumps = render.CompactJSONSerializer()
+        self.assertEqual(json.loads(dumps(self.request, [1])), [1])
+        factory.add_adapter(datetime.date, lambda obj, request: obj.isoformat())
+        data = dumps(self.request, [datetime.date(2015, 1, 2)])
+        self.assertEqual(json.loads(data), ['2015-01-02'])
+
+    def test_custom_renderer(self):
+        """A renderer with a custom serializer or options is used instead."""
+
+        factories = (
+            renderers.JSON(serializer=lambda value, **kw: 'custom'),
+            renderers.JSON(indent=4),
+            Mock(),
+        )
+        for factory in factories:
+            request = Mock()
+            request.registry = registry.Registry()
+            request.registry.registerUtility(factory, pi.IRendererFactory,
+                    name='json')
+            json_dumps = Mock()
+            dumps = render.CompactJSONSerializer(json_dumps=json_dumps)
+            data = dumps(request, [1])
+            json_dumps.assert_called_once_with(request, [1])
+            self.assertEqual(data, json_dumps.return_value)
+
+        # By default, using the registered renderer.
+        self.request.registry.registerUtility(factories[0],
+                pi.IRendererFactory, name='json')
+        data = render.CompactJSONSerializer()(self.request, [1])
+        self.assertEqual(data, 'custom')
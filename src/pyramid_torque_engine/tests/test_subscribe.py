@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""Test the engine subscriber index."""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import unittest
+
+import zope.interface as zi
+
+from pyramid_torque_engine import subscribe
+
+class IModel(zi.Interface):
+    pass
+
+class IFoo(IModel):
+    pass
+
+@zi.implementer(IFoo)
+class Foo(object):
+    pass
+
+class Registration(object):
+    def __init__(self, required, handler):
+        self.required = required
+        self.handler = handler
+
+class TestSubscriberIndex(unittest.TestCase):
+    """Test the ``pyramid_torque_engine.subscribe.SubscriberIndex``."""
+
+    def makeOne(self):
+        index = subscribe.SubscriberIndex()
+        index.add(IFoo, 'state', u'state:STARTED', 'foo_started')
+        index.add(IModel, 'action', u'action:POKE', 'model_poked')
+        index.add(IFoo, None, None, 'foo_asterix')
+        index.add(IModel, 'state', u'state:STARTED', 'model_started')
+        index.add(Foo, 'state', u'state:STARTED', 'class_started')
+        index.add(IModel, 'state', u'state:CANCELLED', 'model_cancelled')
+        return index
+
+    def test_lookup(self):
+        """Only matching subscribers are returned, from the least to the most
+          specific interface, in registration order.
+        """
+
+        index = self.makeOne()
+        params = {'state': u'state:STARTED', 'event_id': 1, 'data': {}}
+        subscribers = index.lookup(zi.providedBy(Foo()), params)
+        self.assertEqual(subscribers, ['model_started', 'foo_started',
+                'foo_asterix', 'class_started'])
+
+    def test_lookup_action(self):
+        """Asterix subscribers match everything."""
+
+        index = self.makeOne()
+        params = {'action': u'action:POKE'}
+        subscribers = index.lookup(zi.providedBy(Foo()), params)
+        self.assertEqual(subscribers, ['model_poked', 'foo_asterix'])
+
+    def test_lookup_context(self):
+        """The compiled class table matches the specification lookup."""
+
+        index = self.makeOne()
+        index.freeze([Foo])
+        for params in ({'state': u'state:STARTED'}, {'action': u'action:POKE'}):
+            expected = index.lookup(zi.providedBy(Foo()), params)
+            self.assertEqual(list(index.lookup_context(Foo(), params)),
+                    expected)
+
+    def test_lookup_context_direct_provides(self):
+        """Instances that directly provide interfaces aren't looked up by
+          class.
+        """
+
+        class IBar(zi.Interface):
+            pass
+
+        index = self.makeOne()
+        index.add(IBar, None, None, 'bar_asterix')
+        context = Foo()
+        zi.alsoProvides(context, IBar)
+        subscribers = index.lookup_context(context, {'action': u'action:POKE'})
+        self.assertEqual(subscribers, ['model_poked', 'foo_asterix',
+                'bar_asterix'])
+        self.assertFalse(Foo in index.tables)
+
+    def test_add_clears_tables(self):
+        """Adding a subscriber invalidates the compiled tables."""
+
+        index = self.makeOne()
+        index.freeze([Foo])
+        index.add(IFoo, 'action', u'action:POKE', 'foo_poked')
+        subscribers = index.lookup_context(Foo(), {'action': u'action:POKE'})
+        self.assertEqual(subscribers, ('model_poked', 'foo_asterix',
+                'foo_poked'))
+
+    def test_compile(self):
+        """Each class is compiled into ordered tuples per param and value,
+          with the asterix subscribers merged in.
+        """
+
+        table = self.makeOne().compile(Foo)
+        subscribers, _ = table[('state', u'state:STARTED')]
+        self.assertEqual(subscribers, ('model_started', 'foo_started',
+                'foo_asterix', 'class_started'))
+        self.assertEqual(table[None][0], ('foo_asterix',))
+
+    def test_lookup_context_many_params(self):
+        """When several params match, their subscribers are merged in order."""
+
+        index = self.makeOne()
+        params = {'state': u'state:STARTED', 'action': u'action:POKE'}
+        expected = index.lookup(zi.providedBy(Foo()), params)
+        self.assertEqual(list(index.lookup_context(Foo(), params)), expected)
+        params = {'state': u'state:UNKNOWN', 'event_id': 1}
+        self.assertEqual(index.lookup_context(Foo(), params), ('foo_asterix',))
+
+    def test_sync(self):
+        """Syncing re-sequences the subscribers in registration order and
+          indexes plain handlers as asterix subscribers.
+        """
+
+        index = self.makeOne()
+        registrations = [
+            Registration((IFoo,), 'foo_asterix'),
+            Registration((IModel,), 'plain'),
+            Registration((IModel, IFoo), 'multi'),
+        ]
+        for item in list(index.items):
+            if item[4] not in ('foo_asterix', 'model_cancelled'):
+                registrations.append(Registration((item[0],), item[4]))
+        index.sync(registrations)
+        params = {'state': u'state:STARTED'}
+        subscribers = index.lookup(zi.providedBy(Foo()), params)
+        self.assertEqual(subscribers, ['plain', 'model_started',
+                'foo_asterix', 'foo_started', 'class_started'])
+        params = {'state': u'state:CANCELLED'}
+        subscribers = index.lookup(zi.providedBy(Foo()), params)
+        self.assertEqual(subscribers, ['plain', 'model_cancelled',
+                'foo_asterix'])
+
+class TestCombinedArgs(unittest.TestCase):
+    """Test the subscribers are called with ``(request, context, event)``."""
+
+    def test_three_tuple(self):
+        """Custom subscribers can still unpack three args."""
+
+        combined_args = subscribe.CombinedArgs('req', 'ctx', 'evt',
+                {'state': u'state:STARTED'})
+        request, context, event = combined_args
+        self.assertEqual((request, context, event), ('req', 'ctx', 'evt'))
+        self.assertEqual(combined_args.params, {'state': u'state:STARTED'})
+
+    def test_param_aware_subscriber(self):
+        """Param aware subscribers match the params, falling back on the
+          request's when given a plain tuple.
+        """
+
+        handler = lambda *args: args
+        subscriber = subscribe.ParamAwareSubscriber('state', u'state:STARTED',
+                handler)
+        combined_args = subscribe.CombinedArgs('req', 'ctx', 'evt',
+                {'state': u'state:STARTED'})
+        self.assertEqual(subscriber(combined_args), ('req', 'ctx', 'evt'))
+        combined_args = subscribe.CombinedArgs('req', 'ctx', 'evt', {})
+        self.assertEqual(subscriber(combined_args), None)
+
+        class Request(object):
+            json = {'state': u'state:STARTED'}
+        request = Request()
+        self.assertEqual(subscriber((request, 'ctx', 'evt')),
+                (request, 'ctx', 'evt'))
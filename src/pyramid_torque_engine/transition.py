@@ -10,20 +10,36 @@
           'a.SET_VALID', # action
       )
 
-  And dispatch to them using `torque.engine.result(context, 'o.VALIDATE', 'r.OK')`.
+  And dispatch to them using `torque.engine.result(context, 'o.VALIDATE', 'r.OK')`
+  or, for many contexts in one request to `/results/batch`, using
+  `torque.engine.results(contexts, 'o.VALIDATE', 'r.OK')`.
+
+  By default, each transition is registered as a `/results` view with a
+  `json_param` predicate. Enable the `engine.direct_transitions` setting
+  to instead handle `/results` with a single view that looks up the
+  transition by `(interface, operation, result)`.
 """
 
 __all__ = [
     'AddEngineTransition',
+    'BatchTransitionHandler',
+    'DirectTransitionHandler',
     'TransitionHandler',
+    'Transitions',
 ]
 
 import logging
 logger = logging.getLogger(__name__)
 
+import zope.interface as zi
+
 from pyramid import exceptions
 from pyramid.config import predicates
+from pyramid.settings import asbool
+from zope.interface.interfaces import IInterface
 
+from . import ledger
+from . import repo
 from . import util
 
 class JSONPredicate(predicates.RequestParamPredicate):
@@ -67,10 +83,103 @@ class TransitionHandler(object):
         dispatched = []
 
         # Perform.
-        if state_changer.can_perform(context, action):
-            _, __, dispatched = request.state_changer.perform(context, action, event)
+        performed = state_changer.try_perform(context, action, event)
+        if performed is not None:
+            _, __, dispatched = performed
         return {'dispatched': dispatched}
 
+class Transitions(object):
+    """Map ``(interface, operation, result)`` to the action to perform, with
+      the lookup for a context memoized by the specification it provides.
+    """
+
+    def __init__(self, **kwargs):
+        self.implementedBy = kwargs.get('implementedBy', zi.implementedBy)
+        self.providedBy = kwargs.get('providedBy', zi.providedBy)
+        self.actions = {}
+        self.cache = {}
+
+    def add(self, context, operation, result, action):
+        """Register the ``action`` for the ``context`` interface (or class)."""
+
+        if not IInterface.providedBy(context):
+            context = self.implementedBy(context)
+        self.actions[(context, operation, result)] = action
+        self.cache.clear()
+
+    def lookup(self, context, operation, result):
+        """Return the action registered for the most specific interface
+          provided by the ``context``, or ``None``.
+        """
+
+        key = (self.providedBy(context), operation, result)
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        action = None
+        for iface in key[0].__sro__:
+            action = self.actions.get((iface, operation, result), None)
+            if action is not None:
+                break
+        self.cache[key] = action
+        return action
+
+class BatchTransitionHandler(object):
+    """Handle a batch of results, posted as a list of ``{tablename, id,
+      operation, result, event_id}`` items, e.g. when an operation reports
+      the same result for many related contexts.
+
+      The contexts and events are loaded in bulk, the actions are resolved
+      once per interface, operation and result and then performed using the
+      ``request.state_changer.perform_each`` batched state changes.
+    """
+
+    def __init__(self, **kwargs):
+        self.loader = kwargs.get('loader', repo.BatchLoader())
+
+    def __call__(self, request):
+        """Perform the transitions, returning a list of results in the same
+          order as the items.
+        """
+
+        # Unpack.
+        data = request.json
+        items = data.get('items', []) if hasattr(data, 'get') else data
+        loader = self.loader
+        registry = request.registry
+        transitions = registry.engine_transitions
+        mapping = getattr(registry, 'engine_resource_mapping', {})
+
+        # Load the contexts and events.
+        contexts = loader.contexts(mapping, items)
+        events = loader.events(items)
+
+        # Resolve the actions to perform.
+        results = [None] * len(items)
+        indexes = []
+        to_perform = []
+        for i, item in enumerate(items):
+            context = contexts.get(loader.key(item), None)
+            if context is None:
+                results[i] = {'status': 404}
+                continue
+            operation = item.get('operation')
+            action = transitions.lookup(context, operation, item.get('result'))
+            if action is None:
+                results[i] = {'status': 204}
+                continue
+            event = events.get(loader.to_id(item.get('event_id')), None)
+            indexes.append(i)
+            to_perform.append((context, action, event))
+
+        # Perform them in one go.
+        performed = request.state_changer.perform_each(to_perform)
+        for i, value in zip(indexes, performed):
+            dispatched = value[2] if value is not None else []
+            results[i] = {'status': 200, 'dispatched': dispatched}
+        return {'results': results}
+
 class AddEngineTransition(object):
     """Configuration directive that uses the Pyramid ``view_config``
       machinery to perform a registered ``action`` for a given ``context``,
@@ -86,23 +195,25 @@ class AddEngineTransition(object):
         """Register a `results` handler for the given predicates."""
 
         # Prepare a function to call to validate that the action was
-        # registered for this context.
-        validate = lambda: self.validate(config.registry, context, action)
+        # registered for this context and add it to the transitions.
+        registry = config.registry
+        def register():
+            self.validate(registry, context, action)
+            registry.engine_transitions.add(context, operation, result, action)
 
         # Register it for this context.
         key = 'engine.transition'
         discriminator = (key, context, operation, result)
 
-        # Instantiate a handler that knows the action to perform.
-        handler = self.handler_cls(action)
-
-        # Build the match params.
-        params = self.request_params(operation=operation, result=result)
-
-        # Register the handler for the context and params.
-        config.add_view(handler, context=context, renderer='json',
-                request_method='POST', json_param=params,
-                route_name='results')
+        # Unless the direct transitions view handles all the results, register
+        # a handler that knows the action to perform for the context and params.
+        settings = registry.settings or {}
+        if not asbool(settings.get('engine.direct_transitions', False)):
+            handler = ledger.wrap_view(self.handler_cls(action), settings)
+            params = self.request_params(operation=operation, result=result)
+            config.add_view(handler, context=context, renderer='json',
+                    request_method='POST', json_param=params,
+                    route_name='results')
 
         # Make it introspectable.
         intr = config.introspectable(category_name='engine transition',
@@ -111,7 +222,7 @@ class AddEngineTransition(object):
                                      type_name=None)
         intr['value'] = (context, operation, result, action)
 
-        config.action(discriminator, validate, introspectables=(intr,))
+        config.action(discriminator, register, introspectables=(intr,))
 
     def validate(self, registry, context, action):
         """Make sure that there's a registered ``action`` for the ``context``."""
@@ -145,21 +256,77 @@ def noop_handler(request):
     return response
 
 
+class DirectTransitionHandler(object):
+    """Handle all results with a single view, that looks up the action to
+      perform in the ``registry.engine_transitions`` rather than relying on
+      view predicates, falling back on the ``noop_handler``.
+    """
+
+    def __init__(self, **kwargs):
+        self.handler_cls = kwargs.get('handler_cls', TransitionHandler)
+        self.noop = kwargs.get('noop', noop_handler)
+        self.handlers = {}
+
+    def __call__(self, request):
+        """Lookup and call the handler for the action, if any."""
+
+        # Unpack.
+        context = request.context
+        transitions = request.registry.engine_transitions
+
+        # Lookup the action.
+        action = None
+        try:
+            data = request.json
+        except ValueError:
+            data = None
+        if context and hasattr(data, 'get'):
+            operation = data.get('operation')
+            result = data.get('result')
+            if operation is not None and result is not None:
+                action = transitions.lookup(context, operation, result)
+        if action is None:
+            return self.noop(request)
+
+        # Call the handler that knows the action to perform.
+        handler = self.handlers.get(action, None)
+        if handler is None:
+            handler = self.handlers[action] = self.handler_cls(action)
+        return handler(request)
+
 class IncludeMe(object):
     """Handle `/results...` and provide an ``add_engine_transition`` directive."""
 
     def __init__(self, **kwargs):
         self.add_transition = kwargs.get('add_transition', AddEngineTransition())
+        self.batch_handler = kwargs.get('batch_handler', BatchTransitionHandler())
+        self.direct_handler = kwargs.get('direct_handler',
+                DirectTransitionHandler())
 
     def __call__(self, config):
-        """Expose route and provide directive."""
+        """Expose routes and provide directive."""
+
+        # Handle `POST [{tablename, id, operation, result, event_id}, ...]
+        # /results/batch`, registering the route first so it takes precedence.
+        config.add_route('results_batch', '/results/batch')
+        config.add_view(self.batch_handler, renderer='json',
+                request_method='POST', route_name='results_batch')
 
         # Configure.
+        settings = config.get_settings()
+        config.registry.engine_transitions = Transitions()
         config.add_route('results', '/results/*traverse')
-        # Add a catch all view that responds to when a result cannot find
-        # a subscriber. In this case 204 is returned instead of 404.
-        config.add_view(noop_handler, renderer='json', request_method='POST',
-                route_name='results')
+        if asbool(settings.get('engine.direct_transitions', False)):
+            # Handle all results with the direct transitions view, which
+            # falls back on the catch all noop handler.
+            view = ledger.wrap_view(self.direct_handler, settings)
+            config.add_view(view, renderer='json',
+                    request_method='POST', route_name='results')
+        else:
+            # Add a catch all view that responds to when a result cannot find
+            # a subscriber. In this case 204 is returned instead of 404.
+            config.add_view(noop_handler, renderer='json',
+                    request_method='POST', route_name='results')
         config.add_view_predicate('json_param', JSONPredicate)
         config.add_directive('add_engine_transition', self.add_transition)
 